@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import redis
+
+from app import metrics
+from app.auth import models
+from app.redis_store import redis_store
+
+logger = logging.getLogger()
+
+# Seconds a looked up user is trusted for. Invalidations normally arrive
+# over pub/sub well before this; it bounds staleness if Redis is down.
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+USER_CACHE_SIZE = max(int(os.getenv("USER_CACHE_SIZE", 1000)), 1)
+INVALIDATION_CHANNEL = "user-cache:invalidate"
+
+
+class UserCache:
+    """Users by email, dropped after USER_CACHE_TTL or when changed.
+
+    Lookups that started before an invalidation aren't stored, so a read
+    racing an update can't put the old user back.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: "OrderedDict[str, Tuple[models.UserInDB, float]]" = OrderedDict()
+
+    def get(self, email: str) -> Optional[models.UserInDB]:
+        entry = self._entries.get(email)
+        if entry is None or entry[1] < time.monotonic():
+            metrics.increment("user_cache.misses")
+            return None
+        self._entries.move_to_end(email)
+        metrics.increment("user_cache.hits")
+        # Handlers may change the user they are given.
+        return entry[0].copy()
+
+    def put(self, email: str, user: models.UserInDB, generation: int):
+        if generation != self.generation:
+            return
+        self._entries[email] = (user.copy(), time.monotonic() + self.ttl)
+        self._entries.move_to_end(email)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def discard(self, email: str):
+        self.generation += 1
+        self._entries.pop(email.lower(), None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+async def invalidate(*emails: str):
+    """Drop users from the cache here and in every other worker."""
+    for email in emails:
+        user_cache.discard(email)
+        try:
+            await redis_store.publish(INVALIDATION_CHANNEL, email.lower())
+        except redis.RedisError as err:
+            logger.warning(f"Could not publish user cache invalidation: {err}")
+
+
+_listener = None
+
+
+def start_listener():
+    """Apply invalidations published by other workers."""
+    global _listener
+    loop = asyncio.get_event_loop()
+
+    def on_message(message):
+        email = message["data"].decode()
+        loop.call_soon_threadsafe(user_cache.discard, email)
+
+    pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: on_message})
+    except redis.RedisError as err:
+        logger.warning(f"User cache invalidations from other workers are off: {err}")
+        return
+    _listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    user_cache.clear()
@@ -5,6 +5,7 @@ import bson
 from motor import motor_asyncio
 
 from app.auth import models
+from app.auth.cache import invalidate, user_cache
 from app.dependencies import db
 
 logger = logging.getLogger()
@@ -17,6 +18,18 @@ async def get_user_by_email(email: str) -> Optional[models.UserInDB]:
     return models.UserInDB.parse_obj(user)
 
 
+async def get_cached_user_by_email(email: str) -> Optional[models.UserInDB]:
+    """get_user_by_email, answered from the user cache when possible."""
+    email = email.lower()
+    user = user_cache.get(email)
+    if user is None:
+        generation = user_cache.generation
+        user = await get_user_by_email(email)
+        if user is not None:
+            user_cache.put(email, user, generation)
+    return user
+
+
 async def create_user(user: models.UserInDB) -> models.UserInDB:
     user.email = user.email.lower()
     result = await db.users.insert_one(
@@ -40,8 +53,11 @@ async def update_user_by_email(
     current = await db.users.find_one({"email": email.lower()})
     _id = current["_id"]
     await db.users.replace_one({"_id": _id}, updated.dict(exclude={"password", "_id"}))
+    await invalidate(email, updated.email)
     return await db.users.find_one({"_id": _id})
 
 
 async def delete_user_by_email(email: str):
-    return await db.users.delete_one({"email": email.lower()})
+    result = await db.users.delete_one({"email": email.lower()})
+    await invalidate(email)
+    return result
@@ -18,6 +18,7 @@ from app.auth import models, security, crud
 from app.auth.forms import RequestLoginForm, SubmitCodeForm, EnterEmailForm
 from app.auth.security import oauth2_scheme
 from app.dependencies import templates
+from app.rate_limit import Limit, rate_limit
 from app.util import send_email
 
 auth_router = APIRouter()
@@ -35,6 +36,15 @@ logger = logging.getLogger()
 from_name = os.getenv("MAILGUN_FROM_NAME")
 from_address = os.getenv("MAILGUN_FROM_ADDRESS")
 
+# Routes that email a login secret share buckets, as do routes that check
+# one, so switching between the form and API routes gains nothing.
+limit_sending = rate_limit(
+    "send-login", per_ip=Limit(10, 60), per_email=Limit(3, 5 * 60)
+)
+limit_checking = rate_limit(
+    "check-login", per_ip=Limit(20, 60), per_email=Limit(5, 5 * 60)
+)
+
 
 @auth_router.get("/login")
 async def login(
@@ -54,7 +64,7 @@ async def login(
     )
 
 
-@auth_router.post("/login")
+@auth_router.post("/login", dependencies=[Depends(limit_sending)])
 async def login_post(
     request: Request,
     next_location: str = Query(None, alias="next"),
@@ -109,7 +119,7 @@ async def login_post(
     )
 
 
-@auth_router.post("/code")
+@auth_router.post("/code", dependencies=[Depends(limit_checking)])
 async def submit_code(request: Request, next_location: str = Query(None, alias="next")):
     code_form = SubmitCodeForm(
         await request.form(), meta={"csrf_context": request.session}
@@ -158,7 +168,7 @@ async def confirm_magic(
     return add_login_cookie(response, user)
 
 
-@auth_router.post("/magic")
+@auth_router.post("/magic", dependencies=[Depends(limit_checking)])
 async def confirm_magic_form(request: Request):
     form = EnterEmailForm(await request.form(), meta={"csrf_context": request.session})
     if not form.validate():
@@ -174,7 +184,7 @@ async def confirm_magic_form(request: Request):
 
 
 async def send_otp(email):
-    otp = security.generate_otp(email)
+    otp = await security.generate_otp(email)
     await send_email(
         email,
         "Your One Time Password",
@@ -185,7 +195,7 @@ async def send_otp(email):
 
 
 async def send_magic(email, next_location, location):
-    magic_link = security.generate_magic_link(email, next_location, location)
+    magic_link = await security.generate_magic_link(email, next_location, location)
     await send_email(
         email,
         "Your magic sign in link",
@@ -195,7 +205,7 @@ async def send_magic(email, next_location, location):
     )
 
 
-@auth_router.post("/request")
+@auth_router.post("/request", dependencies=[Depends(limit_sending)])
 async def request_login(data: models.AuthRequest = Body(...)):
     user = await crud.get_user_by_email(data.email)
     if not user:
@@ -210,7 +220,7 @@ async def request_login(data: models.AuthRequest = Body(...)):
     return "Please check your email for a single use password."
 
 
-@auth_router.post("/request-magic")
+@auth_router.post("/request-magic", dependencies=[Depends(limit_sending)])
 async def request_magic(data: models.AuthRequest = Body(...)):
     user = await crud.get_user_by_email(data.email)
     if not user:
@@ -225,7 +235,7 @@ async def request_magic(data: models.AuthRequest = Body(...)):
     return "Please check your email for your sign in link."
 
 
-@auth_router.post("/confirm-magic")
+@auth_router.post("/confirm-magic", dependencies=[Depends(limit_checking)])
 async def verify_magic(data: models.Magic = Body(...)):
     user = await security.authenticate_user_magic(data.email, data.secret)
     if not user:
@@ -245,7 +255,7 @@ def add_login_cookie(response, user):
     return response
 
 
-@auth_router.post("/confirm")
+@auth_router.post("/confirm", dependencies=[Depends(limit_checking)])
 async def confirm_login(data: models.OTP = Body(...)):
     user = await security.authenticate_user(data.email, data.code)
     logger.debug(user)
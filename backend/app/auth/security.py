@@ -1,13 +1,16 @@
+import asyncio
 import datetime
+import hashlib
+import hmac
 import logging
 import os
 import secrets
 import string
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 from urllib.parse import quote_plus
 
 import jwt
-import redis
 from fastapi import HTTPException, Security, Depends
 from fastapi.openapi.models import OAuthFlows
 from fastapi.security import OAuth2
@@ -16,6 +19,7 @@ from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED
 
 from app.auth import models, crud
+from app.redis_store import redis_store
 
 logger = logging.getLogger()
 
@@ -62,38 +66,87 @@ def get_secret_key():
 
 SECRET_KEY = get_secret_key()
 ALGORITHM = "HS256"
-one_time_password_store = redis.Redis(
-    host=os.getenv("REDIS_HOST"),
-    port=os.getenv("REDIS_PORT"),
-    db=0,
-    password=os.getenv("REDIS_PASSWORD"),
-)
-url_secret_store = redis.Redis(
-    host=os.getenv("REDIS_HOST"),
-    port=os.getenv("REDIS_PORT"),
-    db=1,
-    password=os.getenv("REDIS_PASSWORD"),
-)
+LOGIN_SECRET_EXPIRY = datetime.timedelta(minutes=5)
+
+# How OTPs and magic link secrets are hashed before they are stored:
+# "hmac" (HMAC-SHA256 keyed with SECRET_KEY) or "bcrypt".
+LOGIN_SECRET_HASHER = os.getenv("LOGIN_SECRET_HASHER", "hmac")
+BCRYPT_WORKERS = max(int(os.getenv("BCRYPT_WORKERS", 2)), 1)
+HMAC_PREFIX = "hmac-sha256$"
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = Passwordless(tokenUrl="/auth/confirm", authorizationUrl="/auth/request")
+_bcrypt_executor = ThreadPoolExecutor(
+    max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt"
+)
+
+
+def _hmac_digest(secret: str) -> str:
+    digest = hmac.new(SECRET_KEY.encode(), secret.encode(), hashlib.sha256)
+    return HMAC_PREFIX + digest.hexdigest()
+
 
+async def _hmac_hash(secret: str) -> str:
+    return _hmac_digest(secret)
+
+
+async def _hmac_verify(secret: str, secret_hash: str) -> bool:
+    return hmac.compare_digest(_hmac_digest(secret), secret_hash)
+
+
+async def _bcrypt_hash(secret: str) -> str:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_bcrypt_executor, pwd_context.hash, secret)
+
+
+async def _bcrypt_verify(secret: str, secret_hash: str) -> bool:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _bcrypt_executor, pwd_context.verify, secret, secret_hash
+    )
 
-def generate_otp(email: str) -> str:
+
+SECRET_HASHERS = {
+    "hmac": (_hmac_hash, _hmac_verify),
+    "bcrypt": (_bcrypt_hash, _bcrypt_verify),
+}
+
+
+async def hash_secret(secret: str, hasher: str = None) -> str:
+    """Hash a short-lived login secret for storage.
+
+    These secrets are random, single use and expire in minutes, so a keyed
+    digest protects them as well as a slow password hash would.
+    """
+    hash_function, _ = SECRET_HASHERS[hasher or LOGIN_SECRET_HASHER]
+    return await hash_function(secret)
+
+
+async def verify_secret(secret: str, secret_hash: Union[str, bytes]) -> bool:
+    """Check a secret against a stored hash made by either hasher, so
+    secrets issued before a switch still work."""
+    if isinstance(secret_hash, bytes):
+        secret_hash = secret_hash.decode()
+    hasher = "hmac" if secret_hash.startswith(HMAC_PREFIX) else "bcrypt"
+    _, verify_function = SECRET_HASHERS[hasher]
+    return await verify_function(secret, secret_hash)
+
+
+async def generate_otp(email: str) -> str:
     code = "".join(secrets.choice(string.digits) for _ in range(8))
-    code_hash = pwd_context.hash(code)
-    one_time_password_store.set(f"otp:{email}", code_hash)
-    one_time_password_store.expire(f"otp:{email}", datetime.timedelta(minutes=5))
+    code_hash = await hash_secret(code)
+    await redis_store.set(f"otp:{email}", code_hash, expire=LOGIN_SECRET_EXPIRY)
     return code
 
 
-def generate_magic_link(
+async def generate_magic_link(
     email: str, next_location: str = None, location: str = ""
 ) -> str:
     url_secret = secrets.token_urlsafe()
-    secret_hash = pwd_context.hash(url_secret)
-    url_secret_store.set(f"url_secret:{email}", secret_hash)
-    url_secret_store.expire(f"url_secret:{email}", datetime.timedelta(minutes=5))
+    secret_hash = await hash_secret(url_secret)
+    await redis_store.set(
+        f"url_secret:{email}", secret_hash, expire=LOGIN_SECRET_EXPIRY
+    )
     host = os.getenv("HOSTNAME", "localhost")
     magic_link = f"{host}{location}?secret={url_secret}"
     if next_location:
@@ -101,31 +154,32 @@ def generate_magic_link(
     return magic_link
 
 
-def verify_magic_link(email: str, secret: str):
-    secret_hash = url_secret_store.get(f"url_secret:{email}")
-    if not secret_hash:
+async def _consume_secret(key: str, secret: str) -> bool:
+    """Check a secret against the hash stored at ``key``, deleting it only if
+    it matches. Wrong guesses leave it in place, so they can't lock the user
+    out; the login rate limits bound how many guesses can be made."""
+    secret_hash = await redis_store.get(key)
+    if not secret_hash or not await verify_secret(secret, secret_hash):
         return False
-    success = pwd_context.verify(secret, secret_hash)
-    if success:
-        url_secret_store.expire(f"url_secret:{email}", datetime.timedelta(seconds=1))
-    return success
+    # Of concurrent requests with the right secret, only one logs in.
+    return await redis_store.delete_if_equal(key, secret_hash)
 
 
-def verify_otp(email: str, code: str) -> bool:
-    code_hash = one_time_password_store.get(f"otp:{email}")
-    if not code_hash:
-        return False
-    success = pwd_context.verify(code, code_hash)
-    if success:
-        one_time_password_store.expire(f"otp:{email}", datetime.timedelta(seconds=1))
-    return success
+async def verify_magic_link(email: str, secret: str) -> bool:
+    """Check a magic link secret. Each link can be used once."""
+    return await _consume_secret(f"url_secret:{email}", secret)
+
+
+async def verify_otp(email: str, code: str) -> bool:
+    """Check a one time password. Each code can be used once."""
+    return await _consume_secret(f"otp:{email}", code)
 
 
 async def authenticate_user(email: str, code: str) -> Union[models.UserInDB, bool]:
     user = await crud.get_user_by_email(email)
     if not user:
         return False
-    if not verify_otp(email, code):
+    if not await verify_otp(email, code):
         return False
     return user
 
@@ -134,7 +188,7 @@ async def authenticate_user_magic(email: str, secret: str):
     user = await crud.get_user_by_email(email)
     if not user:
         return False
-    if not verify_magic_link(email, secret):
+    if not await verify_magic_link(email, secret):
         return False
     return user
 
@@ -163,7 +217,7 @@ async def get_current_user(token: str = Security(oauth2_scheme)) -> models.UserI
     except jwt.PyJWTError as err:
         logger.debug(err)
         raise credentials_exception
-    user = await crud.get_user_by_email(email)
+    user = await crud.get_cached_user_by_email(email)
     if not user:
         raise credentials_exception
     return user
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Iterable, List, Tuple
+
+from app import metrics, taxonomy
+from app.dependencies import db
+
+AUTOCOMPLETE_FIELDS = taxonomy.TAXONOMY_FIELDS
+# Users whose values are held in memory at once.
+AUTOCOMPLETE_USERS = max(int(os.getenv("AUTOCOMPLETE_USERS", 1000)), 1)
+# Seconds before a user's values are reloaded, which bounds how long other
+# workers show values from before a write.
+AUTOCOMPLETE_TTL = float(os.getenv("AUTOCOMPLETE_TTL", 60))
+# Prefixes matching more keys than this walk the values most used first
+# instead of ranking every match, so one-letter prefixes stay cheap.
+MAX_SCAN = 200
+
+
+def _keys(name: str) -> Iterable[str]:
+    """The name and every later word in it, so "seb" finds "Johann Sebastian
+    Bach"."""
+    words = name.casefold().split()
+    return {" ".join(words[start:]) for start in range(len(words))}
+
+
+class PrefixIndex:
+    """Sorted keys of one field's values, searched by bisection."""
+
+    def __init__(self, counts: Iterable[Tuple[str, int]]):
+        ranked = sorted(counts, key=lambda item: (-item[1], item[0]))
+        entries = sorted(
+            (key, name, count) for name, count in ranked for key in _keys(name)
+        )
+        self.keys = [key for key, _, _ in entries]
+        self.values = [(name, count) for _, name, count in entries]
+        self.ranked = [(name, count, _keys(name)) for name, count in ranked]
+
+    def search(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        """Values with a word starting with ``prefix``, most used first."""
+        prefix = " ".join(prefix.casefold().split())
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + "\U0010ffff", start)
+        if end - start > MAX_SCAN:
+            return self._search_ranked(prefix, limit)
+        matches = dict(self.values[start:end])
+        return sorted(matches.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def _search_ranked(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        found = []
+        for name, count, keys in self.ranked:
+            if len(found) == limit:
+                break
+            if any(key.startswith(prefix) for key in keys):
+                found.append((name, count))
+        return found
+
+
+class UserPrefixes:
+    def __init__(self, docs: Iterable[dict]):
+        counts: Dict[str, List[Tuple[str, int]]] = {
+            field: [] for field in AUTOCOMPLETE_FIELDS
+        }
+        for doc in docs:
+            counts[doc["field"]].append((doc["name"], doc["count"]))
+        self.fields = {field: PrefixIndex(values) for field, values in counts.items()}
+        self.loaded_at = time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > AUTOCOMPLETE_TTL
+
+
+class PrefixCache:
+    """Per-user prefix indexes, loaded on first use and evicted LRU.
+
+    Writes in this worker drop the user's entry straight away; entries are
+    also reloaded after AUTOCOMPLETE_TTL to pick up writes made elsewhere.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._entries: "OrderedDict[str, UserPrefixes]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, owner_email: str) -> UserPrefixes:
+        entry = self._entries.get(owner_email)
+        if entry is not None and not entry.expired:
+            self._entries.move_to_end(owner_email)
+            metrics.increment("autocomplete.hits")
+            return entry
+        metrics.increment("autocomplete.misses")
+        load = self._loading.get(owner_email)
+        if load is None:
+            generation = self._generations.get(owner_email, 0)
+            load = asyncio.ensure_future(self._load(owner_email, generation))
+            self._loading[owner_email] = load
+            load.add_done_callback(partial(self._loaded, owner_email))
+        return await asyncio.shield(load)
+
+    def _loaded(self, owner_email: str, load: asyncio.Future):
+        # An invalidate may have replaced this load with a newer one.
+        if self._loading.get(owner_email) is load:
+            del self._loading[owner_email]
+
+    async def _load(self, owner_email: str, generation: int) -> UserPrefixes:
+        docs = await db.taxonomy.find(
+            {"owner_email": owner_email}, {"_id": 0, "field": 1, "name": 1, "count": 1}
+        ).to_list(None)
+        entry = UserPrefixes(docs)
+        # A write during the load may not be in what was read.
+        if self._generations.get(owner_email, 0) == generation:
+            self._entries[owner_email] = entry
+            self._entries.move_to_end(owner_email)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+                metrics.increment("autocomplete.evictions")
+        return entry
+
+    def invalidate(self, owner_email: str):
+        self._generations[owner_email] = self._generations.get(owner_email, 0) + 1
+        self._entries.pop(owner_email, None)
+        self._loading.pop(owner_email, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+        self._generations.clear()
+
+
+prefix_cache = PrefixCache(AUTOCOMPLETE_USERS)
+
+
+async def suggest(
+    owner_email: str, field: str, prefix: str, limit: int = 10
+) -> List[Tuple[str, int]]:
+    prefixes = await prefix_cache.get(owner_email)
+    return prefixes.fields[field].search(prefix, limit)
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from app.auth.models import UserInDB
+from app.auth.security import get_current_active_user
+from app.autocomplete import prefixes
+
+autocomplete_router = APIRouter()
+
+
+@autocomplete_router.get("/{field}")
+async def autocomplete(
+    field: str,
+    q: str = Query(""),
+    limit: int = Query(10, ge=1, le=50),
+    current_user: UserInDB = Depends(get_current_active_user),
+):
+    """Values of ``field`` already in use that have a word starting with ``q``."""
+    if field not in prefixes.AUTOCOMPLETE_FIELDS:
+        raise HTTPException(status_code=404, detail=f"Can't autocomplete {field}.")
+    suggestions = await prefixes.suggest(current_user.email, field, q, limit)
+    return [{"name": name, "count": count} for name, count in suggestions]
@@ -1,5 +1,9 @@
+from typing import List, Tuple
+
+from app import taxonomy
 from app.dependencies import db
-from app.sheets.models import SheetOut
+from app.pagination import FACET_FIELDS, Page, paged_query
+from app.sheets.models import SheetSummary, SUMMARY_PROJECTION
 
 
 def get_composer_query(owner_email, composer_name):
@@ -10,35 +14,30 @@ def get_composer_query(owner_email, composer_name):
     }
 
 
-async def get_all_composers(email: str):
-    return await db.sheets.distinct(
-        "composers", {"owner_email": email, "current": True}
-    )
+async def get_all_composers(email: str, sort: str = "name") -> List[Tuple[str, int]]:
+    return await taxonomy.get_terms(email, "composers", sort)
 
 
 async def get_composer_sheets(
     owner_email: str,
     composer_name: str,
     limit: int = 20,
-    page: int = 1,
     sort: str = "piece",
     direction: int = 1,
-):
-    skip = limit * (page - 1)
-    cursor = db.sheets.find(
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    return await paged_query(
+        db.sheets,
         get_composer_query(owner_email, composer_name),
-        limit=limit,
-        skip=skip,
-        sort=[(sort, direction)],
-    )
-    return [SheetOut.parse_obj(sheet) async for sheet in cursor]
-
-
-async def composer_sheets_has_next(
-    owner_email: str, composer_name: str, limit: int = 20, page: int = 1
-):
-    skip = limit * page
-    count = await db.sheets.count_documents(
-        get_composer_query(owner_email, composer_name), limit=1, skip=skip
+        sort,
+        direction,
+        limit,
+        after,
+        before,
+        parse=SheetSummary.parse_obj,
+        projection=SUMMARY_PROJECTION,
+        with_total=with_facets,
+        facets=FACET_FIELDS if with_facets else (),
     )
-    return count > 0
@@ -1,25 +1,56 @@
 import datetime
 import os
+from typing import Awaitable, Callable, Optional
 from pathlib import Path
 from urllib.parse import quote_plus
 
+import certifi
+import urllib3
 import wtforms
 from minio import Minio
 from motor import motor_asyncio
 from starlette.templating import Jinja2Templates
 from wtforms.csrf.session import SessionCSRF
 
-minio_client = Minio(
-    os.getenv("MINIO_HOST"),
-    access_key=os.getenv("MINIO_ACCESS_KEY"),
-    secret_key=os.getenv("MINIO_SECRET_KEY"),
-    secure=(not os.getenv("DEBUG")),
+MINIO_POOL_SIZE = int(os.getenv("MINIO_POOL_SIZE", 10))
+
+
+def new_minio_client(host: str = None, region: str = None) -> Minio:
+    http_client = urllib3.PoolManager(
+        timeout=urllib3.Timeout.DEFAULT_TIMEOUT,
+        maxsize=MINIO_POOL_SIZE,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.getenv("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
+    return Minio(
+        host or os.getenv("MINIO_HOST"),
+        access_key=os.getenv("MINIO_ACCESS_KEY"),
+        secret_key=os.getenv("MINIO_SECRET_KEY"),
+        secure=(not os.getenv("DEBUG")),
+        region=region,
+        http_client=http_client,
+    )
+
+
+minio_client = new_minio_client()
+
+# Presigned URLs are signed for the host browsers use to reach MinIO, which
+# may differ from the one the app talks to. Fixing the region keeps signing
+# from making a network round trip to look it up.
+presign_client = new_minio_client(
+    host=os.getenv("MINIO_PUBLIC_HOST"), region=os.getenv("MINIO_REGION", "us-east-1")
 )
 
 
 DB_NAME = os.getenv("DB_NAME", "app")
 db_uri = os.getenv("MONGODB_URI", False)
 db = None
+# Transactions need a replica set; a single node one is enough.
+DB_REPLICA_SET = os.getenv("DB_REPLICA_SET")
+DB_TRANSACTIONS = bool(DB_REPLICA_SET or os.getenv("DB_TRANSACTIONS"))
 
 HERE = Path(__file__).parent
 
@@ -39,10 +70,24 @@ else:
         host=quote_plus(os.getenv("DB_HOST", "localhost")),
         port=quote_plus(os.getenv("DB_PORT", "27017")),
     )
-    db_client = motor_asyncio.AsyncIOMotorClient(db_uri)
+    db_client = motor_asyncio.AsyncIOMotorClient(db_uri, replicaset=DB_REPLICA_SET)
     db: motor_asyncio.AsyncIOMotorDatabase = db_client[DB_NAME]
 
 
+async def in_transaction(
+    operation: Callable[[Optional[motor_asyncio.AsyncIOMotorClientSession]], Awaitable],
+):
+    """Run ``operation(session)`` so its writes commit or fail together.
+
+    Transient transaction errors are retried. Without DB_TRANSACTIONS the
+    operation runs with no session, for standalone servers.
+    """
+    if not DB_TRANSACTIONS:
+        return await operation(None)
+    async with await db_client.start_session() as session:
+        return await session.with_transaction(operation)
+
+
 class CSRFForm(wtforms.Form):
     class Meta:
         csrf = True
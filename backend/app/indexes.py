@@ -0,0 +1,111 @@
+from typing import Dict, List
+
+import pymongo
+from fastapi import HTTPException
+from pymongo import IndexModel
+
+from app.sheets import models
+
+SORT_DIRECTIONS = (pymongo.ASCENDING, pymongo.DESCENDING)
+
+
+def sort_index_keys(field: str) -> list:
+    """Keys of the index behind list pages sorted on ``field``."""
+    return [
+        ("owner_email", pymongo.ASCENDING),
+        ("current", pymongo.ASCENDING),
+        (f"sort_keys.{field}", pymongo.ASCENDING),
+        ("sheet_id", pymongo.ASCENDING),
+    ]
+
+
+# Every index the app relies on, by collection. manage.py syncindexes makes
+# the database match this.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [IndexModel([("email", pymongo.ASCENDING)], unique=True)],
+    "sheets": [
+        IndexModel([("sheet_id", pymongo.ASCENDING)], unique=True),
+        IndexModel(
+            [
+                ("piece", pymongo.TEXT),
+                ("instruments", pymongo.TEXT),
+                ("composers", pymongo.TEXT),
+                ("tags", pymongo.TEXT),
+                ("catalog_number", pymongo.TEXT),
+                ("genre", pymongo.TEXT),
+            ],
+            default_language="english",
+        ),
+        *[
+            IndexModel(sort_index_keys(field))
+            for field in models.Sheet.sortable_fields()
+        ],
+        # Only pending previews are ever looked up by status.
+        IndexModel(
+            [
+                ("preview_status", pymongo.ASCENDING),
+                ("preview_queued_at", pymongo.ASCENDING),
+            ],
+            partialFilterExpression={
+                "preview_status": models.PreviewStatus.pending.value
+            },
+        ),
+    ],
+    "sheet_versions": [
+        IndexModel([("sheet_id", pymongo.ASCENDING)], unique=True),
+        IndexModel(
+            [
+                ("owner_email", pymongo.ASCENDING),
+                ("lineage_id", pymongo.ASCENDING),
+                ("replaced_at", pymongo.DESCENDING),
+            ]
+        ),
+    ],
+    "taxonomy": [
+        IndexModel(
+            [
+                ("owner_email", pymongo.ASCENDING),
+                ("field", pymongo.ASCENDING),
+                ("name", pymongo.ASCENDING),
+            ],
+            unique=True,
+        ),
+        IndexModel(
+            [
+                ("owner_email", pymongo.ASCENDING),
+                ("field", pymongo.ASCENDING),
+                ("count", pymongo.DESCENDING),
+                ("name", pymongo.ASCENDING),
+            ]
+        ),
+    ],
+}
+
+
+def _index_keys(collection: str) -> List[list]:
+    return [list(index.document["key"].items()) for index in INDEXES[collection]]
+
+
+def sort_is_indexed(collection: str, sort: str, direction: int) -> bool:
+    """Whether an index can return list pages in this order without sorting.
+
+    Indexes are walked backwards for descending pages, so only the field
+    needs an index.
+    """
+    if direction not in SORT_DIRECTIONS:
+        return False
+    prefix = sort_index_keys(sort)[:3]
+    return any(keys[:3] == prefix for keys in _index_keys(collection))
+
+
+def check_sort(collection: str, sort: str, direction: int):
+    if not sort_is_indexed(collection, sort, direction):
+        raise HTTPException(
+            status_code=400, detail=f"Can't sort by {sort} in direction {direction}."
+        )
+
+
+async def ensure_indexes(db):
+    """Create any missing indexes; never drops anything."""
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
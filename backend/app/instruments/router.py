@@ -20,27 +20,32 @@ async def get_single_instrument(
     request: Request,
     instrument_name: str,
     current_user: UserInDB = Depends(get_current_active_user),
-    page: int = Query(1),
     sort: str = Query("piece"),
     direction: int = Query(1),
+    after: str = Query(None),
+    before: str = Query(None),
 ):
     limit = int(os.getenv("SHEETS_PER_PAGE", 20))
-    prev_page, next_page = util.get_next_prev_page_urls(request.url, page)
-    sheets = await crud.get_instrument_sheets(
-        current_user.email, instrument_name, limit, page, sort, direction
+    page = await crud.get_instrument_sheets(
+        current_user.email,
+        instrument_name,
+        limit,
+        sort,
+        direction,
+        after,
+        before,
+        with_facets=True,
     )
-    if not await crud.instrument_sheets_has_next(
-        current_user.email, instrument_name, limit, page
-    ):
-        next_page = None
+    prev_page, next_page = util.get_page_urls(request.url, page)
     return templates.TemplateResponse(
         "list.html",
         {
             "request": request,
-            "page": page,
             "sort": sort,
             "direction": direction,
-            "sheets": sheets,
+            "sheets": page.items,
+            "total": page.total,
+            "facets": page.facets,
             "next_page": next_page,
             "prev_page": prev_page,
             "sort_links": util.get_sort_links(request.url, sort, direction),
@@ -51,14 +56,17 @@ async def get_single_instrument(
 
 @instrument_router.get("")
 async def get_instruments(
-    request: Request, current_user: UserInDB = Depends(get_current_active_user)
+    request: Request,
+    current_user: UserInDB = Depends(get_current_active_user),
+    sort: str = Query("name"),
 ):
-    instruments = await crud.get_all_instruments(current_user.email)
+    instruments = await crud.get_all_instruments(current_user.email, sort)
     return templates.TemplateResponse(
         "instruments/all.html",
         {
             "request": request,
-            "instruments": sorted(instruments),
+            "instruments": instruments,
+            "sort": sort,
             "title": "All instruments",
         },
     )
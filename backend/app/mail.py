@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import List, Optional
+
+import aiohttp
+from fastapi import HTTPException
+
+from app import metrics
+from app.dependencies import mailgun_enpoint, mailgun_key
+
+logger = logging.getLogger()
+
+MAIL_WORKERS = max(int(os.getenv("MAIL_WORKERS", 4)), 1)
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 1000))
+MAIL_MAX_ATTEMPTS = max(int(os.getenv("MAIL_MAX_ATTEMPTS", 5)), 1)
+# Seconds before the first retry; each later one waits twice as long.
+MAIL_RETRY_DELAY = float(os.getenv("MAIL_RETRY_DELAY", 1))
+MAIL_MAX_RETRY_DELAY = 60.0
+MAIL_TIMEOUT = float(os.getenv("MAIL_TIMEOUT", 10))
+
+
+class PermanentFailure(Exception):
+    """Mailgun turned the message down; sending it again won't help."""
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, so retries from many workers don't
+    arrive together."""
+    delay = min(MAIL_RETRY_DELAY * 2 ** (attempt - 1), MAIL_MAX_RETRY_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class MailQueue:
+    """Outgoing email, sent by background workers over one HTTP session.
+
+    Handlers only wait for the message to be queued. Failed sends are
+    retried with backoff; messages still queued at shutdown get a short
+    chance to go out, and are lost if the process dies.
+    """
+
+    def __init__(self, endpoint: str, api_key: str, workers: int, max_size: int):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.workers = workers
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(self.max_size)
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth("api", self.api_key or ""),
+            timeout=aiohttp.ClientTimeout(total=MAIL_TIMEOUT),
+        )
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5):
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.depth} queued emails")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._session.close()
+        self._tasks = []
+        self._queue = self._session = None
+
+    def put(self, message: dict):
+        """Queue a Mailgun message, starting the workers if need be."""
+        self.start()
+        try:
+            self._queue.put_nowait((message, time.monotonic()))
+        except asyncio.QueueFull:
+            metrics.increment("mail.rejected")
+            raise HTTPException(status_code=503, detail="Could not send email.")
+        metrics.increment("mail.queued")
+
+    async def _work(self):
+        while True:
+            message, queued_at = await self._queue.get()
+            try:
+                await self._deliver(message)
+                metrics.increment("mail.sent")
+                metrics.record_timing("mail.delivery", time.monotonic() - queued_at)
+            except Exception as err:
+                metrics.increment("mail.failed")
+                logger.error(f"Could not send email to {message['to']}: {err}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, message: dict):
+        for attempt in range(1, MAIL_MAX_ATTEMPTS + 1):
+            try:
+                return await self._post(message)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt == MAIL_MAX_ATTEMPTS:
+                    raise
+                logger.debug(f"Email attempt {attempt} failed: {err}")
+            metrics.increment("mail.retries")
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def _post(self, message: dict):
+        with metrics.timed("mail.send"):
+            async with self._session.post(self.endpoint, data=message) as response:
+                if response.status == 200:
+                    return
+                if response.status == 429 or response.status >= 500:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info,
+                        response.history,
+                        status=response.status,
+                    )
+                raise PermanentFailure(f"Mailgun answered {response.status}")
+
+
+outbox = MailQueue(mailgun_enpoint, mailgun_key, MAIL_WORKERS, MAIL_QUEUE_SIZE)
+metrics.register_gauge("mail.queue_depth", lambda: outbox.depth)
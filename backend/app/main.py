@@ -2,20 +2,22 @@ import logging
 import os
 import urllib.parse
 
-import minio
-import pymongo
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.requests import Request
 from starlette.responses import RedirectResponse
 from starlette.staticfiles import StaticFiles
 from starlette.status import HTTP_401_UNAUTHORIZED
 
+from app import indexes, mail, metrics
+from app.auth import cache as auth_cache
 from app.auth.models import UserInDB
 from app.auth.router import auth_router
-from app.auth.security import get_current_active_user
-from app.dependencies import db, HERE, templates, minio_client
+from app.auth.security import get_current_active_user, get_current_admin_user
+from app.autocomplete.router import autocomplete_router
+from app.dependencies import db, HERE, templates
 from app.composers.router import composer_router
+from app.sheets import previews, search, storage
 from app.sheets.router import sheet_router
 from app.tags.router import tag_router
 from app.instruments.router import instrument_router
@@ -34,32 +36,40 @@ else:
 
 @app.on_event("startup")
 async def setup_db():
-    await db.users.create_index("email", unique=True)
-    await db.sheets.create_index("owner_email")
-    await db.sheets.create_index("sheet_id", unique=True)
-    await db.sheets.create_index(
-        [
-            ("piece", pymongo.TEXT),
-            ("instruments", pymongo.TEXT),
-            ("composers", pymongo.TEXT),
-            ("tags", pymongo.TEXT),
-            ("catalog_number", pymongo.TEXT),
-            ("genre", pymongo.TEXT),
-        ],
-        default_language="english",
-    )
-    await db.sheets.create_index("instruments")
-    await db.sheets.create_index("composers")
-    await db.sheets.create_index("tags")
+    await indexes.ensure_indexes(db)
 
 
 @app.on_event("startup")
-def ensure_bucket():
-    try:
-        if not minio_client.bucket_exists(os.getenv("MINIO_BUCKET_NAME")):
-            minio_client.make_bucket(os.getenv("MINIO_BUCKET_NAME"))
-    except minio.ResponseError:
-        minio_client.make_bucket(os.getenv("MINIO_BUCKET_NAME"))
+async def ensure_bucket():
+    await storage.ensure_bucket()
+
+
+@app.on_event("startup")
+def listen_for_user_changes():
+    auth_cache.start_listener()
+
+
+@app.on_event("startup")
+def start_mail_workers():
+    mail.outbox.start()
+
+
+@app.on_event("startup")
+def requeue_lost_previews():
+    previews.start_sweeper()
+
+
+@app.on_event("shutdown")
+async def flush_mail():
+    await mail.outbox.stop()
+
+
+@app.on_event("shutdown")
+def release_local_resources():
+    auth_cache.stop_listener()
+    previews.shutdown()
+    storage.sheet_cache.clear()
+    search.index_cache.persist()
 
 
 @app.get("/")
@@ -69,6 +79,11 @@ async def index(
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+@app.get("/metrics")
+async def get_metrics(_current_user: UserInDB = Depends(get_current_admin_user)):
+    return metrics.snapshot()
+
+
 app.include_router(
     auth_router,
     prefix="/auth",
@@ -80,6 +95,7 @@ app.include_router(sheet_router, prefix="/sheets")
 app.include_router(composer_router, prefix="/composers")
 app.include_router(tag_router, prefix="/tags")
 app.include_router(instrument_router, prefix="/instruments")
+app.include_router(autocomplete_router, prefix="/autocomplete")
 
 
 @app.middleware("http")
@@ -0,0 +1,59 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "max_seconds": self.max,
+        }
+
+
+timings = defaultdict(Timing)
+counters = defaultdict(int)
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def record_timing(name: str, seconds: float):
+    timings[name].record(seconds)
+
+
+def increment(name: str, amount: int = 1):
+    counters[name] += amount
+
+
+def register_gauge(name: str, read: Callable[[], float]):
+    """Report ``read()`` under ``name`` in every snapshot."""
+    gauges[name] = read
+
+
+@contextmanager
+def timed(name: str):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_timing(name, time.monotonic() - start)
+
+
+def snapshot() -> dict:
+    return {
+        "timings": {name: timing.dict() for name, timing in timings.items()},
+        "counters": dict(counters),
+        "gauges": {name: read() for name, read in gauges.items()},
+    }
@@ -0,0 +1,174 @@
+import asyncio
+import base64
+import binascii
+import json
+import uuid
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from motor import motor_asyncio
+
+from app.indexes import check_sort
+
+FACET_FIELDS = ("genre", "type", "instruments")
+FACET_LIMIT = 10
+
+
+class Page(NamedTuple):
+    items: List[Any]
+    next_cursor: Optional[str]
+    prev_cursor: Optional[str]
+    total: Optional[int] = None
+    facets: Optional[Dict[str, List[Tuple[str, int]]]] = None
+
+
+def sort_key_field(sort: str) -> str:
+    return f"sort_keys.{sort}"
+
+
+def encode_cursor(sort_value: str, sheet_id: uuid.UUID) -> str:
+    raw = json.dumps([sort_value, str(sheet_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, uuid.UUID]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, sheet_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(sort_value), uuid.UUID(sheet_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid page cursor.")
+
+
+def keyset_filter(
+    query: dict, sort: str, direction: int, cursor: str, forward: bool
+) -> dict:
+    """Restrict ``query`` to documents after (or before) ``cursor``."""
+    sort_value, sheet_id = decode_cursor(cursor)
+    operator = "$gt" if (direction == 1) == forward else "$lt"
+    field = sort_key_field(sort)
+    return {
+        **query,
+        "$or": [
+            {field: {operator: sort_value}},
+            {field: sort_value, "sheet_id": {operator: sheet_id}},
+        ],
+    }
+
+
+def _cursor_for(doc: dict, sort: str) -> str:
+    return encode_cursor(doc.get("sort_keys", {}).get(sort, ""), doc["sheet_id"])
+
+
+def facet_stages(field: str) -> List[dict]:
+    # $unwind treats a scalar as a one element array, so this counts list and
+    # scalar fields alike.
+    return [
+        {"$unwind": f"${field}"},
+        {"$match": {field: {"$nin": [None, ""]}}},
+        {"$sortByCount": f"${field}"},
+        {"$limit": FACET_LIMIT},
+    ]
+
+
+def build_pipeline(
+    query: dict,
+    sort: str = "piece",
+    direction: int = 1,
+    limit: int = 20,
+    after: str = None,
+    before: str = None,
+    projection: dict = None,
+) -> List[dict]:
+    """Aggregation pipeline for one page of ``query``: an index-backed range
+    query from the cursor."""
+    forward = before is None
+    cursor = after if forward else before
+    if cursor:
+        query = keyset_filter(query, sort, direction, cursor, forward)
+    order = direction if forward else -direction
+    pipeline = [
+        {"$match": query},
+        {"$sort": {sort_key_field(sort): order, "sheet_id": order}},
+        {"$limit": limit + 1},
+    ]
+    if projection:
+        pipeline.append({"$project": projection})
+    return pipeline
+
+
+def summary_pipeline(
+    query: dict, with_total: bool = False, facets: Sequence[str] = ()
+) -> List[dict]:
+    """Aggregation pipeline counting every match of ``query`` and its most
+    common values of each ``facets`` field."""
+    stages = {}
+    if with_total:
+        stages["total"] = [{"$count": "count"}]
+    for field in facets:
+        stages[field] = facet_stages(field)
+    return [{"$match": query}, {"$facet": stages}]
+
+
+async def paged_query(
+    collection: motor_asyncio.AsyncIOMotorCollection,
+    query: dict,
+    sort: str = "piece",
+    direction: int = 1,
+    limit: int = 20,
+    after: str = None,
+    before: str = None,
+    parse: Callable[[dict], Any] = dict,
+    with_total: bool = False,
+    facets: Sequence[str] = (),
+    projection: dict = None,
+) -> Page:
+    """Fetch one page of ``query`` ordered by a sort key and sheet_id.
+
+    Pages are found with a range query from the cursor rather than by
+    skipping, so every page costs the same however deep it is, and sheets
+    added meanwhile don't shift the pages being browsed. One extra row is
+    fetched to tell whether there is another page. Only ``projection``
+    fields of each result are fetched, when given. Orders without a backing
+    index are rejected with a 400.
+
+    The total and per-field counts, if asked for, have to read every match,
+    so they come from a second aggregation run alongside the first page
+    only; later pages leave them as None.
+    """
+    check_sort(collection.name, sort, direction)
+    forward = before is None
+    cursor = after if forward else before
+    pipeline = build_pipeline(query, sort, direction, limit, after, before, projection)
+    fetches = [collection.aggregate(pipeline).to_list(limit + 1)]
+    with_summary = (with_total or bool(facets)) and not cursor
+    if with_summary:
+        summary = summary_pipeline(query, with_total, facets)
+        fetches.append(collection.aggregate(summary).to_list(1))
+    docs, *summary_docs = await asyncio.gather(*fetches)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if not forward:
+        docs.reverse()
+    if forward:
+        has_next, has_prev = has_more, bool(cursor)
+    else:
+        has_next, has_prev = True, has_more
+    total = facet_counts = None
+    if with_summary:
+        result = summary_docs[0][0] if summary_docs[0] else {}
+        if with_total:
+            total = result["total"][0]["count"] if result.get("total") else 0
+        facet_counts = {
+            field: [
+                (bucket["_id"], bucket["count"]) for bucket in result.get(field, [])
+            ]
+            for field in facets
+        }
+    return Page(
+        [parse(doc) for doc in docs],
+        _cursor_for(docs[-1], sort) if docs and has_next else None,
+        _cursor_for(docs[0], sort) if docs and has_prev else None,
+        total,
+        facet_counts,
+    )
@@ -0,0 +1,156 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import redis
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from app import metrics
+from app.redis_store import redis_store
+
+logger = logging.getLogger()
+
+# "redis" shares buckets between workers and nodes; "memory" keeps them in
+# this process, which is enough for a single worker. Redis errors fall back
+# to memory rather than letting every request through.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "redis")
+MEMORY_BUCKETS = 10000
+# Peers trusted to say who the client is in X-Forwarded-For: the proxy in
+# front of the app. Requests over the Unix socket the app is served on have
+# no peer address; only the proxy can reach the socket, so they are trusted.
+TRUSTED_PROXIES = {
+    host.strip()
+    for host in os.getenv("TRUSTED_PROXIES", "127.0.0.1").split(",")
+    if host.strip()
+}
+
+# Refill by elapsed time, then take a token if there is one. Returns
+# whether the request may go ahead and, if not, the seconds until it may.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or capacity
+local at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - at) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class Limit(NamedTuple):
+    """``requests`` may be made at once, refilling over ``seconds``."""
+
+    requests: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.seconds
+
+
+class MemoryBuckets:
+    def __init__(self, max_buckets: int):
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: str, limit: Limit, now: float) -> Tuple[bool, float]:
+        tokens, at = self._buckets.pop(key, (limit.requests, now))
+        tokens = min(limit.requests, tokens + max(0.0, now - at) * limit.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / limit.rate
+
+
+memory_buckets = MemoryBuckets(MEMORY_BUCKETS)
+_token_bucket = redis_store.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+async def take_token(key: str, limit: Limit) -> Tuple[bool, float]:
+    now = time.time()
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            allowed, retry_after = await _token_bucket(
+                [key], [limit.requests, limit.rate, now]
+            )
+            return bool(allowed), float(retry_after)
+        except redis.RedisError as err:
+            logger.warning(f"Rate limiting in memory, Redis failed: {err}")
+    return memory_buckets.take(key, limit, now)
+
+
+def client_ip(request: Request) -> Optional[str]:
+    """The client's address, as seen by the trusted proxy if there is one."""
+    peer = request.client.host if request.client else None
+    if peer is not None and peer not in TRUSTED_PROXIES:
+        return peer
+    # The proxy appends the address it saw; earlier entries come from the
+    # client and can't be believed.
+    forwarded = request.headers.get("x-forwarded-for", "").split(",")
+    hops = [hop.strip() for hop in forwarded if hop.strip()]
+    return hops[-1] if hops else peer
+
+
+async def request_email(request: Request) -> Optional[str]:
+    """The email a login request is about, from its JSON or form body."""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            return None
+    else:
+        body = await request.form()
+    email = body.get("email") if hasattr(body, "get") else None
+    return email.strip().lower() if isinstance(email, str) and email else None
+
+
+def rate_limit(name: str, per_ip: Limit, per_email: Limit = None):
+    """A dependency allowing ``per_ip`` requests from each client address
+    and ``per_email`` for each email, answering others with a 429."""
+
+    async def check_rate_limit(request: Request):
+        buckets = []
+        ip = client_ip(request)
+        if ip is None:
+            # Keying on a missing address would put every client in one bucket.
+            logger.warning(f"Not rate limiting {name} by address, none was given")
+            metrics.increment(f"rate_limit.{name}.no_address")
+        else:
+            buckets.append((f"rate:{name}:ip:{ip}", per_ip))
+        if per_email is not None:
+            email = await request_email(request)
+            if email:
+                buckets.append((f"rate:{name}:email:{email}", per_email))
+        waits = []
+        for key, limit in buckets:
+            allowed, retry_after = await take_token(key, limit)
+            if not allowed:
+                waits.append(retry_after)
+        if waits:
+            metrics.increment(f"rate_limit.{name}")
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests. Please try again later.",
+                headers={"Retry-After": str(math.ceil(max(waits)))},
+            )
+
+    return check_rate_limit
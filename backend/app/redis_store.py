@@ -0,0 +1,105 @@
+import asyncio
+import datetime
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Union
+
+import redis
+
+from app import metrics
+
+REDIS_POOL_SIZE = max(int(os.getenv("REDIS_POOL_SIZE", 10)), 1)
+# Seconds to wait for a connection, for a reply, and for a free pooled
+# connection before giving up.
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 2))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+
+# Deletes a key only if it still holds the given value, so of several callers
+# that read the same value, exactly one gets to consume it.
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+Expiry = Union[int, datetime.timedelta]
+
+
+def new_redis_client() -> redis.Redis:
+    pool = redis.BlockingConnectionPool(
+        host=os.getenv("REDIS_HOST"),
+        port=os.getenv("REDIS_PORT"),
+        db=int(os.getenv("REDIS_DB", 0)),
+        password=os.getenv("REDIS_PASSWORD"),
+        # One more than the command threads, for the pub/sub listener.
+        max_connections=REDIS_POOL_SIZE + 1,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+class AsyncRedis:
+    """Awaitable Redis commands over a shared connection pool.
+
+    Commands run on a thread pool the size of the connection pool, like
+    MinIO calls in app.sheets.storage, so they never block the event loop
+    and never queue for a connection.
+    """
+
+    def __init__(self, client: redis.Redis):
+        self.client = client
+        self._executor = ThreadPoolExecutor(
+            max_workers=REDIS_POOL_SIZE, thread_name_prefix="redis"
+        )
+        self._delete_if_equal = client.register_script(DELETE_IF_EQUAL_SCRIPT)
+
+    async def _run(self, operation: str, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        try:
+            return await loop.run_in_executor(
+                self._executor, lambda: func(*args, **kwargs)
+            )
+        finally:
+            metrics.record_timing(f"redis.{operation}", time.monotonic() - start)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run("get", self.client.get, key)
+
+    async def set(self, key: str, value, expire: Expiry = None) -> bool:
+        """SET with the expiry in the same command, so a key is never left
+        without one."""
+        return await self._run("set", self.client.set, key, value, ex=expire)
+
+    async def delete_if_equal(self, key: str, value) -> bool:
+        """Delete a key if it still holds ``value``, returning whether it did."""
+        deleted = await self._run(
+            "delete_if_equal", self._delete_if_equal, keys=[key], args=[value]
+        )
+        return bool(deleted)
+
+    async def delete(self, *keys: str) -> int:
+        return await self._run("delete", self.client.delete, *keys)
+
+    async def publish(self, channel: str, message) -> int:
+        return await self._run("publish", self.client.publish, channel, message)
+
+    def register_script(self, source: str):
+        """An awaitable ``script(keys, args)`` for a Lua script."""
+        script = self.client.register_script(source)
+
+        async def run(keys: Sequence[str] = (), args: Sequence = ()):
+            return await self._run("script", script, keys=list(keys), args=list(args))
+
+        return run
+
+    def pubsub(self, **kwargs) -> redis.client.PubSub:
+        return self.client.pubsub(**kwargs)
+
+
+redis_store = AsyncRedis(new_redis_client())
@@ -1,125 +1,377 @@
 import datetime
 import uuid
-from typing import List
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from motor import motor_asyncio
+import pymongo
+from fastapi import UploadFile
+from pymongo import ReturnDocument, UpdateOne
 
-from app.dependencies import db
-from app.sheets import models
+from app import taxonomy
+from app.autocomplete.prefixes import prefix_cache
+from app.dependencies import db, in_transaction
+from app.indexes import check_sort
+from app.pagination import FACET_FIELDS, Page, paged_query, sort_key_field
+from app.sheets import models, search, storage
 
 
-async def create_sheet(sheet: models.Sheet) -> models.SheetInDB:
+async def add_blob_reference(blob_id: str, session=None) -> bool:
+    """Count a reference to a blob, returning whether it is the only one."""
+    result = await db.blobs.update_one(
+        {"_id": blob_id}, {"$inc": {"refcount": 1}}, upsert=True, session=session
+    )
+    return result.upserted_id is not None
+
+
+async def release_blob_references(blob_counts: Counter, session=None) -> List[str]:
+    """Drop references to blobs, returning the ones that are no longer used.
+
+    Their records are deleted here; removing the stored objects is left to
+    the caller, once the transaction has committed.
+    """
+    if not blob_counts:
+        return []
+    await db.blobs.bulk_write(
+        [
+            UpdateOne({"_id": blob_id}, {"$inc": {"refcount": -count}})
+            for blob_id, count in blob_counts.items()
+        ],
+        ordered=False,
+        session=session,
+    )
+    unused = {"_id": {"$in": list(blob_counts)}, "refcount": {"$lte": 0}}
+    dead = [blob["_id"] async for blob in db.blobs.find(unused, session=session)]
+    if dead:
+        await db.blobs.delete_many(unused, session=session)
+    return dead
+
+
+async def remove_unused_blobs(blob_ids: Sequence[str]):
+    for blob_id in blob_ids:
+        # A new upload may have taken a reference since it was released.
+        if await db.blobs.find_one({"_id": blob_id}) is None:
+            await storage.remove_blob(blob_id)
+
+
+async def drop_blob_reference(blob_id: str):
+    await remove_unused_blobs(await release_blob_references(Counter([blob_id])))
+
+
+async def save_sheet_file(sheet_file: UploadFile) -> str:
+    """Store an uploaded sheet file, returning its blob id.
+
+    The reference for the sheet that will use it is taken first, so a
+    concurrent delete of another sheet with the same contents can't remove
+    the blob once the upload has been skipped. Pass ``blob_held=True`` to
+    create_sheet or update_sheet, which give the reference back if they fail.
+    """
+    blob_id, size = await storage.hash_upload(sheet_file)
+    only_reference = await add_blob_reference(blob_id)
+    try:
+        # With no other references the stored copy, if any, may be on its
+        # way out, so it is uploaded again.
+        await storage.save_sheet(
+            sheet_file, blob_id, size, deduplicate=not only_reference
+        )
+    except Exception:
+        await drop_blob_reference(blob_id)
+        raise
+    return blob_id
+
+
+async def create_sheet(
+    sheet: models.Sheet, blob_held: bool = False
+) -> models.SheetInDB:
     sheet = models.SheetInDB.parse_obj(sheet)
     sheet.clean_empty_strings()
     sheet.clean_tags()
-    result = await db.sheets.insert_one(sheet.dict())
-    created = await db.sheets.find_one({"_id": result.inserted_id})
-    return models.SheetInDB.parse_obj(created)
+    sheet.set_sort_keys()
+    sheet.lineage_id = sheet.lineage_id or sheet.sheet_id
+    _stamp_preview(sheet)
+    doc = sheet.dict()
+
+    async def create(session):
+        await db.sheets.insert_one(doc, session=session)
+        await taxonomy.apply_term_changes(
+            sheet.owner_email, taxonomy.term_changes(added=[doc]), session
+        )
+        if sheet.blob_id and not blob_held:
+            await add_blob_reference(sheet.blob_id, session)
+
+    try:
+        await in_transaction(create)
+    except Exception:
+        if sheet.blob_id and blob_held:
+            await drop_blob_reference(sheet.blob_id)
+        raise
+    _sheets_changed(sheet.owner_email, added=[doc])
+    return models.SheetInDB.parse_obj(doc)
+
+
+def _stamp_preview(sheet: models.SheetInDB):
+    if sheet.preview_status == models.PreviewStatus.pending.value:
+        sheet.preview_queued_at = datetime.datetime.now()
 
 
 class DuplicateID(Exception):
     pass
 
 
+class VersionConflict(Exception):
+    """The sheet being replaced is no longer the current version."""
+
+
+def _sheets_changed(
+    owner_email: str, removed: Sequence[uuid.UUID] = (), added: Sequence[dict] = ()
+):
+    """Bring this worker's in-memory views of a user's sheets up to date."""
+    prefix_cache.invalidate(owner_email)
+    search.sheets_changed(owner_email, removed, added)
+
+
+def _lineage_id(doc: dict) -> uuid.UUID:
+    return doc.get("lineage_id") or doc["sheet_id"]
+
+
+# Without DB_TRANSACTIONS each write below stands alone, so sheets are copied
+# into their new place before they are removed from the old one. A crash in
+# between leaves a sheet in both places, never in neither, and copies are
+# keyed by sheet_id so the next attempt overwrites them.
+
+
+async def _retire(doc: dict, session):
+    """Copy a sheet about to be replaced into the version history."""
+    version = {key: value for key, value in doc.items() if key != "_id"}
+    version.pop("prev_versions", None)
+    version.update(
+        current=False,
+        lineage_id=_lineage_id(doc),
+        replaced_at=datetime.datetime.now(),
+    )
+    await db.sheet_versions.replace_one(
+        {"sheet_id": doc["sheet_id"]}, version, upsert=True, session=session
+    )
+
+
+async def _adopt_legacy_versions(doc: dict, session):
+    """Move the old versions listed in a sheet's ``prev_versions``, stored in
+    sheets before ``manage.py migrateversions`` has run, into its history."""
+    for version_id, replaced_at in doc.get("prev_versions") or []:
+        version = await db.sheets.find_one(
+            {"sheet_id": version_id, "current": False}, session=session
+        )
+        if version is None:
+            continue
+        version_key = version.pop("_id")
+        version.pop("prev_versions", None)
+        version.update(lineage_id=_lineage_id(doc), replaced_at=replaced_at)
+        await db.sheet_versions.replace_one(
+            {"sheet_id": version_id}, version, upsert=True, session=session
+        )
+        await db.sheets.delete_one({"_id": version_key}, session=session)
+
+
 async def update_sheet(
-    old_sheet: models.SheetWithVersions, new_sheet: models.Sheet
+    old_sheet: models.SheetWithVersions,
+    new_sheet: models.Sheet,
+    blob_held: bool = False,
 ) -> models.SheetInDB:
     if new_sheet.sheet_id == old_sheet.sheet_id:
         raise DuplicateID()
     new_sheet = models.SheetInDB.parse_obj(new_sheet)
-    old_sheet.current = False
-    old_sheet.clean_empty_strings()
-    old_sheet.clean_tags()
-    await db.sheets.find_one_and_replace(
-        {"sheet_id": old_sheet.sheet_id}, old_sheet.dict()
-    )
-    new_sheet.prev_versions = []
-    new_sheet.prev_versions.append((old_sheet.sheet_id, datetime.datetime.now()))
-    if old_sheet.prev_versions:
-        new_sheet.prev_versions.extend(old_sheet.prev_versions)
     new_sheet.clean_empty_strings()
     new_sheet.clean_tags()
-    result = await db.sheets.insert_one(new_sheet.dict())
-    created = await db.sheets.find_one({"_id": result.inserted_id})
-    return models.SheetInDB.parse_obj(created)
+    new_sheet.set_sort_keys()
+    _stamp_preview(new_sheet)
+
+    async def update(session):
+        live = {"sheet_id": old_sheet.sheet_id, "current": True}
+        replaced = await db.sheets.find_one(live, session=session)
+        if replaced is None:
+            raise VersionConflict()
+        new_sheet.lineage_id = _lineage_id(replaced)
+        await _adopt_legacy_versions(replaced, session)
+        await _retire(replaced, session)
+        doc = new_sheet.dict()
+        replaced = await db.sheets.find_one_and_replace(live, doc, session=session)
+        if replaced is None:
+            raise VersionConflict()
+        await taxonomy.apply_term_changes(
+            new_sheet.owner_email, taxonomy.term_changes([replaced], [doc]), session
+        )
+        if new_sheet.blob_id and not blob_held:
+            await add_blob_reference(new_sheet.blob_id, session)
+
+    try:
+        await in_transaction(update)
+    except Exception:
+        if new_sheet.blob_id and blob_held:
+            await drop_blob_reference(new_sheet.blob_id)
+        raise
+    _sheets_changed(new_sheet.owner_email, [old_sheet.sheet_id], [new_sheet.dict()])
+    return new_sheet
 
 
 async def restore_previous_sheet(
     sheet_to_restore: models.SheetInDB, current_version_sheet: models.SheetInDB
 ) -> models.SheetInDB:
-    sheet_to_restore.current = True
-    versions = [(current_version_sheet.sheet_id, datetime.datetime.now())]
-    versions.extend(
-        [
-            item
-            for item in current_version_sheet.prev_versions
-            if item[1] == sheet_to_restore.sheet_id
-        ]
-    )
-    sheet_to_restore.prev_versions = versions
-    await db.sheets.find_one_and_update(
-        {"sheet_id": current_version_sheet.sheet_id}, {"$set": {"current": False}}
-    )
-    result = await db.sheets.find_one_and_replace(
-        {
-            "sheet_id": sheet_to_restore.sheet_id,
-            "owner_email": sheet_to_restore.owner_email,
-        },
-        sheet_to_restore.dict(),
+    async def restore(session):
+        live = {"sheet_id": current_version_sheet.sheet_id, "current": True}
+        replaced = await db.sheets.find_one(live, session=session)
+        if replaced is None:
+            raise VersionConflict()
+        await _adopt_legacy_versions(replaced, session)
+        restored = await db.sheet_versions.find_one(
+            {
+                "sheet_id": sheet_to_restore.sheet_id,
+                "owner_email": sheet_to_restore.owner_email,
+                "lineage_id": current_version_sheet.lineage_id
+                or current_version_sheet.sheet_id,
+            },
+            session=session,
+        )
+        if restored is None:
+            raise VersionConflict()
+        await _retire(replaced, session)
+        version_key = restored.pop("_id")
+        restored.pop("replaced_at", None)
+        restored["current"] = True
+        replaced = await db.sheets.find_one_and_replace(live, restored, session=session)
+        if replaced is None:
+            raise VersionConflict()
+        await db.sheet_versions.delete_one({"_id": version_key}, session=session)
+        await taxonomy.apply_term_changes(
+            restored["owner_email"],
+            taxonomy.term_changes([replaced], [restored]),
+            session,
+        )
+        return restored
+
+    restored = await in_transaction(restore)
+    _sheets_changed(
+        restored["owner_email"], [current_version_sheet.sheet_id], [restored]
     )
-    return models.SheetInDB.parse_obj(result)
+    return models.SheetInDB.parse_obj(restored)
 
 
 async def get_sheet_by_id(owner_email: str, sheet_id: uuid.UUID) -> models.SheetInDB:
-    found = await db.sheets.find_one({"owner_email": owner_email, "sheet_id": sheet_id})
+    """A live sheet or, failing that, one of the old versions."""
+    query = {"owner_email": owner_email, "sheet_id": sheet_id}
+    found = await db.sheets.find_one(query)
+    if found is None:
+        found = await db.sheet_versions.find_one(query)
     return models.SheetInDB.parse_obj(found)
 
 
-async def get_previous_versions(sheet: models.SheetInDB):
-    if sheet.prev_versions:
-        return [
-            (await get_sheet_by_id(sheet.owner_email, version_id), replacement_time)
-            for (version_id, replacement_time) in sheet.prev_versions
-        ]
-    return []
+async def set_preview_status(
+    owner_email: str,
+    sheet_id: uuid.UUID,
+    status: models.PreviewStatus,
+    page_count: int = None,
+):
+    update = {"preview_status": status.value}
+    if page_count is not None:
+        update["page_count"] = page_count
+    await db.sheets.update_one(
+        {"owner_email": owner_email, "sheet_id": sheet_id}, {"$set": update}
+    )
 
 
-async def get_user_sheets(
-    owner_email: str,
-    page: int = 1,
-    sort: str = "piece",
-    direction: int = 1,
-    limit: int = 20,
-) -> motor_asyncio.AsyncIOMotorCursor:
-    skip = limit * (page - 1)
-    return db.sheets.find(
-        {"owner_email": owner_email, "current": True},
-        sort=[(sort, direction)],
-        limit=limit,
-        skip=skip,
+def stale_preview_query(queued_before: datetime.datetime) -> dict:
+    return {
+        "preview_status": models.PreviewStatus.pending.value,
+        "$or": [
+            {"preview_queued_at": {"$lt": queued_before}},
+            {"preview_queued_at": None},
+        ],
+    }
+
+
+async def claim_stale_preview(
+    queued_before: datetime.datetime,
+) -> Optional[models.SheetInDB]:
+    """Take one sheet whose preview has been pending since before
+    ``queued_before``, marking it queued now so no other worker takes it."""
+    found = await db.sheets.find_one_and_update(
+        stale_preview_query(queued_before),
+        {"$set": {"preview_queued_at": datetime.datetime.now()}},
+        return_document=ReturnDocument.AFTER,
     )
+    return models.SheetInDB.parse_obj(found) if found else None
 
 
-async def user_sheets_has_next(owner_email: str, page: int = 1, limit: int = 20):
-    skip = limit * page
-    count = await db.sheets.count_documents(
-        {"owner_email": owner_email, "current": True}, limit=1, skip=skip
+async def set_page_count(owner_email: str, sheet_id: uuid.UUID, page_count: int):
+    await db.sheets.update_one(
+        {"owner_email": owner_email, "sheet_id": sheet_id},
+        {"$set": {"page_count": page_count}},
     )
-    return count > 0
 
 
-async def related_has_next(
-    sheet: models.Sheet,
-    field: str,
-    page: int = 1,
+async def get_previous_versions(
+    sheet: models.SheetInDB,
+) -> List[Tuple[models.SheetSummary, datetime.datetime]]:
+    """Previous versions of a live sheet, newest first, fetched in one query.
+
+    Sheets stored before the history moved to sheet_versions still list
+    their old versions in ``prev_versions``; those are read from sheets.
+    """
+    if not sheet.current:
+        return []
+    found = db.sheet_versions.find(
+        {
+            "owner_email": sheet.owner_email,
+            "lineage_id": sheet.lineage_id or sheet.sheet_id,
+        },
+        {**models.SUMMARY_PROJECTION, "replaced_at": 1},
+        sort=[("replaced_at", pymongo.DESCENDING)],
+    )
+    versions = [
+        (models.SheetSummary.parse_obj(doc), doc["replaced_at"]) async for doc in found
+    ]
+    if sheet.prev_versions:
+        replaced_at = dict(sheet.prev_versions)
+        legacy = db.sheets.find(
+            {
+                "owner_email": sheet.owner_email,
+                "sheet_id": {"$in": list(replaced_at)},
+                "current": False,
+            },
+            models.SUMMARY_PROJECTION,
+        )
+        async for doc in legacy:
+            versions.append(
+                (models.SheetSummary.parse_obj(doc), replaced_at[doc["sheet_id"]])
+            )
+        versions.sort(key=lambda version: version[1], reverse=True)
+    return versions
+
+
+def user_sheets_query(owner_email: str) -> dict:
+    return {"owner_email": owner_email, "current": True}
+
+
+async def get_user_sheets(
+    owner_email: str,
+    sort: str = "piece",
+    direction: int = 1,
     limit: int = 20,
-    exclude: bool = True,
-):
-    skip = limit * page
-    count = await db.sheets.count_documents(
-        generate_related_query(sheet, field, exclude), limit=1, skip=skip
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    return await paged_query(
+        db.sheets,
+        user_sheets_query(owner_email),
+        sort,
+        direction,
+        limit,
+        after,
+        before,
+        parse=models.SheetSummary.parse_obj,
+        projection=models.SUMMARY_PROJECTION,
+        with_total=with_facets,
+        facets=FACET_FIELDS if with_facets else (),
     )
-    return count > 0
 
 
 def generate_related_query(sheet, field, exclude):
@@ -139,69 +391,165 @@ async def find_related(
     sheet: models.Sheet,
     field: str,
     limit: int = 3,
-    page: int = 1,
     sort: str = "piece",
     direction: int = 1,
     exclude: bool = True,
-):
-    skip = limit * (page - 1)
-    query_filter = generate_related_query(sheet, field, exclude)
-    cursor = db.sheets.find(
-        query_filter, limit=limit, skip=skip, sort=[(sort, direction)]
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    return await paged_query(
+        db.sheets,
+        generate_related_query(sheet, field, exclude),
+        sort,
+        direction,
+        limit,
+        after,
+        before,
+        parse=models.SheetSummary.parse_obj,
+        projection=models.SUMMARY_PROJECTION,
+        with_total=with_facets,
+        facets=FACET_FIELDS if with_facets else (),
     )
-    return [models.SheetOut.parse_obj(sheet) async for sheet in cursor]
 
 
-async def get_piece_related(
+def related_lists_pipeline(
     sheet: models.Sheet,
+    fields: Sequence[str],
     limit: int = 3,
-    page: int = 1,
     sort: str = "piece",
     direction: int = 1,
-) -> List[models.SheetOut]:
-    return await find_related(sheet, "piece", limit, page, sort, direction)
+) -> List[dict]:
+    conditions = {
+        field: generate_related_query(sheet, field, exclude=True)[field]
+        for field in fields
+    }
+    return [
+        {
+            "$match": {
+                **user_sheets_query(sheet.owner_email),
+                "sheet_id": {"$ne": sheet.sheet_id},
+                "$or": [{field: value} for field, value in conditions.items()],
+            }
+        },
+        {"$sort": {sort_key_field(sort): direction, "sheet_id": direction}},
+        {
+            "$facet": {
+                field: [
+                    {"$match": {field: value}},
+                    {"$limit": limit},
+                    {"$project": models.SUMMARY_PROJECTION},
+                ]
+                for field, value in conditions.items()
+            }
+        },
+    ]
 
 
-async def delete_sheet_by_id(owner_email: str, sheet_id: uuid.UUID):
-    sheet = models.SheetInDB.parse_obj(await get_sheet_by_id(owner_email, sheet_id))
-    if sheet.prev_versions:
-        for version_id, _ in sheet.prev_versions:
-            await db.sheets.delete_one(
-                {"owner_email": owner_email, "sheet_id": version_id}
-            )
-    await db.sheets.delete_one({"owner_email": owner_email, "sheet_id": sheet_id})
+async def find_related_lists(
+    sheet: models.Sheet,
+    fields: Sequence[str],
+    limit: int = 3,
+    sort: str = "piece",
+    direction: int = 1,
+) -> Dict[str, List[models.SheetSummary]]:
+    """A few sheets sharing each of ``fields`` with ``sheet``, in one query."""
+    check_sort("sheets", sort, direction)
+    pipeline = related_lists_pipeline(sheet, fields, limit, sort, direction)
+    result = (await db.sheets.aggregate(pipeline).to_list(1))[0]
+    return {
+        field: [models.SheetSummary.parse_obj(doc) for doc in result[field]]
+        for field in fields
+    }
 
 
-def find_sheet_from_text(
-    owner_email: str,
-    search_terms: str,
-    page: int = 1,
+async def get_piece_related(
+    sheet: models.Sheet,
+    limit: int = 3,
     sort: str = "piece",
     direction: int = 1,
-    limit: int = 20,
-):
-    skip = limit * (page - 1)
-    return db.sheets.find(
-        {
-            "owner_email": owner_email,
-            "current": True,
-            "$text": {"$search": search_terms},
-        },
-        sort=[(sort, direction)],
-        limit=limit,
-        skip=skip,
+    after: str = None,
+    before: str = None,
+) -> Page:
+    return await find_related(
+        sheet, "piece", limit, sort, direction, after=after, before=before
     )
 
 
-async def sheet_search_has_next(owner_email, search_text, page, limit):
-    skip = limit * page
-    count = await db.sheets.count_documents(
-        {
-            "owner_email": owner_email,
-            "current": True,
-            "$text": {"$search": search_text},
-        },
-        limit=limit,
-        skip=skip,
+async def delete_sheet_by_id(owner_email: str, sheet_id: uuid.UUID):
+    """Delete a sheet and all its previous versions."""
+
+    async def delete(session):
+        query = {"owner_email": owner_email, "sheet_id": sheet_id}
+        projection = {
+            "sheet_id": 1,
+            "lineage_id": 1,
+            "blob_id": 1,
+            "current": 1,
+            "prev_versions": 1,
+            **{field: 1 for field in taxonomy.TAXONOMY_FIELDS},
+        }
+        sheet = await db.sheets.find_one(query, projection, session=session)
+        if sheet is None:
+            return []
+        await _adopt_legacy_versions(sheet, session)
+        # The history goes first, so a crash part way leaves the sheet there
+        # to be deleted again. Each deletion counts only the references it
+        # removed, so concurrent deletes can't release one twice.
+        blob_counts = Counter()
+        versions = {"owner_email": owner_email, "lineage_id": _lineage_id(sheet)}
+        async for version in db.sheet_versions.find(
+            versions, {"_id": 1}, session=session
+        ):
+            deleted = await db.sheet_versions.find_one_and_delete(
+                {"_id": version["_id"]}, projection={"blob_id": 1}, session=session
+            )
+            if deleted and deleted.get("blob_id"):
+                blob_counts[deleted["blob_id"]] += 1
+        sheet = await db.sheets.find_one_and_delete(
+            query, projection=projection, session=session
+        )
+        if sheet is not None:
+            if sheet.get("current"):
+                await taxonomy.apply_term_changes(
+                    owner_email, taxonomy.term_changes(removed=[sheet]), session
+                )
+            if sheet.get("blob_id"):
+                blob_counts[sheet["blob_id"]] += 1
+        return await release_blob_references(blob_counts, session)
+
+    dead_blobs = await in_transaction(delete)
+    _sheets_changed(owner_email, removed=[sheet_id])
+    await remove_unused_blobs(dead_blobs)
+
+
+async def find_sheet_from_text(
+    owner_email: str,
+    search_terms: str,
+    sort: str = search.RELEVANCE,
+    direction: int = 1,
+    limit: int = 20,
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    """Sheets matching ``search_terms``, best match first unless sorted by a
+    field. SEARCH_BACKEND picks what finds and ranks the matches."""
+    ranked = await search.rank(owner_email, search_terms)
+    if sort == search.RELEVANCE:
+        return await search.ranked_page(
+            owner_email, ranked, limit, after, before, with_facets
+        )
+    return await paged_query(
+        db.sheets,
+        {**user_sheets_query(owner_email), "sheet_id": {"$in": ranked}},
+        sort,
+        direction,
+        limit,
+        after,
+        before,
+        parse=models.SheetSummary.parse_obj,
+        projection=models.SUMMARY_PROJECTION,
+        with_total=with_facets,
+        facets=FACET_FIELDS if with_facets else (),
     )
-    return count > 0
@@ -1,10 +1,30 @@
 import datetime
-from typing import Optional, List, Tuple
+from enum import Enum
+from typing import Dict, Optional, List, Tuple
 
 from pydantic import BaseModel, EmailStr, Field, UUID4
 
 
+def sort_key(value) -> str:
+    """Comparable string for a sortable field, as shown in list views."""
+    if not value:
+        return ""
+    if isinstance(value, list):
+        return ", ".join(value)
+    return str(value)
+
+
+class PreviewStatus(Enum):
+    none = "NONE"
+    pending = "PENDING"
+    ready = "READY"
+    failed = "FAILED"
+
+
 class Sheet(BaseModel):
+    class Config:
+        use_enum_values = True
+
     @staticmethod
     def sortable_fields():
         return [
@@ -63,23 +83,56 @@ class Sheet(BaseModel):
     )
     sheet_id: UUID4 = Field(..., title="Unique ID")
     file_ext: str = Field(..., title="File Extension")
+    blob_id: Optional[str] = Field(
+        None,
+        title="Blob ID",
+        description="SHA-256 digest of the sheet file, which keys its stored object.",
+    )
     current: bool = Field(
         True,
         title="Current",
         description="Whether this is the current version of a sheet.",
     )
+    lineage_id: Optional[UUID4] = Field(
+        None,
+        title="Lineage ID",
+        description="Shared by every version of a sheet; the first version's ID.",
+    )
+    preview_status: PreviewStatus = Field(
+        PreviewStatus.ready.value,
+        title="Preview Status",
+        description="Whether the preview image has been generated yet.",
+    )
+    preview_queued_at: Optional[datetime.datetime] = Field(
+        None,
+        title="Preview Queued At",
+        description="When the pending preview render was last queued.",
+    )
+    page_count: Optional[int] = Field(
+        None, title="Page Count", description="Number of pages in the sheet file."
+    )
+    sort_keys: Optional[Dict[str, str]] = Field(
+        None,
+        title="Sort Keys",
+        description="Scalar value of each sortable field, for keyset pagination.",
+    )
 
 
 class SheetWithVersions(Sheet):
     prev_versions: Optional[List[Tuple[UUID4, datetime.datetime]]] = Field(
         None,
         title="Previous Versions",
-        description="UUIDs of previous versions of this sheet.",
+        description="Only on sheets stored before history moved to sheet_versions.",
     )
 
 
 class SheetInDB(SheetWithVersions):
     _id: Optional[str] = None
+    replaced_at: Optional[datetime.datetime] = Field(
+        None,
+        title="Replaced At",
+        description="When an old version was replaced by a newer one.",
+    )
 
     @property
     def id(self):
@@ -98,6 +151,36 @@ class SheetInDB(SheetWithVersions):
     def clean_tags(self):
         self.tags = [tag.lower() for tag in self.tags]
 
+    def set_sort_keys(self):
+        self.sort_keys = {
+            field: sort_key(getattr(self, field)) for field in self.sortable_fields()
+        }
+
 
 class SheetOut(SheetWithVersions):
     pass
+
+
+class SheetSummary(BaseModel):
+    """The fields shown for a sheet in list views."""
+
+    class Config:
+        use_enum_values = True
+
+    sheet_id: UUID4
+    piece: str
+    composers: List[str]
+    catalog_number: Optional[str] = None
+    genre: Optional[str] = None
+    tags: Optional[List[str]] = None
+    instruments: Optional[List[str]] = None
+    type: Optional[str] = None
+    preview_status: PreviewStatus = PreviewStatus.ready.value
+
+
+# Paging needs sort_keys to build cursors; nothing else leaves the database.
+SUMMARY_PROJECTION = {
+    "_id": 0,
+    "sort_keys": 1,
+    **{field: 1 for field in SheetSummary.__fields__},
+}
@@ -0,0 +1,396 @@
+import asyncio
+import datetime
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.util import Finalize
+from typing import IO, Dict, List, Optional, Tuple
+
+import minio
+from fastapi import UploadFile
+from minio import Minio
+from pdf2image import convert_from_path, pdfinfo_from_path
+from starlette.concurrency import run_in_threadpool
+
+from app import metrics
+from app.dependencies import new_minio_client
+from app.sheets import crud, models, storage
+
+logger = logging.getLogger()
+
+PREVIEW_WORKERS = max(int(os.getenv("PREVIEW_WORKERS", 2)), 1)
+
+# Widths in pixels: list thumbnails, mobile cards and the preview modal.
+PREVIEW_SIZES = {"thumb": 160, "card": 480, "modal": 1000}
+PREVIEW_FORMATS = {"webp": ("WEBP", "image/webp"), "png": ("PNG", "image/png")}
+INGEST_FORMAT = "webp"
+PAGE_DPIS = (72, 100, 150, 200, 300)
+# Page renders may hold this many pool workers at once, so flipping through a
+# long score leaves room for previews of new uploads.
+PAGE_WORKERS = min(max(int(os.getenv("PAGE_WORKERS", 1)), 1), PREVIEW_WORKERS)
+
+# Seconds a render may stay pending before it is taken as lost to a crash or
+# restart and queued again. Each sweep queues at most REQUEUE_BATCH.
+PREVIEW_STALE_AFTER = float(os.getenv("PREVIEW_STALE_AFTER", 600))
+REQUEUE_BATCH = 100
+# Bytes of sheet files each pool worker keeps on local disk to render from,
+# so paging through a score downloads it once rather than once per page.
+SOURCE_CACHE_SIZE = int(os.getenv("PREVIEW_SOURCE_CACHE_SIZE", 512 * 1024 * 1024))
+SOURCE_CACHE_DIR = os.path.join(storage.SHEET_CACHE_DIR, "sources")
+# Copies of new uploads, rendered from so their previews don't download the
+# file that was just uploaded.
+UPLOADS_DIR = os.path.join(storage.SHEET_CACHE_DIR, "uploads")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_worker_client: Optional[Minio] = None
+_worker_sources: Optional["SourceFiles"] = None
+_worker_lock: Optional[IO] = None
+_uploads: Optional[Tuple[str, IO]] = None
+_in_flight: Dict[str, asyncio.Future] = {}
+_page_slots: Optional[asyncio.Semaphore] = None
+_sweeper: Optional[asyncio.Task] = None
+
+
+class SourceFiles:
+    """Local copies of the sheet files a worker renders from.
+
+    Stored objects never change, so a copy stays good until it is evicted,
+    least recently used first. The file being rendered is never evicted,
+    even if it alone is larger than ``max_bytes``.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, client: Minio):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.client = client
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+
+    def path(self, object_name: str) -> str:
+        entry = self._entries.get(object_name)
+        if entry is not None:
+            self._entries.move_to_end(object_name)
+            return entry[0]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, hashlib.sha256(object_name.encode()).hexdigest()
+        )
+        self.client.fget_object(os.getenv("MINIO_BUCKET_NAME"), object_name, path)
+        size = os.path.getsize(path)
+        self._entries[object_name] = (path, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, (old_path, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+            os.remove(old_path)
+        return path
+
+
+def _init_worker():
+    # Minio clients must not be shared between processes.
+    global _worker_client, _worker_sources, _worker_lock
+    _worker_client = new_minio_client()
+    directory, _worker_lock = storage.private_directory(SOURCE_CACHE_DIR)
+    _worker_sources = SourceFiles(directory, SOURCE_CACHE_SIZE, _worker_client)
+    # Pool workers skip atexit handlers, but run finalizers.
+    Finalize(None, shutil.rmtree, (directory, True), exitpriority=10)
+
+
+def _object_exists(bucket: str, object_name: str) -> bool:
+    try:
+        _worker_client.stat_object(bucket, object_name)
+    except minio.error.NoSuchKey:
+        return False
+    return True
+
+
+def _save_image(image, object_name: str, fmt: str):
+    data = io.BytesIO()
+    image_format, content_type = PREVIEW_FORMATS[fmt]
+    image.save(data, format=image_format, optimize=True)
+    size = data.tell()
+    data.seek(0)
+    _worker_client.put_object(
+        os.getenv("MINIO_BUCKET_NAME"),
+        object_name,
+        data,
+        size,
+        content_type=content_type,
+    )
+
+
+def _render_previews(
+    object_name: str, targets: List[Tuple[str, int, str]], source: str = None
+) -> int:
+    """Render page 1 once and store it at each (name, width, format) target.
+
+    Renders from the local file ``source`` if given, otherwise from the
+    stored object. Returns the number of pages in the sheet.
+    """
+    bucket = os.getenv("MINIO_BUCKET_NAME")
+    # Sheets sharing a blob share its previews too.
+    missing = [target for target in targets if not _object_exists(bucket, target[0])]
+    pdf_path = source or _worker_sources.path(object_name)
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    if not missing:
+        return page_count
+    page = convert_from_path(
+        pdf_path,
+        size=(max(width for _, width, _ in missing), None),
+        use_cropbox=True,
+        first_page=1,
+        last_page=1,
+        grayscale=True,
+    )[0]
+    for preview_name, width, fmt in missing:
+        image = page.copy()
+        image.thumbnail((width, image.height))
+        _save_image(image, preview_name, fmt)
+    return page_count
+
+
+def _render_page(
+    object_name: str, page_name: str, page_number: int, dpi: int, fmt: str
+) -> int:
+    """Render one page of a sheet at ``dpi`` and return the sheet's page count."""
+    pdf_path = _worker_sources.path(object_name)
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    if page_number > page_count:
+        raise ValueError(f"{object_name} has only {page_count} pages")
+    page = convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        use_cropbox=True,
+        first_page=page_number,
+        last_page=page_number,
+        grayscale=True,
+    )[0]
+    _save_image(page, page_name, fmt)
+    return page_count
+
+
+def new_pool(workers: int = PREVIEW_WORKERS) -> ProcessPoolExecutor:
+    """A process pool whose workers can render previews."""
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = new_pool()
+    return _executor
+
+
+def shutdown():
+    global _executor, _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        _sweeper = None
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def initial_status(file_ext: str) -> str:
+    if file_ext.lower() == "pdf":
+        return models.PreviewStatus.pending.value
+    return models.PreviewStatus.none.value
+
+
+def _single_flight(object_name: str, render) -> asyncio.Future:
+    """Share one pending render of ``object_name`` between all callers."""
+    future = _in_flight.get(object_name)
+    if future is None:
+        future = asyncio.ensure_future(render())
+        _in_flight[object_name] = future
+        future.add_done_callback(lambda _: _in_flight.pop(object_name, None))
+    return future
+
+
+async def _render(
+    sheet: models.Sheet, targets: List[Tuple[str, int, str]], source: str = None
+) -> int:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(),
+        _render_previews,
+        storage.sheet_object_name(sheet),
+        targets,
+        source,
+    )
+
+
+def _uploads_dir() -> str:
+    global _uploads
+    if _uploads is None:
+        _uploads = storage.private_directory(UPLOADS_DIR)
+    return _uploads[0]
+
+
+def _copy_upload(file, directory: str) -> str:
+    file.seek(0)
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as copy:
+        shutil.copyfileobj(file, copy)
+    return copy.name
+
+
+async def keep_upload(sheet_file: UploadFile) -> str:
+    """Copy an upload to local disk for ``generate_preview`` to render from.
+
+    The request's upload may be closed before background tasks run.
+    """
+    return await run_in_threadpool(_copy_upload, sheet_file.file, _uploads_dir())
+
+
+def ingest_targets(sheet: models.Sheet) -> List[Tuple[str, int, str]]:
+    """Every preview size rendered when a sheet is stored."""
+    return [
+        (storage.preview_object_name(sheet, size, INGEST_FORMAT), width, INGEST_FORMAT)
+        for size, width in PREVIEW_SIZES.items()
+    ]
+
+
+def submit_previews(
+    pool: ProcessPoolExecutor, sheet: models.Sheet, source: str = None
+) -> Future:
+    """Render a sheet's previews on a pool from ``new_pool``, for callers
+    outside the event loop, from the local file ``source`` if given. The
+    future gives the sheet's page count."""
+    return pool.submit(
+        _render_previews,
+        storage.sheet_object_name(sheet),
+        ingest_targets(sheet),
+        source,
+    )
+
+
+async def generate_preview(sheet: models.Sheet, upload: str = None):
+    """Render every preview size in the process pool and record the outcome.
+
+    ``upload`` is a copy from ``keep_upload`` to render from, removed after.
+    """
+    page_count = None
+    try:
+        page_count = await _render(sheet, ingest_targets(sheet), upload)
+        status = models.PreviewStatus.ready
+    except Exception as err:
+        logger.debug(f"Preview for {sheet.sheet_id} failed: {err}")
+        status = models.PreviewStatus.failed
+    finally:
+        if upload is not None:
+            os.remove(upload)
+    await crud.set_preview_status(sheet.owner_email, sheet.sheet_id, status, page_count)
+
+
+async def requeue_stale_previews() -> int:
+    """Queue renders again for sheets pending longer than PREVIEW_STALE_AFTER."""
+    queued_before = datetime.datetime.now() - datetime.timedelta(
+        seconds=PREVIEW_STALE_AFTER
+    )
+    requeued = 0
+    while requeued < REQUEUE_BATCH:
+        sheet = await crud.claim_stale_preview(queued_before)
+        if sheet is None:
+            break
+        asyncio.ensure_future(generate_preview(sheet))
+        requeued += 1
+    if requeued:
+        metrics.increment("previews.requeued", requeued)
+        logger.warning(f"Queued {requeued} lost preview renders again")
+    return requeued
+
+
+def start_sweeper():
+    """Look for lost renders now and every PREVIEW_STALE_AFTER seconds."""
+    global _sweeper
+
+    async def sweep():
+        while True:
+            try:
+                await requeue_stale_previews()
+            except Exception as err:
+                logger.warning(f"Could not requeue previews: {err}")
+            await asyncio.sleep(PREVIEW_STALE_AFTER)
+
+    if _sweeper is None:
+        _sweeper = asyncio.ensure_future(sweep())
+
+
+async def ensure_preview(
+    sheet: models.Sheet, size: str, fmt: str
+) -> Optional[Tuple[str, Optional[minio.definitions.Object]]]:
+    """Name of a stored preview, rendering it first if it is missing, and
+    its stat if that was looked up on the way.
+
+    Concurrent requests for the same missing preview share a single render.
+    Returns None if the sheet can't be rendered.
+    """
+    preview_name = storage.preview_object_name(sheet, size, fmt)
+    if preview_name in storage.sheet_cache:
+        return preview_name, None
+    stat = await storage.find_object(preview_name)
+    if stat is not None:
+        return preview_name, stat
+    render = _single_flight(
+        preview_name,
+        lambda: _render(sheet, [(preview_name, PREVIEW_SIZES[size], fmt)]),
+    )
+    try:
+        await asyncio.shield(render)
+    except Exception as err:
+        logger.debug(f"Rendering {preview_name} failed: {err}")
+        return None
+    return preview_name, None
+
+
+async def _render_page_limited(
+    sheet: models.Sheet, page_name: str, page_number: int, dpi: int, fmt: str
+):
+    global _page_slots
+    if _page_slots is None:
+        _page_slots = asyncio.Semaphore(PAGE_WORKERS)
+    loop = asyncio.get_event_loop()
+    async with _page_slots:
+        page_count = await loop.run_in_executor(
+            get_executor(),
+            _render_page,
+            storage.sheet_object_name(sheet),
+            page_name,
+            page_number,
+            dpi,
+            fmt,
+        )
+    if sheet.page_count is None:
+        sheet.page_count = page_count
+        await crud.set_page_count(sheet.owner_email, sheet.sheet_id, page_count)
+
+
+async def ensure_page(
+    sheet: models.Sheet, page_number: int, dpi: int, fmt: str
+) -> Optional[Tuple[str, Optional[minio.definitions.Object]]]:
+    """Name of a stored page image, rendering it first if it is missing, and
+    its stat as ``ensure_preview`` gives it.
+
+    Returns None if the page doesn't exist or can't be rendered.
+    """
+    page_name = storage.page_object_name(sheet, page_number, dpi, fmt)
+    if page_name in storage.sheet_cache:
+        return page_name, None
+    stat = await storage.find_object(page_name)
+    if stat is not None:
+        return page_name, stat
+    render = _single_flight(
+        page_name,
+        lambda: _render_page_limited(sheet, page_name, page_number, dpi, fmt),
+    )
+    try:
+        await asyncio.shield(render)
+    except Exception as err:
+        logger.debug(f"Rendering {page_name} failed: {err}")
+        return None
+    return page_name, None
@@ -0,0 +1,136 @@
+import os
+from typing import Optional, Tuple
+
+import minio
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.responses import (
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.status import (
+    HTTP_206_PARTIAL_CONTENT,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+)
+
+from app.sheets import storage
+
+# "stream" proxies object bytes through the app; "redirect" sends clients
+# straight to MinIO with a presigned URL.
+SHEET_DELIVERY = os.getenv("SHEET_DELIVERY", "stream")
+
+# Objects are never rewritten under the same sheet id: every edit makes a new
+# sheet id, so anything served for one can be cached for good.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range into inclusive start and end offsets.
+
+    Returns None when the whole object should be sent, which includes
+    malformed and multi-range headers. Raises a 416 when the range lies
+    entirely past the end of the object.
+    """
+    if not header or not header.startswith("bytes=") or "," in header or not size:
+        return None
+    start, _, end = header[len("bytes=") :].strip().partition("-")
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                return None
+            return max(size - suffix, 0), size - 1
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        raise HTTPException(
+            status_code=HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+async def object_response(
+    request: Request,
+    object_name: str,
+    media_type: str = None,
+    headers: dict = None,
+    object_stat: minio.definitions.Object = None,
+) -> Response:
+    """Serve a stored object with validators, caching and Range support.
+
+    Objects held in the local disk cache are sent from there. In redirect
+    mode the client is sent to a presigned MinIO URL instead, which carries
+    the same Content-Type and Content-Disposition. ``object_stat`` is the
+    object's stat if the caller already has it.
+    """
+    if SHEET_DELIVERY == "redirect":
+        return await redirect_response(object_name, media_type, headers)
+    stat = await storage.cached_object(object_name, object_stat)
+    etag = f'"{stat.etag}"'
+    response_headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        **(headers or {}),
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=response_headers)
+    media_type = media_type or stat.content_type
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range == etag:
+        byte_range = parse_range(request.headers.get("range"), stat.size)
+    # Opened now, so a concurrent fill evicting the copy can't pull it away
+    # mid-response. A copy that is already gone is fetched from MinIO.
+    file = await storage.sheet_cache.open(object_name, stat) if stat.path else None
+    if byte_range is None:
+        response_headers["Content-Length"] = str(stat.size)
+        if file:
+            body = storage.iter_file(file)
+        else:
+            body = storage.iter_object(await storage.get_object(object_name))
+        return StreamingResponse(body, media_type=media_type, headers=response_headers)
+    start, end = byte_range
+    length = end - start + 1
+    if file:
+        body = storage.iter_file(file, start, length)
+    else:
+        body = storage.iter_object(await storage.get_object(object_name, start, length))
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{stat.size}"
+    response_headers["Content-Length"] = str(length)
+    return StreamingResponse(
+        body,
+        status_code=HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=response_headers,
+    )
+
+
+async def redirect_response(
+    object_name: str, media_type: str = None, headers: dict = None
+) -> RedirectResponse:
+    response_headers = {}
+    if media_type:
+        response_headers["response-content-type"] = media_type
+    if headers and "Content-Disposition" in headers:
+        response_headers["response-content-disposition"] = headers[
+            "Content-Disposition"
+        ]
+    url = await storage.presigned_url(object_name, response_headers)
+    return RedirectResponse(url, headers={"Cache-Control": "no-store"})
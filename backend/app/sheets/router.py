@@ -1,19 +1,30 @@
+import asyncio
 import logging
 import os
 import string
 import uuid
 
 import minio
-from fastapi import APIRouter, Depends, UploadFile, File, Query
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    UploadFile,
+    File,
+    Query,
+    HTTPException,
+)
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, RedirectResponse
+from starlette.responses import RedirectResponse
 
 from app.auth.models import UserInDB
 from app.auth.security import get_current_active_user
 from app.dependencies import templates
-from app.util import get_next_prev_page_urls, get_sort_links
-from app.sheets import models, storage, crud
+from app.util import get_page_urls, get_sort_links
+from app.sheets import models, storage, crud, previews
 from app.sheets.forms import SheetForm, UpdateSheetForm, SearchForm
+from app.sheets.responses import object_response
+from app.sheets.search import RELEVANCE
 
 sheet_router = APIRouter()
 
@@ -25,36 +36,40 @@ async def search_sheets(
     request: Request,
     current_user: UserInDB = Depends(get_current_active_user),
     search: str = Query(...),
-    page: int = Query(1),
-    sort: str = Query("piece"),
+    sort: str = Query(RELEVANCE),
     direction: int = Query(1),
+    after: str = Query(None),
+    before: str = Query(None),
 ):
     limit = int(os.getenv("SHEETS_PER_PAGE", 20))
-    found = crud.find_sheet_from_text(
+    page = await crud.find_sheet_from_text(
         current_user.email,
         search,
-        page=page,
         sort=sort,
         direction=direction,
         limit=limit,
+        after=after,
+        before=before,
+        with_facets=True,
     )
-    sheets = [models.SheetOut.parse_obj(item) async for item in found]
     sort_links = get_sort_links(request.url, sort, direction)
-    prev_page, next_page = get_next_prev_page_urls(request.url, page)
-    if not await crud.sheet_search_has_next(current_user.email, search, page, limit):
-        next_page = None
+    prev_page, next_page = get_page_urls(request.url, page)
     return templates.TemplateResponse(
         "list.html",
         {
             "request": request,
-            "page": page,
             "sort": sort,
             "direction": direction,
-            "sheets": sheets,
+            "sheets": page.items,
+            "total": page.total,
+            "facets": page.facets,
             "prev_page": prev_page,
             "next_page": next_page,
             "title": "Found Sheets",
             "sort_links": sort_links,
+            "relevance_link": request.url.remove_query_params(
+                ["sort", "direction", "after", "before"]
+            ),
         },
     )
 
@@ -72,21 +87,26 @@ async def get_create_sheet(
 @sheet_router.post("/create")
 async def post_create_sheet(
     request: Request,
+    background_tasks: BackgroundTasks,
     current_user: UserInDB = Depends(get_current_active_user),
     sheet_file: UploadFile = File(...),
 ):
     form = SheetForm(await request.form(), meta={"csrf_context": request.session})
     if form.validate():
+        file_ext = sheet_file.filename.split(".")[-1]
+        blob_id = await crud.save_sheet_file(sheet_file)
         sheet = models.Sheet(
             **form.data,
             owner_email=current_user.email,
             sheet_id=uuid.uuid4(),
-            file_ext=sheet_file.filename.split(".")[-1],
-        )
-        await storage.save_sheet(
-            sheet_file, sheet.sheet_id, sheet.owner_email, sheet.file_ext
+            file_ext=file_ext,
+            blob_id=blob_id,
+            preview_status=previews.initial_status(file_ext),
         )
-        created_sheet = await crud.create_sheet(sheet)
+        created_sheet = await crud.create_sheet(sheet, blob_held=True)
+        if created_sheet.preview_status == models.PreviewStatus.pending.value:
+            upload = await previews.keep_upload(sheet_file)
+            background_tasks.add_task(previews.generate_preview, created_sheet, upload)
         return templates.TemplateResponse(
             "sheets/created.html",
             {"request": request, "sheet_id": created_sheet.sheet_id},
@@ -101,11 +121,12 @@ def clean_for_filename(text: str):
 
 @sheet_router.get("/{sheet_id}/download")
 async def download_sheet_by_id(
-    sheet_id: str, current_user: UserInDB = Depends(get_current_active_user)
+    request: Request,
+    sheet_id: str,
+    current_user: UserInDB = Depends(get_current_active_user),
 ):
     sheet_id = uuid.UUID(sheet_id)
     sheet = await crud.get_sheet_by_id(current_user.email, sheet_id)
-    data = storage.get_sheet(sheet.sheet_id, sheet.owner_email, sheet.file_ext)
     filename = ""
     if sheet.type.lower() == "part" and sheet.instruments:
         filename = sheet.instruments[0].upper() + "-"
@@ -114,22 +135,76 @@ async def download_sheet_by_id(
     filename += sheet.composers[0].split(" ")[-1] + "-"
     filename += sheet.piece.title().replace(" ", "").replace(".", "")
     filename = clean_for_filename(filename) + "." + sheet.file_ext
-    return StreamingResponse(
-        data.stream(32 * 1024),
+    return await object_response(
+        request,
+        storage.sheet_object_name(sheet),
         headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
 
 
 @sheet_router.get("/{sheet_id}/preview")
 async def get_sheet_preview_by_id(
-    sheet_id: str, current_user: UserInDB = Depends(get_current_active_user)
+    request: Request,
+    sheet_id: str,
+    size: str = Query("modal"),
+    current_user: UserInDB = Depends(get_current_active_user),
 ):
+    if size not in previews.PREVIEW_SIZES:
+        raise HTTPException(status_code=400, detail="Unknown preview size.")
     sheet_id = uuid.UUID(sheet_id)
+    sheet = await crud.get_sheet_by_id(current_user.email, sheet_id)
+    if sheet.file_ext.lower() != "pdf":
+        raise HTTPException(status_code=404, detail="Preview not found.")
+    fmt = "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+    preview = await previews.ensure_preview(sheet, size, fmt)
+    if preview is None:
+        raise HTTPException(status_code=404, detail="Preview not found.")
+    preview_name, preview_stat = preview
     try:
-        data = storage.get_preview(sheet_id, current_user.email)
-        return StreamingResponse(data.stream(32 * 1024))
+        return await object_response(
+            request,
+            preview_name,
+            media_type=previews.PREVIEW_FORMATS[fmt][1],
+            headers={"Vary": "Accept"},
+            object_stat=preview_stat,
+        )
     except minio.error.NoSuchKey:
-        return None
+        raise HTTPException(status_code=404, detail="Preview not found.")
+
+
+@sheet_router.get("/{sheet_id}/pages/{page_number}")
+async def get_sheet_page(
+    request: Request,
+    sheet_id: str,
+    page_number: int,
+    dpi: int = Query(100),
+    current_user: UserInDB = Depends(get_current_active_user),
+):
+    if dpi not in previews.PAGE_DPIS:
+        raise HTTPException(status_code=400, detail="Unsupported DPI.")
+    sheet_id = uuid.UUID(sheet_id)
+    sheet = await crud.get_sheet_by_id(current_user.email, sheet_id)
+    if (
+        sheet.file_ext.lower() != "pdf"
+        or page_number < 1
+        or (sheet.page_count is not None and page_number > sheet.page_count)
+    ):
+        raise HTTPException(status_code=404, detail="Page not found.")
+    fmt = "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+    page = await previews.ensure_page(sheet, page_number, dpi, fmt)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Page not found.")
+    page_name, page_stat = page
+    headers = {"Vary": "Accept"}
+    if sheet.page_count is not None:
+        headers["X-Page-Count"] = str(sheet.page_count)
+    return await object_response(
+        request,
+        page_name,
+        media_type=previews.PREVIEW_FORMATS[fmt][1],
+        headers=headers,
+        object_stat=page_stat,
+    )
 
 
 @sheet_router.get("/{sheet_id}/restore")
@@ -145,7 +220,12 @@ async def restore_sheet(
     current_version_sheet = await crud.get_sheet_by_id(
         current_user.email, current_version_id
     )
-    result = await crud.restore_previous_sheet(sheet_to_restore, current_version_sheet)
+    try:
+        result = await crud.restore_previous_sheet(
+            sheet_to_restore, current_version_sheet
+        )
+    except crud.VersionConflict:
+        raise HTTPException(status_code=409, detail="This sheet has changed.")
     return templates.TemplateResponse(
         "sheets/updated.html", {"request": request, "sheet_id": result.sheet_id}
     )
@@ -156,23 +236,33 @@ async def get_related(
     request: Request,
     sheet_id: str,
     field: str = Query(...),
-    page: int = Query(1),
     sort: str = Query("piece"),
     direction: int = Query(1),
+    after: str = Query(None),
+    before: str = Query(None),
     current_user: UserInDB = Depends(get_current_active_user),
 ):
     sheet_id = uuid.UUID(sheet_id)
     limit = int(os.getenv("SHEETS_PER_PAGE", 20))
     sheet = await crud.get_sheet_by_id(current_user.email, sheet_id)
-    prev_page, next_page = get_next_prev_page_urls(request.url, page)
+    sheets = []
+    total, facets = 0, {}
+    prev_page = next_page = None
     if field in models.Sheet.allowed_related_fields():
-        sheets = await crud.find_related(
-            sheet, field, limit, page, sort, direction, exclude=False
+        page = await crud.find_related(
+            sheet,
+            field,
+            limit,
+            sort,
+            direction,
+            exclude=False,
+            after=after,
+            before=before,
+            with_facets=True,
         )
-        if not await crud.related_has_next(sheet, field, page, limit):
-            next_page = None
-    else:
-        sheets = []
+        sheets = page.items
+        total, facets = page.total, page.facets
+        prev_page, next_page = get_page_urls(request.url, page)
     title_text = getattr(sheet, field)
     if isinstance(title_text, list):
         title_text = ", ".join(title_text)
@@ -180,10 +270,11 @@ async def get_related(
         "list.html",
         {
             "request": request,
-            "page": page,
             "sort": sort,
             "direction": direction,
             "sheets": sheets,
+            "total": total,
+            "facets": facets,
             "next_page": next_page,
             "prev_page": prev_page,
             "title": f"Related to {title_text}",
@@ -223,6 +314,7 @@ async def get_sheet_update_form(
 async def post_sheet_update(
     request: Request,
     sheet_id: str,
+    background_tasks: BackgroundTasks,
     current_user: UserInDB = Depends(get_current_active_user),
     sheet_file: UploadFile = File(None),
 ):
@@ -231,24 +323,44 @@ async def post_sheet_update(
         old_sheet = await crud.get_sheet_by_id(current_user.email, uuid.UUID(sheet_id))
         new_id = uuid.uuid4()
         file_ext = old_sheet.file_ext
+        blob_id = old_sheet.blob_id
+        blob_held = False
+        preview_status = old_sheet.preview_status
+        page_count = old_sheet.page_count
         logger.debug(f"New sheet id {new_id}")
         # logger.debug(sheet_file.content_type)
         # logger.debug(sheet_file.filename)
         if sheet_file.filename:
             logger.debug("Uploading new sheet")
             file_ext = sheet_file.filename.split(".")[-1]
-            await storage.save_sheet(sheet_file, new_id, current_user.email, file_ext)
-        else:
-            storage.copy_sheet(
-                old_sheet.sheet_id, new_id, current_user.email, old_sheet.file_ext
-            )
+            blob_id = await crud.save_sheet_file(sheet_file)
+            blob_held = True
+            preview_status = previews.initial_status(file_ext)
+            page_count = None
+        elif not blob_id:
+            await storage.copy_legacy_sheet(old_sheet, new_id)
+            preview_status = previews.initial_status(file_ext)
         new_sheet = models.Sheet(
             **form.data,
             owner_email=current_user.email,
             sheet_id=new_id,
             file_ext=file_ext,
+            blob_id=blob_id,
+            preview_status=preview_status,
+            page_count=page_count,
         )
-        new_sheet_in_db = await crud.update_sheet(old_sheet, new_sheet)
+        try:
+            new_sheet_in_db = await crud.update_sheet(old_sheet, new_sheet, blob_held)
+        except crud.VersionConflict:
+            raise HTTPException(status_code=409, detail="This sheet has changed.")
+        if new_sheet_in_db.preview_status == models.PreviewStatus.pending.value:
+            # Copied legacy files and unchanged files aren't in hand here.
+            upload = None
+            if sheet_file.filename:
+                upload = await previews.keep_upload(sheet_file)
+            background_tasks.add_task(
+                previews.generate_preview, new_sheet_in_db, upload
+            )
         return templates.TemplateResponse(
             "sheets/updated.html",
             {"request": request, "sheet_id": new_sheet_in_db.sheet_id},
@@ -274,21 +386,14 @@ async def get_sheet_info(
 ):
     sheet_id = uuid.UUID(sheet_id)
     sheet = await crud.get_sheet_by_id(current_user.email, sheet_id)
-    prev_version_records = await crud.get_previous_versions(sheet)
-    logger.debug(prev_version_records)
+    related_fields = {"piece": False, "composers": True, "tags": True}
+    prev_version_records, related = await asyncio.gather(
+        crud.get_previous_versions(sheet),
+        crud.find_related_lists(sheet, list(related_fields)),
+    )
     related_lists = {
-        "piece": {
-            "items": await crud.find_related(sheet, "piece", limit=3),
-            "plural": False,
-        },
-        "composers": {
-            "items": await crud.find_related(sheet, "composers", limit=3),
-            "plural": True,
-        },
-        "tags": {
-            "items": await crud.find_related(sheet, "tags", limit=3),
-            "plural": True,
-        },
+        field: {"items": related[field], "plural": plural}
+        for field, plural in related_fields.items()
     }
     return templates.TemplateResponse(
         "sheets/single.html",
@@ -306,27 +411,27 @@ async def get_sheet_info(
 async def get_sheets(
     request: Request,
     current_user: UserInDB = Depends(get_current_active_user),
-    page: int = Query(1),
     sort: str = Query("piece"),
     direction: int = Query(1),
+    after: str = Query(None),
+    before: str = Query(None),
 ):
     limit = int(os.getenv("SHEETS_PER_PAGE", 20))
-    sheet_cursor = await crud.get_user_sheets(
-        current_user.email, page, sort, direction, limit
+    page = await crud.get_user_sheets(
+        current_user.email, sort, direction, limit, after, before, with_facets=True
     )
-    prev_page, next_page = get_next_prev_page_urls(request.url, page)
-    if not await crud.user_sheets_has_next(current_user.email, page, limit):
-        next_page = None
-    user_sheets = [models.SheetOut.parse_obj(sheet) async for sheet in sheet_cursor]
+    prev_page, next_page = get_page_urls(request.url, page)
+    user_sheets = page.items
     sort_links = get_sort_links(request.url, sort, direction)
     return templates.TemplateResponse(
         "list.html",
         {
             "request": request,
-            "page": page,
             "sort": sort,
             "direction": direction,
             "sheets": user_sheets,
+            "total": page.total,
+            "facets": page.facets,
             "prev_page": prev_page,
             "next_page": next_page,
             "title": "All Sheets",
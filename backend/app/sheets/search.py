@@ -0,0 +1,451 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import unicodedata
+import uuid
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from app import metrics
+from app.dependencies import db
+from app.pagination import (
+    FACET_FIELDS,
+    Page,
+    decode_cursor,
+    encode_cursor,
+    facet_stages,
+)
+from app.sheets import models
+
+# "text" ranks with the Mongo $text index; "index" with the in-process
+# index below.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "text")
+# Ranked results kept per search; later matches are dropped.
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 1000))
+# Snapshots hold words from users' sheets, so the directory is kept private
+# to this user.
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR") or os.path.join(
+    tempfile.gettempdir(), "smlib-search"
+)
+SEARCH_INDEX_USERS = max(int(os.getenv("SEARCH_INDEX_USERS", 200)), 1)
+# Seconds between checks that a user's index still matches the database.
+SEARCH_SYNC_INTERVAL = float(os.getenv("SEARCH_SYNC_INTERVAL", 30))
+
+FIELD_BOOSTS = {
+    "piece": 3.0,
+    "composers": 2.0,
+    "tags": 1.5,
+    "catalog_number": 1.0,
+    "genre": 1.0,
+    "instruments": 1.0,
+    "type": 1.0,
+}
+# Search results are in ranked order unless sorted by a field.
+RELEVANCE = "relevance"
+# Share of trigrams (Dice coefficient) a misspelt word needs in common
+# with a word in the index to count as a match.
+FUZZY_THRESHOLD = 0.5
+SNAPSHOT_VERSION = 1
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words with accents removed and no stemming, so names and
+    foreign titles match as typed."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    plain = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return re.findall(r"\w+", plain.casefold())
+
+
+def trigrams(token: str) -> Set[str]:
+    padded = f" {token} "
+    return {padded[start : start + 3] for start in range(len(padded) - 2)}
+
+
+def sheet_tokens(sheet: dict) -> Dict[str, float]:
+    """Each word in a sheet with the boost of the best field it appears in."""
+    weights = {}
+    for field, boost in FIELD_BOOSTS.items():
+        values = sheet.get(field)
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            for token in tokenize(value or ""):
+                weights[token] = max(weights.get(token, 0.0), boost)
+    return weights
+
+
+class UserIndex:
+    """Inverted index over one user's current sheets.
+
+    Words map to the sheets containing them, and trigrams map to words, so
+    a query word finds exact, prefix and misspelt matches without scanning
+    every sheet.
+    """
+
+    def __init__(self):
+        self.sheets: Dict[uuid.UUID, Dict[str, float]] = {}
+        self.postings: Dict[str, Dict[uuid.UUID, float]] = {}
+        self.grams: Dict[str, Set[str]] = {}
+        self.vocabulary: List[str] = []
+        self.synced_at = 0.0
+
+    def add(self, sheet_id: uuid.UUID, tokens: Dict[str, float]):
+        if sheet_id in self.sheets:
+            return
+        self.sheets[sheet_id] = tokens
+        for token, weight in tokens.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                insort(self.vocabulary, token)
+                for gram in trigrams(token):
+                    self.grams.setdefault(gram, set()).add(token)
+            self.postings[token][sheet_id] = weight
+
+    def remove(self, sheet_id: uuid.UUID):
+        for token in self.sheets.pop(sheet_id, {}):
+            postings = self.postings[token]
+            postings.pop(sheet_id, None)
+            if postings:
+                continue
+            del self.postings[token]
+            del self.vocabulary[bisect_left(self.vocabulary, token)]
+            for gram in trigrams(token):
+                self.grams[gram].discard(token)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+
+    def _matches(self, query: str) -> Dict[str, float]:
+        """Words in the index similar to ``query``, with their similarity."""
+        matches = {}
+        position = bisect_left(self.vocabulary, query)
+        while position < len(self.vocabulary) and self.vocabulary[position].startswith(
+            query
+        ):
+            token = self.vocabulary[position]
+            matches[token] = 0.8 + 0.2 * len(query) / len(token)
+            position += 1
+        if len(query) < 3:
+            return matches
+        query_grams = trigrams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self.grams.get(gram, ()))
+        for token, count in shared.items():
+            similarity = 2 * count / (len(query_grams) + len(trigrams(token)))
+            if similarity >= FUZZY_THRESHOLD:
+                matches[token] = max(matches.get(token, 0.0), similarity)
+        return matches
+
+    def search(self, terms: str, limit: int = SEARCH_MAX_RESULTS) -> List[uuid.UUID]:
+        """Sheets matching ``terms``, best first.
+
+        Sheets matching more of the query words come first, then those with
+        the higher sum of similarity times field boost.
+        """
+        scores = Counter()
+        matched = Counter()
+        for query in set(tokenize(terms)):
+            best = {}
+            for token, similarity in self._matches(query).items():
+                for sheet_id, weight in self.postings[token].items():
+                    best[sheet_id] = max(best.get(sheet_id, 0.0), similarity * weight)
+            scores.update(best)
+            matched.update(best.keys())
+        ranked = sorted(
+            scores, key=lambda sheet_id: (-matched[sheet_id], -scores[sheet_id])
+        )
+        return ranked[:limit]
+
+    def copy(self) -> "UserIndex":
+        index = UserIndex()
+        # Token weights are never changed once added, so they can be shared.
+        index.sheets = dict(self.sheets)
+        index.postings = {
+            token: dict(postings) for token, postings in self.postings.items()
+        }
+        index.grams = {gram: set(tokens) for gram, tokens in self.grams.items()}
+        index.vocabulary = list(self.vocabulary)
+        index.synced_at = self.synced_at
+        return index
+
+    def snapshot(self) -> dict:
+        return {
+            "version": SNAPSHOT_VERSION,
+            "sheets": {
+                str(sheet_id): tokens for sheet_id, tokens in self.sheets.items()
+            },
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "UserIndex":
+        index = cls()
+        if snapshot.get("version") == SNAPSHOT_VERSION:
+            for sheet_id, tokens in snapshot["sheets"].items():
+                index.add(uuid.UUID(sheet_id), tokens)
+        return index
+
+
+def _snapshot_path(owner_email: str) -> str:
+    name = hashlib.sha256(owner_email.encode()).hexdigest()
+    return os.path.join(SEARCH_INDEX_DIR, f"{name}.json")
+
+
+def _read_snapshot(owner_email: str) -> dict:
+    try:
+        with open(_snapshot_path(owner_email)) as snapshot_file:
+            return json.load(snapshot_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _index_dir() -> str:
+    os.makedirs(SEARCH_INDEX_DIR, mode=0o700, exist_ok=True)
+    # An existing directory keeps its owner and mode, which may not be ours.
+    info = os.stat(SEARCH_INDEX_DIR)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(
+            f"{SEARCH_INDEX_DIR} must be owned by this user and private to it"
+        )
+    return SEARCH_INDEX_DIR
+
+
+def _write_snapshot(owner_email: str, snapshot: dict):
+    directory = _index_dir()
+    path = _snapshot_path(owner_email)
+    # Other workers may read the file at any time, so swap it in whole.
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(snapshot_file.name, path)
+
+
+async def sync_index(owner_email: str, index: UserIndex) -> Optional[UserIndex]:
+    """A copy of ``index`` brought up to date with the database, or None if
+    it already matches.
+
+    Sheets are never edited in place, as every edit makes a new sheet id,
+    so comparing ids is enough to find what to add and remove. ``index``
+    itself is left alone, as searches may be using it meanwhile.
+    """
+    query = {"owner_email": owner_email, "current": True}
+    found = db.sheets.find(query, {"_id": 0, "sheet_id": 1})
+    current = {doc["sheet_id"] async for doc in found}
+    stale = set(index.sheets) - current
+    missing = current - set(index.sheets)
+    added = []
+    if missing:
+        found = db.sheets.find(
+            {**query, "sheet_id": {"$in": list(missing)}},
+            {"_id": 0, "sheet_id": 1, **{field: 1 for field in FIELD_BOOSTS}},
+        )
+        added = [doc async for doc in found]
+    if not (stale or missing):
+        return None
+    synced = index.copy()
+    for sheet_id in stale:
+        synced.remove(sheet_id)
+    for doc in added:
+        synced.add(doc["sheet_id"], sheet_tokens(doc))
+    return synced
+
+
+class IndexCache:
+    """Per-user search indexes kept in memory and evicted LRU.
+
+    A user's index starts from the snapshot on disk and is synced with the
+    database on first use and every SEARCH_SYNC_INTERVAL seconds after.
+    Writes in this worker are applied straight away.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._entries: "OrderedDict[str, UserIndex]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, owner_email: str) -> UserIndex:
+        index = self._entries.get(owner_email)
+        if index is not None:
+            self._entries.move_to_end(owner_email)
+            if time.monotonic() - index.synced_at <= SEARCH_SYNC_INTERVAL:
+                return index
+        load = self._loading.get(owner_email)
+        if load is None:
+            generation = self._generations.get(owner_email, 0)
+            load = asyncio.ensure_future(self._load(owner_email, index, generation))
+            self._loading[owner_email] = load
+            load.add_done_callback(lambda _: self._loading.pop(owner_email, None))
+        return await asyncio.shield(load)
+
+    async def _load(
+        self, owner_email: str, index: Optional[UserIndex], generation: int
+    ) -> UserIndex:
+        if index is None:
+            metrics.increment("search.index_loads")
+            snapshot = await run_in_threadpool(_read_snapshot, owner_email)
+            index = UserIndex.from_snapshot(snapshot)
+        synced = await sync_index(owner_email, index)
+        # A write during the sync may not be in what was read, and is
+        # already in the cached index, so leave that to be synced again.
+        if self._generations.get(owner_email, 0) != generation:
+            return synced or index
+        index = synced or index
+        index.synced_at = time.monotonic()
+        self._entries[owner_email] = index
+        self._entries.move_to_end(owner_email)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        if synced is not None:
+            await run_in_threadpool(_write_snapshot, owner_email, index.snapshot())
+        return index
+
+    def sheets_changed(
+        self,
+        owner_email: str,
+        removed: Iterable[uuid.UUID] = (),
+        added: Iterable[dict] = (),
+    ):
+        self._generations[owner_email] = self._generations.get(owner_email, 0) + 1
+        index = self._entries.get(owner_email)
+        if index is None:
+            return
+        for sheet_id in removed:
+            index.remove(sheet_id)
+        for doc in added:
+            index.add(doc["sheet_id"], sheet_tokens(doc))
+
+    def persist(self):
+        for owner_email, index in self._entries.items():
+            _write_snapshot(owner_email, index.snapshot())
+
+
+index_cache = IndexCache(SEARCH_INDEX_USERS)
+
+
+def text_search_query(owner_email: str, search_terms: str) -> dict:
+    return {
+        "owner_email": owner_email,
+        "current": True,
+        "$text": {"$search": search_terms},
+    }
+
+
+async def rank_with_text_index(owner_email: str, terms: str) -> List[uuid.UUID]:
+    score = {"$meta": "textScore"}
+    found = db.sheets.find(
+        text_search_query(owner_email, terms),
+        {"_id": 0, "sheet_id": 1, "score": score},
+        sort=[("score", score)],
+        limit=SEARCH_MAX_RESULTS,
+    )
+    return [doc["sheet_id"] async for doc in found]
+
+
+async def rank_with_search_index(owner_email: str, terms: str) -> List[uuid.UUID]:
+    index = await index_cache.get(owner_email)
+    return index.search(terms)
+
+
+SEARCH_BACKENDS = {"text": rank_with_text_index, "index": rank_with_search_index}
+
+
+async def rank(owner_email: str, terms: str) -> List[uuid.UUID]:
+    """Ids of the sheets matching ``terms``, best match first."""
+    with metrics.timed(f"search.{SEARCH_BACKEND}"):
+        return await SEARCH_BACKENDS[SEARCH_BACKEND](owner_email, terms)
+
+
+def sheets_changed(
+    owner_email: str, removed: Iterable[uuid.UUID] = (), added: Iterable[dict] = ()
+):
+    if SEARCH_BACKEND == "index":
+        index_cache.sheets_changed(owner_email, removed, added)
+
+
+def _position(ranked: List[uuid.UUID], cursor: str) -> int:
+    offset, sheet_id = decode_cursor(cursor)
+    if sheet_id in ranked:
+        return ranked.index(sheet_id)
+    try:
+        return int(offset)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid page cursor.")
+
+
+def ranked_pipeline(
+    owner_email: str,
+    ranked: List[uuid.UUID],
+    page_ids: List[uuid.UUID],
+    with_facets: bool = False,
+) -> List[dict]:
+    page = [{"$project": models.SUMMARY_PROJECTION}]
+    match = {"owner_email": owner_email, "current": True, "sheet_id": {"$in": page_ids}}
+    if not with_facets:
+        return [{"$match": match}, *page]
+    stages = {
+        "page": [{"$match": {"sheet_id": {"$in": page_ids}}}, *page],
+        "total": [{"$count": "count"}],
+    }
+    for field in FACET_FIELDS:
+        stages[field] = facet_stages(field)
+    match["sheet_id"] = {"$in": ranked}
+    return [{"$match": match}, {"$facet": stages}]
+
+
+async def ranked_page(
+    owner_email: str,
+    ranked: List[uuid.UUID],
+    limit: int = 20,
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    """One page of sheets in ranked order, with cursors that hold their
+    place in the ranking.
+
+    As with ``paged_query``, the total and facets only come with the first
+    page; later pages leave them None.
+    """
+    with_facets = with_facets and not (after or before)
+    if before:
+        end = _position(ranked, before)
+        start = max(end - limit, 0)
+    else:
+        start = _position(ranked, after) + 1 if after else 0
+        end = min(start + limit, len(ranked))
+    page_ids = ranked[start:end]
+    pipeline = ranked_pipeline(owner_email, ranked, page_ids, with_facets)
+    if with_facets:
+        result = (await db.sheets.aggregate(pipeline).to_list(1))[0]
+        docs = result["page"]
+    else:
+        result = {}
+        docs = await db.sheets.aggregate(pipeline).to_list(None)
+    by_id = {doc["sheet_id"]: doc for doc in docs}
+    items = [
+        models.SheetSummary.parse_obj(by_id[sheet_id])
+        for sheet_id in page_ids
+        if sheet_id in by_id
+    ]
+    total = facets = None
+    if with_facets:
+        total = result["total"][0]["count"] if result["total"] else 0
+        facets = {
+            field: [(bucket["_id"], bucket["count"]) for bucket in result[field]]
+            for field in FACET_FIELDS
+        }
+    has_next = page_ids and end < len(ranked)
+    return Page(
+        items,
+        encode_cursor(str(end - 1), page_ids[-1]) if has_next else None,
+        encode_cursor(str(start), page_ids[0]) if start > 0 and page_ids else None,
+        total,
+        facets,
+    )
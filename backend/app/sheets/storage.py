@@ -1,74 +1,458 @@
+import asyncio
+import datetime
+import fcntl
+import hashlib
 import logging
+import math
 import os
+import shutil
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, NamedTuple, AsyncIterator, Tuple, Dict, Optional
 from uuid import UUID
 
+import aiofiles
 import minio
 from fastapi import UploadFile
-from pdf2image import convert_from_bytes
+from minio.helpers import MIN_PART_SIZE
+from starlette.concurrency import run_in_threadpool
+from urllib3 import HTTPResponse
 
-from app.dependencies import minio_client
+from app import metrics
+from app.dependencies import minio_client, presign_client, MINIO_POOL_SIZE
+from app.sheets import models
 
 logger = logging.getLogger()
 
+PART_SIZE = max(int(os.getenv("MINIO_PART_SIZE", MIN_PART_SIZE)), MIN_PART_SIZE)
+CHUNK_SIZE = 32 * 1024
+PRESIGNED_URL_EXPIRY = datetime.timedelta(
+    seconds=int(os.getenv("MINIO_PRESIGNED_URL_EXPIRY", 300))
+)
+SHEET_CACHE_DIR = os.getenv("SHEET_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "smlib-cache"
+)
+# Total bytes kept on local disk; 0 turns the cache off.
+SHEET_CACHE_SIZE = int(os.getenv("SHEET_CACHE_SIZE", 512 * 1024 * 1024))
+SHEET_CACHE_MAX_OBJECT = int(os.getenv("SHEET_CACHE_MAX_OBJECT", SHEET_CACHE_SIZE // 8))
+
+# Every blocking MinIO call runs here, so at most MINIO_POOL_SIZE requests
+# compete for the client's MINIO_POOL_SIZE pooled connections.
+_executor = ThreadPoolExecutor(max_workers=MINIO_POOL_SIZE, thread_name_prefix="minio")
+
+
+async def _run(operation: str, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    try:
+        return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
+    finally:
+        metrics.record_timing(f"minio.{operation}", time.monotonic() - start)
+
+
+class UploadStats(NamedTuple):
+    object_name: str
+    size: int
+    parts: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Upload throughput in bytes per second."""
+        if not self.seconds:
+            return float(self.size)
+        return self.size / self.seconds
+
+
+def _put_file(bucket: str, object_name: str, file, content_type: str) -> int:
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    minio_client.put_object(
+        bucket, object_name, file, size, content_type=content_type, part_size=PART_SIZE
+    )
+    return size
+
+
+async def upload_stream(
+    upload: UploadFile,
+    object_name: str,
+    content_type: str = "application/octet-stream",
+) -> UploadStats:
+    """Stream an upload into MinIO.
+
+    put_object sends files larger than ``PART_SIZE`` as a multipart upload,
+    reading them a part at a time, so memory use doesn't grow with the file.
+    """
+    start = time.monotonic()
+    size = await _run(
+        "put_object",
+        _put_file,
+        os.getenv("MINIO_BUCKET_NAME"),
+        object_name,
+        upload.file,
+        content_type,
+    )
+    parts = math.ceil(size / PART_SIZE) if size > PART_SIZE else 1
+    return UploadStats(object_name, size, parts, time.monotonic() - start)
+
+
+async def iter_object(
+    response: HTTPResponse, chunk_size: int = CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Yield an object's body, always handing its connection back to the pool."""
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(_executor, response.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        response.close()
+        response.release_conn()
+
+
+async def iter_file(
+    file, offset: int = 0, length: int = None, chunk_size: int = CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Yield ``length`` bytes of an open aiofiles file starting at ``offset``,
+    closing it afterwards."""
+    try:
+        await file.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = await file.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        await file.close()
+
+
+async def ensure_bucket():
+    bucket = os.getenv("MINIO_BUCKET_NAME")
+    try:
+        if not await _run("bucket_exists", minio_client.bucket_exists, bucket):
+            await _run("make_bucket", minio_client.make_bucket, bucket)
+    except minio.ResponseError:
+        await _run("make_bucket", minio_client.make_bucket, bucket)
+
+
+def hash_file(fileobj) -> Tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(PART_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+
+def blob_prefix(blob_id: str) -> str:
+    return f"blobs/{blob_id[:2]}/{blob_id}"
+
+
+def legacy_object_name(sheet_id: UUID, owner_email: str, sheet_file_ext: str) -> str:
+    return f"{owner_email}/{sheet_id}.{sheet_file_ext}"
+
+
+def legacy_preview_name(sheet_id: UUID, owner_email: str) -> str:
+    return f"{owner_email}/{sheet_id}-preview.png"
+
+
+def sheet_object_name(sheet: models.Sheet) -> str:
+    if sheet.blob_id:
+        return blob_prefix(sheet.blob_id)
+    return legacy_object_name(sheet.sheet_id, sheet.owner_email, sheet.file_ext)
+
+
+def _derived_prefix(sheet: models.Sheet) -> str:
+    if sheet.blob_id:
+        return blob_prefix(sheet.blob_id)
+    return f"{sheet.owner_email}/{sheet.sheet_id}"
+
+
+def preview_object_name(sheet: models.Sheet, size: str, fmt: str) -> str:
+    return f"{_derived_prefix(sheet)}-preview-{size}.{fmt}"
+
+
+def page_object_name(sheet: models.Sheet, page_number: int, dpi: int, fmt: str) -> str:
+    return f"{_derived_prefix(sheet)}-page-{page_number}-{dpi}.{fmt}"
+
+
+async def find_object(object_name: str) -> Optional[minio.definitions.Object]:
+    """Stat an object, or return None if it isn't stored."""
+    try:
+        return await stat_object(object_name)
+    except minio.error.NoSuchKey:
+        return None
+
+
+async def object_exists(object_name: str) -> bool:
+    return await find_object(object_name) is not None
+
+
+async def hash_upload(sheet_file: UploadFile) -> Tuple[str, int]:
+    """SHA-256 digest and size of an upload, which name its blob."""
+    return await run_in_threadpool(hash_file, sheet_file.file)
+
 
 async def save_sheet(
-    sheet_file: UploadFile, sheet_id: UUID, owner_email: str, sheet_file_ext: str
+    sheet_file: UploadFile, blob_id: str, size: int, deduplicate: bool = True
 ):
-    tmp_sheet = tempfile.NamedTemporaryFile()
-    tmp_sheet.write(await sheet_file.read())
-    tmp_sheet.seek(0)
-    sheet_stats = os.stat(tmp_sheet.name)
-    # logger.debug(f"Sheet id for upload: {sheet_id}")
-    result = minio_client.put_object(
+    """Store an uploaded sheet as the blob ``blob_id``.
+
+    With ``deduplicate``, nothing is uploaded if the same bytes are already
+    stored. Callers must hold a reference to the blob first, so it can't be
+    removed between that check and the sheet being saved.
+    """
+    object_name = blob_prefix(blob_id)
+    if deduplicate and await object_exists(object_name):
+        metrics.increment("minio.deduplicated_bytes", size)
+        logger.debug(f"{object_name} already stored, skipping upload")
+        return
+    stats = await upload_stream(
+        sheet_file,
+        object_name,
+        content_type=sheet_file.content_type or "application/octet-stream",
+    )
+    metrics.increment("minio.uploaded_bytes", stats.size)
+    logger.debug(
+        f"Uploaded {stats.object_name}: {stats.size} bytes in {stats.parts} parts, "
+        f"{stats.seconds:.2f}s ({stats.throughput / 1024 / 1024:.2f} MiB/s)"
+    )
+
+
+async def remove_blob(blob_id: str):
+    """Remove a blob and every derived object stored beside it."""
+    bucket = os.getenv("MINIO_BUCKET_NAME")
+
+    def remove_all():
+        for item in minio_client.list_objects(bucket, prefix=blob_prefix(blob_id)):
+            minio_client.remove_object(bucket, item.object_name)
+
+    await _run("remove_blob", remove_all)
+    sheet_cache.discard_prefix(blob_prefix(blob_id))
+
+
+async def stat_object(object_name: str) -> minio.definitions.Object:
+    return await _run(
+        "stat_object",
+        minio_client.stat_object,
         os.getenv("MINIO_BUCKET_NAME"),
-        f"{owner_email}/{sheet_id}.{sheet_file_ext}",
-        tmp_sheet,
-        sheet_stats.st_size,
+        object_name,
     )
-    logger.debug(result)
-    if sheet_file_ext.lower() == "pdf":
-        tmp_sheet.seek(0)
-        images = convert_from_bytes(
-            tmp_sheet.read(),
-            dpi=50,
-            use_cropbox=True,
-            first_page=1,
-            last_page=1,
-            grayscale=True,
-        )
-        tmp_preview = tempfile.NamedTemporaryFile()
-        images[0].save(tmp_preview, format="PNG")
-        tmp_preview.seek(0)
-        preview_stats = os.stat(tmp_preview.name)
-        preview_result = minio_client.put_object(
-            os.getenv("MINIO_BUCKET_NAME"),
-            f"{owner_email}/{sheet_id}-preview.png",
-            tmp_preview,
-            preview_stats.st_size,
-        )
-        logger.debug(preview_result)
-        tmp_preview.close()
-    tmp_sheet.close()
 
 
-def get_sheet(sheet_id: UUID, owner_email: str, sheet_file_ext: str):
-    return minio_client.get_object(
-        os.getenv("MINIO_BUCKET_NAME"), f"{owner_email}/{sheet_id}.{sheet_file_ext}"
+async def get_object(
+    object_name: str, offset: int = 0, length: int = 0
+) -> HTTPResponse:
+    """Open an object, or ``length`` bytes of it starting at ``offset``."""
+    return await _run(
+        "get_object",
+        minio_client.get_partial_object,
+        os.getenv("MINIO_BUCKET_NAME"),
+        object_name,
+        offset,
+        length,
     )
 
 
-def get_preview(sheet_id: UUID, owner_email: str):
-    return minio_client.get_object(
-        os.getenv("MINIO_BUCKET_NAME"), f"{owner_email}/{sheet_id}-preview.png"
+async def copy_legacy_sheet(old_sheet: models.Sheet, new_sheet_id: UUID):
+    """Copy an object stored before sheets were content addressed."""
+    await _run(
+        "copy_object",
+        minio_client.copy_object,
+        os.getenv("MINIO_BUCKET_NAME"),
+        legacy_object_name(new_sheet_id, old_sheet.owner_email, old_sheet.file_ext),
+        f"/{os.getenv('MINIO_BUCKET_NAME')}/" + sheet_object_name(old_sheet),
     )
 
 
-def copy_sheet(
-    old_sheet_id: UUID, new_sheet_id: UUID, owner_email: str, sheet_file_ext: str
-):
-    minio_client.copy_object(
+async def presigned_url(object_name: str, response_headers: dict = None) -> str:
+    """Short-lived GET URL for an object, for redirecting clients to MinIO."""
+    return await _run(
+        "presigned_get_object",
+        presign_client.presigned_get_object,
         os.getenv("MINIO_BUCKET_NAME"),
-        f"{owner_email}/{new_sheet_id}.{sheet_file_ext}",
-        f"/{os.getenv('MINIO_BUCKET_NAME')}/{owner_email}/{old_sheet_id}.{sheet_file_ext}",
+        object_name,
+        expires=PRESIGNED_URL_EXPIRY,
+        response_headers=response_headers,
     )
+
+
+def _in_use(directory: str) -> bool:
+    with open(os.path.join(directory, ".lock"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def private_directory(parent: str) -> Tuple[str, IO]:
+    """Make a directory under ``parent`` for this process alone.
+
+    Returns it with the open lock file that marks it in use; the lock goes
+    when the process does, however it exits. Directories nobody holds the
+    lock of were left by processes that crashed or were killed, and are
+    removed first.
+    """
+    os.makedirs(parent, mode=0o700, exist_ok=True)
+    # Processes starting together take turns, so none removes a directory
+    # another has made but not locked yet.
+    with open(os.path.join(parent, ".lock"), "a") as parent_lock:
+        fcntl.flock(parent_lock, fcntl.LOCK_EX)
+        for entry in os.scandir(parent):
+            if entry.is_dir(follow_symlinks=False) and not _in_use(entry.path):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                metrics.increment("cache.stale_directories")
+        directory = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=parent)
+        lock = open(os.path.join(directory, ".lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return directory, lock
+
+
+class CachedObject(NamedTuple):
+    path: Optional[str]
+    size: int
+    etag: str
+    content_type: str
+
+
+class DiskCache:
+    """Size-bounded LRU copy of MinIO objects on local disk.
+
+    Object names never change content, so entries only go stale when the
+    object is deleted. Each process keeps its own directory under
+    ``parent``, made on first use.
+    """
+
+    def __init__(self, parent: str, max_bytes: int, max_object_bytes: int):
+        self.parent = parent
+        self.directory: Optional[str] = None
+        self._lock: Optional[IO] = None
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, CachedObject]" = OrderedDict()
+        self._fetching: Dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __contains__(self, object_name: str) -> bool:
+        return object_name in self._entries
+
+    def _path(self, object_name: str) -> str:
+        if self.directory is None:
+            self.directory, self._lock = private_directory(self.parent)
+        return os.path.join(
+            self.directory, hashlib.sha256(object_name.encode()).hexdigest()
+        )
+
+    async def get(
+        self, object_name: str, stat: minio.definitions.Object = None
+    ) -> CachedObject:
+        """Look up an object, downloading it on a miss.
+
+        Concurrent misses for the same object share one download. Objects
+        too large to cache come back with no path. A ``stat`` the caller
+        already has saves asking MinIO again.
+        """
+        entry = self._entries.get(object_name)
+        if entry is not None:
+            self._entries.move_to_end(object_name)
+            metrics.increment("cache.hits")
+            return entry
+        metrics.increment("cache.misses")
+        fetch = self._fetching.get(object_name)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch(object_name, stat))
+            self._fetching[object_name] = fetch
+            fetch.add_done_callback(lambda _: self._fetching.pop(object_name, None))
+        return await asyncio.shield(fetch)
+
+    async def _fetch(
+        self, object_name: str, stat: Optional[minio.definitions.Object]
+    ) -> CachedObject:
+        stat = stat or await stat_object(object_name)
+        if stat.size > self.max_object_bytes:
+            return CachedObject(None, stat.size, stat.etag, stat.content_type)
+        path = self._path(object_name)
+        await _run(
+            "fget_object",
+            minio_client.fget_object,
+            os.getenv("MINIO_BUCKET_NAME"),
+            object_name,
+            path,
+        )
+        entry = CachedObject(path, stat.size, stat.etag, stat.content_type)
+        self._entries[object_name] = entry
+        self.size += entry.size
+        self._evict()
+        return entry
+
+    async def open(self, object_name: str, entry: CachedObject):
+        """Open the local copy of an object, or return None if it has gone.
+
+        An open copy stays readable after eviction deletes it, so responses
+        open theirs before they start sending.
+        """
+        try:
+            return await aiofiles.open(entry.path, "rb")
+        except FileNotFoundError:
+            if self._entries.get(object_name) == entry:
+                self._remove(object_name)
+            metrics.increment("cache.vanished")
+            return None
+
+    def _remove(self, object_name: str):
+        entry = self._entries.pop(object_name)
+        self.size -= entry.size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            metrics.increment("cache.evictions")
+
+    def discard_prefix(self, prefix: str):
+        for object_name in [name for name in self._entries if name.startswith(prefix)]:
+            self._remove(object_name)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._lock.close()
+            self.directory = self._lock = None
+
+
+sheet_cache = DiskCache(
+    os.path.join(SHEET_CACHE_DIR, "objects"), SHEET_CACHE_SIZE, SHEET_CACHE_MAX_OBJECT
+)
+
+
+async def cached_object(
+    object_name: str, stat: minio.definitions.Object = None
+) -> CachedObject:
+    """Size and validators of an object, with a local copy when cached.
+
+    Pass ``stat`` if the object was just looked up, to skip a second stat.
+    """
+    if sheet_cache.enabled:
+        return await sheet_cache.get(object_name, stat)
+    stat = stat or await stat_object(object_name)
+    return CachedObject(None, stat.size, stat.etag, stat.content_type)
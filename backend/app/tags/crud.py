@@ -1,5 +1,9 @@
+from typing import List, Tuple
+
+from app import taxonomy
 from app.dependencies import db
-from app.sheets.models import SheetOut
+from app.pagination import FACET_FIELDS, Page, paged_query
+from app.sheets.models import SheetSummary, SUMMARY_PROJECTION
 
 
 def get_tag_query(owner_email, tag_name):
@@ -10,33 +14,30 @@ def get_tag_query(owner_email, tag_name):
     }
 
 
-async def get_all_tags(email: str):
-    return await db.sheets.distinct("tags", {"owner_email": email, "current": True})
+async def get_all_tags(email: str, sort: str = "name") -> List[Tuple[str, int]]:
+    return await taxonomy.get_terms(email, "tags", sort)
 
 
 async def get_tag_sheets(
     owner_email: str,
     tag_name: str,
     limit: int = 20,
-    page: int = 1,
     sort: str = "piece",
     direction: int = 1,
-):
-    skip = limit * (page - 1)
-    cursor = db.sheets.find(
+    after: str = None,
+    before: str = None,
+    with_facets: bool = False,
+) -> Page:
+    return await paged_query(
+        db.sheets,
         get_tag_query(owner_email, tag_name),
-        limit=limit,
-        skip=skip,
-        sort=[(sort, direction)],
-    )
-    return [SheetOut.parse_obj(sheet) async for sheet in cursor]
-
-
-async def tag_sheets_has_next(
-    owner_email: str, tag_name: str, limit: int = 20, page: int = 1
-):
-    skip = limit * page
-    count = await db.sheets.count_documents(
-        get_tag_query(owner_email, tag_name), limit=1, skip=skip
+        sort,
+        direction,
+        limit,
+        after,
+        before,
+        parse=SheetSummary.parse_obj,
+        projection=SUMMARY_PROJECTION,
+        with_total=with_facets,
+        facets=FACET_FIELDS if with_facets else (),
     )
-    return count > 0
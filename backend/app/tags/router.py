@@ -20,25 +20,32 @@ async def get_single_tag(
     request: Request,
     tag_name: str,
     current_user: UserInDB = Depends(get_current_active_user),
-    page: int = Query(1),
     sort: str = Query("piece"),
     direction: int = Query(1),
+    after: str = Query(None),
+    before: str = Query(None),
 ):
     limit = int(os.getenv("SHEETS_PER_PAGE", 20))
-    prev_page, next_page = util.get_next_prev_page_urls(request.url, page)
-    sheets = await crud.get_tag_sheets(
-        current_user.email, tag_name, limit, page, sort, direction
+    page = await crud.get_tag_sheets(
+        current_user.email,
+        tag_name,
+        limit,
+        sort,
+        direction,
+        after,
+        before,
+        with_facets=True,
     )
-    if not await crud.tag_sheets_has_next(current_user.email, tag_name, limit, page):
-        next_page = None
+    prev_page, next_page = util.get_page_urls(request.url, page)
     return templates.TemplateResponse(
         "list.html",
         {
             "request": request,
-            "page": page,
             "sort": sort,
             "direction": direction,
-            "sheets": sheets,
+            "sheets": page.items,
+            "total": page.total,
+            "facets": page.facets,
             "next_page": next_page,
             "prev_page": prev_page,
             "sort_links": util.get_sort_links(request.url, sort, direction),
@@ -49,9 +56,12 @@ async def get_single_tag(
 
 @tag_router.get("")
 async def get_tags(
-    request: Request, current_user: UserInDB = Depends(get_current_active_user)
+    request: Request,
+    current_user: UserInDB = Depends(get_current_active_user),
+    sort: str = Query("name"),
 ):
-    tags = await crud.get_all_tags(current_user.email)
+    tags = await crud.get_all_tags(current_user.email, sort)
     return templates.TemplateResponse(
-        "tags/all.html", {"request": request, "tags": sorted(tags), "title": "All Tags"}
+        "tags/all.html",
+        {"request": request, "tags": tags, "sort": sort, "title": "All Tags"},
     )
@@ -0,0 +1,134 @@
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import pymongo
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+from app.dependencies import db
+
+TAXONOMY_FIELDS = ("tags", "composers", "instruments", "genre")
+TERM_SORTS = {
+    "name": [("name", pymongo.ASCENDING)],
+    "count": [("count", pymongo.DESCENDING), ("name", pymongo.ASCENDING)],
+}
+
+
+def sheet_terms(sheet: dict) -> Counter:
+    """The (field, name) pairs a sheet counts towards, each at most once."""
+    terms = Counter()
+    for field in TAXONOMY_FIELDS:
+        values = sheet.get(field)
+        if not isinstance(values, list):
+            values = [values]
+        terms.update((field, value) for value in set(values) if value)
+    return terms
+
+
+def term_changes(removed: Iterable[dict] = (), added: Iterable[dict] = ()) -> Counter:
+    """How each count moves when ``removed`` sheets stop being current and
+    ``added`` ones start."""
+    changes = Counter()
+    for sheet in removed:
+        changes.subtract(sheet_terms(sheet))
+    for sheet in added:
+        changes.update(sheet_terms(sheet))
+    return Counter({term: count for term, count in changes.items() if count})
+
+
+def term_updates(owner_email: str, changes: Counter) -> List[UpdateOne]:
+    return [
+        UpdateOne(
+            {"owner_email": owner_email, "field": field, "name": name},
+            {"$inc": {"count": count}},
+            upsert=True,
+        )
+        for (field, name), count in changes.items()
+    ]
+
+
+def unused_terms_query(owner_email: str, changes: Counter) -> dict:
+    return {
+        "owner_email": owner_email,
+        "field": {"$in": sorted({field for field, _ in changes})},
+        "count": {"$lte": 0},
+    }
+
+
+async def apply_term_changes(owner_email: str, changes: Counter, session=None):
+    if not changes:
+        return
+    await db.taxonomy.bulk_write(
+        term_updates(owner_email, changes), ordered=False, session=session
+    )
+    await db.taxonomy.delete_many(
+        unused_terms_query(owner_email, changes), session=session
+    )
+
+
+def terms_query(owner_email: str, field: str) -> dict:
+    return {"owner_email": owner_email, "field": field}
+
+
+async def get_terms(
+    owner_email: str, field: str, sort: str = "name"
+) -> List[Tuple[str, int]]:
+    """Every name in use for ``field`` with its number of current sheets."""
+    if sort not in TERM_SORTS:
+        raise HTTPException(status_code=400, detail=f"Can't sort by {sort}.")
+    found = db.taxonomy.find(
+        terms_query(owner_email, field),
+        {"_id": 0, "name": 1, "count": 1},
+        sort=TERM_SORTS[sort],
+    )
+    return [(doc["name"], doc["count"]) async for doc in found]
+
+
+def rebuild_pipeline(collection: str = "taxonomy") -> List[dict]:
+    """Count every current sheet's terms and replace ``collection`` with them."""
+    terms = [
+        {
+            "$map": {
+                "input": {
+                    "$setUnion": [
+                        {
+                            "$cond": [
+                                {"$isArray": f"${field}"},
+                                f"${field}",
+                                [f"${field}"],
+                            ]
+                        }
+                    ]
+                },
+                "as": "name",
+                "in": {"field": field, "name": "$$name"},
+            }
+        }
+        for field in TAXONOMY_FIELDS
+    ]
+    return [
+        {"$match": {"current": True}},
+        {"$project": {"owner_email": 1, "terms": {"$concatArrays": terms}}},
+        {"$unwind": "$terms"},
+        {"$match": {"terms.name": {"$nin": [None, ""]}}},
+        {
+            "$group": {
+                "_id": {
+                    "owner_email": "$owner_email",
+                    "field": "$terms.field",
+                    "name": "$terms.name",
+                },
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "owner_email": "$_id.owner_email",
+                "field": "$_id.field",
+                "name": "$_id.name",
+                "count": 1,
+            }
+        },
+        {"$out": collection},
+    ]
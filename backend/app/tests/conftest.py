@@ -1,5 +1,7 @@
+import asyncio
 import os
 import uuid
+from collections import Counter
 from urllib.parse import quote_plus
 
 import pymongo
@@ -8,9 +10,66 @@ from motor import motor_asyncio
 
 from starlette.testclient import TestClient
 
+from app import rate_limit
+from app.auth.cache import user_cache
 from app.main import app
 
 
+class FakeCursor:
+    """Found documents, read the way Motor cursors are."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        await asyncio.sleep(0)
+        return self.docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeTaxonomy:
+    """Term counts kept in a Counter keyed by (owner, field, name)."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        for request in requests:
+            query, update = request._filter, request._doc
+            key = (query["owner_email"], query["field"], query["name"])
+            self.counts[key] += update["$inc"]["count"]
+
+    async def delete_many(self, query, session=None):
+        for key, count in list(self.counts.items()):
+            if key[0] == query["owner_email"] and count <= 0:
+                del self.counts[key]
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    """Each test gets its own database, so users cached by another test
+    would be stale."""
+    user_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def isolated_rate_limits(monkeypatch):
+    """Login tests share emails, so buckets kept in Redis between tests (and
+    runs) would turn them away."""
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKEND", "memory")
+    monkeypatch.setattr(
+        rate_limit,
+        "memory_buckets",
+        rate_limit.MemoryBuckets(rate_limit.MEMORY_BUCKETS),
+    )
+
+
 @pytest.fixture
 def db_name():
     return str(uuid.uuid4())
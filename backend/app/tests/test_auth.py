@@ -1,3 +1,4 @@
+import asyncio
 import os
 import secrets
 
@@ -108,7 +109,9 @@ def test_confirm_login(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    otp = asyncio.get_event_loop().run_until_complete(
+        security.generate_otp(user1["email"])
+    )
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -122,7 +125,9 @@ def test_confirm_login_wrong_code_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    _otp = security.generate_otp(user1["email"])
+    _otp = asyncio.get_event_loop().run_until_complete(
+        security.generate_otp(user1["email"])
+    )
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": "123456"}
@@ -136,7 +141,9 @@ def test_confirm_login_wrong_email_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    otp = asyncio.get_event_loop().run_until_complete(
+        security.generate_otp(user1["email"])
+    )
 
     response = test_client.post(
         "/auth/confirm", json={"email": "fail@rickhenry.dev", "code": otp}
@@ -150,7 +157,9 @@ def test_confirm_magic(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    magic_url = asyncio.get_event_loop().run_until_complete(
+        security.generate_magic_link(user1["email"])
+    )
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic", json={"email": user1["email"], "secret": url_secret}
@@ -164,7 +173,9 @@ def test_confirm_magic_wrong_email_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    magic_url = asyncio.get_event_loop().run_until_complete(
+        security.generate_magic_link(user1["email"])
+    )
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic",
@@ -179,7 +190,9 @@ def test_confirm_magic_wrong_secret_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    magic_url = asyncio.get_event_loop().run_until_complete(
+        security.generate_magic_link(user1["email"])
+    )
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic", json={"email": user1["email"], "secret": "123456789"}
@@ -193,7 +206,9 @@ def test_logged_in_get_user_info(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    otp = asyncio.get_event_loop().run_until_complete(
+        security.generate_otp(user1["email"])
+    )
 
     _response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -217,7 +232,9 @@ def test_log_out(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    otp = asyncio.get_event_loop().run_until_complete(
+        security.generate_otp(user1["email"])
+    )
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -0,0 +1,129 @@
+import asyncio
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.autocomplete import prefixes
+from app.tests.conftest import FakeCursor
+
+
+class FakeTaxonomy:
+    def __init__(self, docs):
+        self.docs = docs
+        self.loads = 0
+
+    def find(self, query, projection=None):
+        self.loads += 1
+        return FakeCursor(
+            [doc for doc in self.docs if doc["owner_email"] == query["owner_email"]]
+        )
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.taxonomy = FakeTaxonomy(docs)
+
+
+def term(owner_email, field, name, count):
+    return {"owner_email": owner_email, "field": field, "name": name, "count": count}
+
+
+def test_search_matches_word_prefixes_most_used_first():
+    index = prefixes.PrefixIndex(
+        [("Johann Sebastian Bach", 3), ("Carl Philipp Emanuel Bach", 5), ("Bartok", 1)]
+    )
+
+    assert index.search("ba", 10) == [
+        ("Carl Philipp Emanuel Bach", 5),
+        ("Johann Sebastian Bach", 3),
+        ("Bartok", 1),
+    ]
+    assert index.search("SEB", 10) == [("Johann Sebastian Bach", 3)]
+    assert index.search("bach", 1) == [("Carl Philipp Emanuel Bach", 5)]
+    assert index.search("x", 10) == []
+
+
+def test_users_are_loaded_once_and_evicted_lru(monkeypatch: MonkeyPatch):
+    fake_db = FakeDB(
+        [term("a@b.com", "tags", "baroque", 2), term("c@d.com", "tags", "jazz", 1)]
+    )
+    monkeypatch.setattr("app.autocomplete.prefixes.db", fake_db)
+    cache = prefixes.PrefixCache(max_users=1)
+    loop = asyncio.get_event_loop()
+
+    first, second = loop.run_until_complete(
+        asyncio.gather(cache.get("a@b.com"), cache.get("a@b.com"))
+    )
+    assert first is second
+    assert first.fields["tags"].search("b", 10) == [("baroque", 2)]
+    loop.run_until_complete(cache.get("c@d.com"))
+    loop.run_until_complete(cache.get("a@b.com"))
+
+    assert fake_db.taxonomy.loads == 3
+
+
+def test_invalidate_during_load_is_not_cached(monkeypatch: MonkeyPatch):
+    fake_db = FakeDB([term("a@b.com", "composers", "Bach", 1)])
+    monkeypatch.setattr("app.autocomplete.prefixes.db", fake_db)
+    cache = prefixes.PrefixCache(max_users=10)
+    loop = asyncio.get_event_loop()
+
+    async def load_then_write():
+        load = asyncio.ensure_future(cache.get("a@b.com"))
+        await asyncio.sleep(0)
+        cache.invalidate("a@b.com")
+        await load
+
+    loop.run_until_complete(load_then_write())
+    loop.run_until_complete(cache.get("a@b.com"))
+
+    assert fake_db.taxonomy.loads == 2
+
+
+def test_busy_prefixes_are_ranked_by_count(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(prefixes, "MAX_SCAN", 2)
+    index = prefixes.PrefixIndex(
+        [("Bach", 1), ("Bartok", 2), ("Beethoven", 9), ("Brahms", 4), ("Chopin", 8)]
+    )
+
+    assert index.search("b", 2) == [("Beethoven", 9), ("Brahms", 4)]
+    assert index.search("", 1) == [("Beethoven", 9)]
+    assert index.search("ba", 10) == [("Bartok", 2), ("Bach", 1)]
+
+
+def test_finished_load_keeps_newer_load(monkeypatch: MonkeyPatch):
+    loop = asyncio.get_event_loop()
+    gates = [loop.create_future(), loop.create_future()]
+    loads = []
+
+    class GatedCursor:
+        async def to_list(self, length):
+            loads.append(length)
+            if len(loads) <= len(gates):
+                return await gates[len(loads) - 1]
+            return []
+
+    class GatedDB:
+        class taxonomy:
+            @staticmethod
+            def find(query, projection=None):
+                return GatedCursor()
+
+    monkeypatch.setattr("app.autocomplete.prefixes.db", GatedDB)
+    cache = prefixes.PrefixCache(max_users=10)
+
+    async def reload_during_load():
+        first = asyncio.ensure_future(cache.get("a@b.com"))
+        await asyncio.sleep(0)
+        cache.invalidate("a@b.com")
+        second = asyncio.ensure_future(cache.get("a@b.com"))
+        await asyncio.sleep(0)
+        gates[0].set_result([])
+        await first
+        third = asyncio.ensure_future(cache.get("a@b.com"))
+        await asyncio.sleep(0)
+        gates[1].set_result([])
+        await asyncio.gather(second, third)
+
+    loop.run_until_complete(reload_during_load())
+
+    assert len(loads) == 2
@@ -0,0 +1,13 @@
+from app import indexes
+from app.sheets import models
+
+
+def test_every_sortable_field_is_indexed():
+    for field in models.Sheet.sortable_fields():
+        assert indexes.sort_is_indexed("sheets", field, 1)
+        assert indexes.sort_is_indexed("sheets", field, -1)
+
+
+def test_unknown_sorts_are_not_indexed():
+    assert not indexes.sort_is_indexed("sheets", "owner_email", 1)
+    assert not indexes.sort_is_indexed("sheets", "piece", 2)
@@ -0,0 +1,50 @@
+import asyncio
+
+from app.auth import security
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_hmac_is_the_default_and_verifies():
+    secret_hash = run(security.hash_secret("12345678"))
+
+    assert secret_hash.startswith(security.HMAC_PREFIX)
+    assert run(security.verify_secret("12345678", secret_hash.encode()))
+    assert not run(security.verify_secret("12345679", secret_hash))
+
+
+def test_bcrypt_hashes_still_verify():
+    secret_hash = run(security.hash_secret("12345678", "bcrypt"))
+
+    assert secret_hash.startswith("$2")
+    assert run(security.verify_secret("12345678", secret_hash.encode()))
+    assert not run(security.verify_secret("12345679", secret_hash))
+
+
+class FakeStore:
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, expire=None):
+        self.values[key] = value.encode()
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def delete_if_equal(self, key, value):
+        if self.values.get(key) != value:
+            return False
+        del self.values[key]
+        return True
+
+
+def test_wrong_code_leaves_otp_usable(monkeypatch):
+    monkeypatch.setattr(security, "redis_store", FakeStore())
+    code = run(security.generate_otp("a@b.com"))
+    wrong = "0" * 8 if code != "0" * 8 else "1" * 8
+
+    assert not run(security.verify_otp("a@b.com", wrong))
+    assert run(security.verify_otp("a@b.com", code))
+    assert not run(security.verify_otp("a@b.com", code))
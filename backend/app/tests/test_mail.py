@@ -0,0 +1,92 @@
+import asyncio
+
+from _pytest.monkeypatch import MonkeyPatch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from fastapi import HTTPException
+
+from app import mail, metrics
+
+
+class FakeMailgun:
+    """Answers with each of ``statuses`` in turn, then 200."""
+
+    def __init__(self, *statuses: int):
+        self.statuses = list(statuses)
+        self.messages = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.messages.append(dict(await request.post()))
+        assert request.headers["Authorization"].startswith("Basic ")
+        status = self.statuses.pop(0) if self.statuses else 200
+        return web.Response(status=status)
+
+    def server(self) -> TestServer:
+        app = web.Application()
+        app.router.add_post("/messages", self.handle)
+        return TestServer(app)
+
+
+def send_through(mailgun: FakeMailgun, *messages: dict) -> mail.MailQueue:
+    async def run():
+        server = mailgun.server()
+        await server.start_server()
+        outbox = mail.MailQueue(str(server.make_url("/messages")), "key", 2, 10)
+        try:
+            for message in messages:
+                outbox.put(message)
+            assert outbox.depth == len(messages)
+            await outbox.stop()
+        finally:
+            await server.close()
+        return outbox
+
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_queued_email_is_sent(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr("app.metrics.counters", metrics.defaultdict(int))
+    mailgun = FakeMailgun()
+
+    send_through(mailgun, {"to": "a@b.com", "subject": "Hi"})
+
+    assert mailgun.messages == [{"to": "a@b.com", "subject": "Hi"}]
+    assert metrics.counters["mail.sent"] == 1
+
+
+def test_server_errors_are_retried(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr("app.mail.MAIL_RETRY_DELAY", 0.01)
+    monkeypatch.setattr("app.metrics.counters", metrics.defaultdict(int))
+    mailgun = FakeMailgun(503, 429)
+
+    send_through(mailgun, {"to": "a@b.com"})
+
+    assert len(mailgun.messages) == 3
+    assert metrics.counters["mail.retries"] == 2
+    assert metrics.counters["mail.sent"] == 1
+
+
+def test_rejected_email_is_not_retried(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr("app.metrics.counters", metrics.defaultdict(int))
+    mailgun = FakeMailgun(400)
+
+    send_through(mailgun, {"to": "a@b.com"})
+
+    assert len(mailgun.messages) == 1
+    assert metrics.counters["mail.failed"] == 1
+
+
+def test_full_queue_is_refused():
+    async def run():
+        outbox = mail.MailQueue("http://127.0.0.1:9/messages", "key", 1, 1)
+        outbox.put({"to": "a@b.com"})
+        try:
+            outbox.put({"to": "c@d.com"})
+        except HTTPException as err:
+            return err.status_code
+        finally:
+            for task in outbox._tasks:
+                task.cancel()
+            await outbox._session.close()
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 503
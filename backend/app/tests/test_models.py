@@ -0,0 +1,32 @@
+import datetime
+import uuid
+
+from app.sheets import models
+
+
+def test_summary_projection_skips_history():
+    assert "prev_versions" not in models.SUMMARY_PROJECTION
+    assert models.SUMMARY_PROJECTION["sort_keys"] == 1
+    assert models.SUMMARY_PROJECTION["_id"] == 0
+
+
+def test_summary_parses_projected_document():
+    sheet = models.SheetInDB(
+        piece="Rondo",
+        composers=["Mozart"],
+        tags=["classical"],
+        owner_email="a@b.com",
+        sheet_id=uuid.uuid4(),
+        file_ext="pdf",
+        prev_versions=[(uuid.uuid4(), datetime.datetime.now())],
+    )
+    doc = {
+        field: value
+        for field, value in sheet.dict().items()
+        if field in models.SUMMARY_PROJECTION
+    }
+    summary = models.SheetSummary.parse_obj(doc)
+
+    assert summary.sheet_id == sheet.sheet_id
+    assert summary.composers == ["Mozart"]
+    assert summary.preview_status == "READY"
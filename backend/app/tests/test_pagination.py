@@ -0,0 +1,153 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from app import pagination
+from app.sheets import models
+
+
+def test_cursor_round_trip():
+    sheet_id = uuid.uuid4()
+    cursor = pagination.encode_cursor("Bach, Handel", sheet_id)
+
+    assert "=" not in cursor
+    assert pagination.decode_cursor(cursor) == ("Bach, Handel", sheet_id)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "bm90IGpzb24", "WzFd"])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as err:
+        pagination.decode_cursor(cursor)
+    assert err.value.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "direction,forward,operator",
+    [(1, True, "$gt"), (1, False, "$lt"), (-1, True, "$lt"), (-1, False, "$gt")],
+)
+def test_keyset_filter(direction, forward, operator):
+    sheet_id = uuid.uuid4()
+    cursor = pagination.encode_cursor("Rondo", sheet_id)
+    query = pagination.keyset_filter(
+        {"owner_email": "a@b.com"}, "piece", direction, cursor, forward
+    )
+
+    assert query["owner_email"] == "a@b.com"
+    assert query["$or"] == [
+        {"sort_keys.piece": {operator: "Rondo"}},
+        {"sort_keys.piece": "Rondo", "sheet_id": {operator: sheet_id}},
+    ]
+
+
+def test_sort_keys_are_scalar():
+    sheet = models.SheetInDB(
+        piece="Rondo",
+        composers=["Mozart", "Haydn"],
+        tags=None,
+        owner_email="a@b.com",
+        sheet_id=uuid.uuid4(),
+        file_ext="pdf",
+    )
+    sheet.set_sort_keys()
+
+    assert sheet.sort_keys["composers"] == "Mozart, Haydn"
+    assert sheet.sort_keys["tags"] == ""
+    assert sheet.sort_keys["piece"] == "Rondo"
+
+
+def make_docs(count, **fields):
+    return [
+        {
+            "owner_email": "a@b.com",
+            "sheet_id": uuid.UUID(int=number),
+            "sort_keys": {"piece": f"piece {number}"},
+            **fields,
+        }
+        for number in range(count)
+    ]
+
+
+def test_page_pipeline_fetches_one_extra_row():
+    pipeline = pagination.build_pipeline({"owner_email": "a@b.com"}, limit=2)
+
+    assert [next(iter(stage)) for stage in pipeline] == ["$match", "$sort", "$limit"]
+    assert pipeline[-1] == {"$limit": 3}
+
+
+def test_paged_query_pages_by_cursor(async_db):
+    run = asyncio.get_event_loop().run_until_complete
+    run(async_db.sheets.insert_many(make_docs(3)))
+
+    page = run(
+        pagination.paged_query(async_db.sheets, {"owner_email": "a@b.com"}, limit=2)
+    )
+
+    assert [doc["sheet_id"].int for doc in page.items] == [0, 1]
+    assert page.next_cursor == pagination.encode_cursor("piece 1", uuid.UUID(int=1))
+    assert page.prev_cursor is None
+    assert page.total is None
+    last = run(
+        pagination.paged_query(
+            async_db.sheets,
+            {"owner_email": "a@b.com"},
+            limit=2,
+            after=page.next_cursor,
+        )
+    )
+    assert [doc["sheet_id"].int for doc in last.items] == [2]
+    assert last.next_cursor is None
+    assert last.prev_cursor == pagination.encode_cursor("piece 2", uuid.UUID(int=2))
+
+
+def test_first_page_counts_matches_and_facets(async_db):
+    run = asyncio.get_event_loop().run_until_complete
+    docs = make_docs(3, genre="Baroque")
+    docs[0]["instruments"] = ["Violin"]
+    docs[2]["owner_email"] = "c@d.com"
+    run(async_db.sheets.insert_many(docs))
+
+    page = run(
+        pagination.paged_query(
+            async_db.sheets,
+            {"owner_email": "a@b.com"},
+            limit=2,
+            with_total=True,
+            facets=("genre", "instruments"),
+        )
+    )
+
+    assert page.next_cursor is None
+    assert page.total == 2
+    assert page.facets == {"genre": [("Baroque", 2)], "instruments": [("Violin", 1)]}
+
+
+def test_later_pages_skip_counts(async_db):
+    run = asyncio.get_event_loop().run_until_complete
+    run(async_db.sheets.insert_many(make_docs(3, genre="Baroque")))
+    cursor = pagination.encode_cursor("piece 0", uuid.UUID(int=0))
+
+    page = run(
+        pagination.paged_query(
+            async_db.sheets,
+            {"owner_email": "a@b.com"},
+            limit=2,
+            after=cursor,
+            with_total=True,
+            facets=("genre",),
+        )
+    )
+
+    assert [doc["sheet_id"].int for doc in page.items] == [1, 2]
+    assert page.total is None
+    assert page.facets is None
+
+
+def test_unindexed_sort_is_rejected(async_db):
+    for sort, direction in [("owner_email", 1), ("piece", 0)]:
+        with pytest.raises(HTTPException) as err:
+            asyncio.get_event_loop().run_until_complete(
+                pagination.paged_query(async_db.sheets, {}, sort, direction)
+            )
+        assert err.value.status_code == 400
@@ -0,0 +1,121 @@
+import asyncio
+import datetime
+import os
+import tempfile
+import uuid
+
+from _pytest.monkeypatch import MonkeyPatch
+from starlette.datastructures import UploadFile
+
+from app.sheets import models, previews
+from app.sheets.previews import SourceFiles
+
+
+def make_sheet() -> models.SheetInDB:
+    return models.SheetInDB(
+        piece="Rondo",
+        composers=["Mozart"],
+        owner_email="a@b.com",
+        sheet_id=uuid.uuid4(),
+        file_ext="pdf",
+        preview_status=models.PreviewStatus.pending.value,
+    )
+
+
+class FakeMinio:
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = []
+
+    def fget_object(self, bucket, name, path):
+        self.downloads.append(name)
+        with open(path, "wb") as file:
+            file.write(self.objects[name])
+
+
+def test_source_files_download_once(tmp_path):
+    client = FakeMinio({"blobs/ab/abc": b"%PDF" * 10})
+    sources = SourceFiles(str(tmp_path), 100, client)
+
+    first = sources.path("blobs/ab/abc")
+    second = sources.path("blobs/ab/abc")
+
+    assert first == second
+    assert client.downloads == ["blobs/ab/abc"]
+    with open(first, "rb") as file:
+        assert file.read() == b"%PDF" * 10
+
+
+def test_source_files_evict_least_recently_used(tmp_path):
+    client = FakeMinio({name: name.encode() * 20 for name in ("a", "b", "c")})
+    sources = SourceFiles(str(tmp_path), 50, client)
+
+    evicted = sources.path("a")
+    sources.path("b")
+    sources.path("b")
+    sources.path("c")
+
+    assert not os.path.exists(evicted)
+    assert sources.size == 40
+    sources.path("a")
+    assert client.downloads == ["a", "b", "c", "a"]
+
+
+def test_source_file_larger_than_cache_is_kept_while_used(tmp_path):
+    client = FakeMinio({"big": b"x" * 200})
+    sources = SourceFiles(str(tmp_path), 100, client)
+
+    assert os.path.getsize(sources.path("big")) == 200
+
+
+def test_stale_previews_are_queued_again(monkeypatch: MonkeyPatch):
+    stale = [make_sheet() for _ in range(3)]
+    claims = []
+    rendered = []
+
+    async def claim_stale_preview(queued_before):
+        claims.append(queued_before)
+        return stale.pop() if stale else None
+
+    async def generate_preview(sheet):
+        rendered.append(sheet.sheet_id)
+
+    monkeypatch.setattr(previews.crud, "claim_stale_preview", claim_stale_preview)
+    monkeypatch.setattr(previews, "generate_preview", generate_preview)
+    monkeypatch.setattr(previews, "REQUEUE_BATCH", 2)
+    loop = asyncio.get_event_loop()
+
+    assert loop.run_until_complete(previews.requeue_stale_previews()) == 2
+    loop.run_until_complete(asyncio.sleep(0))
+    assert len(rendered) == 2
+    cutoff = datetime.datetime.now() - claims[0]
+    assert cutoff >= datetime.timedelta(seconds=previews.PREVIEW_STALE_AFTER)
+    assert loop.run_until_complete(previews.requeue_stale_previews()) == 1
+
+
+def test_upload_previews_render_from_local_copy(monkeypatch: MonkeyPatch, tmp_path):
+    monkeypatch.setattr(previews, "UPLOADS_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(previews, "_uploads", None)
+    spooled = tempfile.SpooledTemporaryFile()
+    spooled.write(b"%PDF upload")
+    sources = []
+    statuses = []
+
+    async def render(sheet, targets, source=None):
+        with open(source, "rb") as file:
+            sources.append(file.read())
+        return 3
+
+    async def set_preview_status(owner_email, sheet_id, status, page_count=None):
+        statuses.append((status, page_count))
+
+    monkeypatch.setattr(previews, "_render", render)
+    monkeypatch.setattr(previews.crud, "set_preview_status", set_preview_status)
+    run = asyncio.get_event_loop().run_until_complete
+
+    upload = run(previews.keep_upload(UploadFile("sheet.pdf", spooled)))
+    run(previews.generate_preview(make_sheet(), upload))
+
+    assert sources == [b"%PDF upload"]
+    assert statuses == [(models.PreviewStatus.ready, 3)]
+    assert not os.path.exists(upload)
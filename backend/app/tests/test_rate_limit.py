@@ -0,0 +1,130 @@
+import asyncio
+
+import redis
+from _pytest.monkeypatch import MonkeyPatch
+from fastapi import Depends, FastAPI
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+from app import rate_limit
+from app.rate_limit import Limit, MemoryBuckets
+
+
+def limited_app(monkeypatch: MonkeyPatch) -> TestClient:
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKEND", "memory")
+    monkeypatch.setattr(rate_limit, "memory_buckets", MemoryBuckets(100))
+    app = FastAPI()
+    limit = rate_limit.rate_limit("test", per_ip=Limit(5, 60), per_email=Limit(2, 60))
+
+    @app.post("/form", dependencies=[Depends(limit)])
+    async def form():
+        return "ok"
+
+    @app.post("/json", dependencies=[Depends(limit)])
+    async def json(data: dict):
+        return data["email"]
+
+    return TestClient(app)
+
+
+def test_bucket_refills_over_time():
+    buckets = MemoryBuckets(10)
+    limit = Limit(2, 10)
+    assert buckets.take("a", limit, now=0) == (True, 0.0)
+    assert buckets.take("a", limit, now=0) == (True, 0.0)
+    allowed, retry_after = buckets.take("a", limit, now=0)
+    assert not allowed
+    assert retry_after == 5
+    assert buckets.take("a", limit, now=5)[0]
+    assert not buckets.take("a", limit, now=5)[0]
+
+
+def test_bucket_never_holds_more_than_capacity():
+    buckets = MemoryBuckets(10)
+    limit = Limit(2, 10)
+    buckets.take("a", limit, now=0)
+    assert buckets.take("a", limit, now=1000)[0]
+    assert buckets.take("a", limit, now=1000)[0]
+    assert not buckets.take("a", limit, now=1000)[0]
+
+
+def test_least_recent_buckets_are_dropped():
+    buckets = MemoryBuckets(2)
+    limit = Limit(1, 60)
+    for key in ("a", "b", "a", "c"):
+        buckets.take(key, limit, now=0)
+    assert list(buckets._buckets) == ["a", "c"]
+
+
+def test_email_limit_applies_to_form_and_json(monkeypatch: MonkeyPatch):
+    client = limited_app(monkeypatch)
+    assert client.post("/form", data={"email": "Me@example.com"}).status_code == 200
+    response = client.post("/json", json={"email": "me@example.com"})
+    assert response.status_code == 200
+    assert response.json() == "me@example.com"
+
+    response = client.post("/form", data={"email": "me@example.com"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) == 30
+    assert client.post("/form", data={"email": "you@example.com"}).status_code == 200
+
+
+def test_ip_limit_applies_without_email(monkeypatch: MonkeyPatch):
+    client = limited_app(monkeypatch)
+    statuses = [client.post("/form").status_code for _ in range(6)]
+    assert statuses == [200] * 5 + [429]
+
+
+def test_redis_failure_falls_back_to_memory(monkeypatch: MonkeyPatch):
+    async def failing_script(keys, args):
+        raise redis.ConnectionError("down")
+
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKEND", "redis")
+    monkeypatch.setattr(rate_limit, "_token_bucket", failing_script)
+    monkeypatch.setattr(rate_limit, "memory_buckets", MemoryBuckets(10))
+
+    def take():
+        return asyncio.get_event_loop().run_until_complete(
+            rate_limit.take_token("key", Limit(1, 60))
+        )
+
+    assert take()[0]
+    assert not take()[0]
+
+
+def test_redis_script_result_is_parsed(monkeypatch: MonkeyPatch):
+    calls = []
+
+    async def script(keys, args):
+        calls.append((keys, args))
+        return [0, b"2.5"]
+
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKEND", "redis")
+    monkeypatch.setattr(rate_limit, "_token_bucket", script)
+    allowed, retry_after = asyncio.get_event_loop().run_until_complete(
+        rate_limit.take_token("key", Limit(3, 60))
+    )
+    assert (allowed, retry_after) == (False, 2.5)
+    assert calls[0][0] == ["key"]
+    assert calls[0][1][:2] == [3, 0.05]
+
+
+def request_from(client, forwarded=None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "client": client, "headers": headers})
+
+
+def test_client_ip_is_taken_from_trusted_proxy_only():
+    spoofed = "1.1.1.1, 2.2.2.2"
+    assert rate_limit.client_ip(request_from(None, spoofed)) == "2.2.2.2"
+    assert rate_limit.client_ip(request_from(("127.0.0.1", 80), spoofed)) == "2.2.2.2"
+    assert rate_limit.client_ip(request_from(("3.3.3.3", 80), spoofed)) == "3.3.3.3"
+    assert rate_limit.client_ip(request_from(("127.0.0.1", 80))) == "127.0.0.1"
+    assert rate_limit.client_ip(request_from(None)) is None
+
+
+def test_requests_without_address_share_no_bucket(monkeypatch: MonkeyPatch):
+    client = limited_app(monkeypatch)
+    monkeypatch.setattr(rate_limit, "client_ip", lambda request: None)
+    statuses = [client.post("/form").status_code for _ in range(6)]
+    assert statuses == [200] * 6
@@ -0,0 +1,62 @@
+import asyncio
+import datetime
+
+from app import redis_store
+
+
+class FakeScript:
+    def __init__(self, client, source):
+        self.client = client
+        self.source = source
+
+    def __call__(self, keys=(), args=()):
+        assert self.source == redis_store.DELETE_IF_EQUAL_SCRIPT
+        if self.client.values.get(keys[0]) != args[0]:
+            return 0
+        del self.client.values[keys[0]]
+        return 1
+
+
+class FakeClient:
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.expiries[key] = ex
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def register_script(self, source):
+        return FakeScript(self, source)
+
+
+def test_set_sends_expiry_with_value():
+    client = FakeClient()
+    store = redis_store.AsyncRedis(client)
+    expiry = datetime.timedelta(minutes=5)
+
+    asyncio.get_event_loop().run_until_complete(store.set("otp:a", b"x", expiry))
+
+    assert client.expiries["otp:a"] == expiry
+
+
+def test_delete_if_equal_consumes_a_value_once():
+    client = FakeClient()
+    store = redis_store.AsyncRedis(client)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(store.set("otp:a", b"x"))
+
+    assert not loop.run_until_complete(store.delete_if_equal("otp:a", b"y"))
+    assert loop.run_until_complete(store.get("otp:a")) == b"x"
+    first, second = loop.run_until_complete(
+        asyncio.gather(
+            store.delete_if_equal("otp:a", b"x"), store.delete_if_equal("otp:a", b"x")
+        )
+    )
+
+    assert sorted([first, second]) == [False, True]
+    assert loop.run_until_complete(store.get("otp:a")) is None
@@ -0,0 +1,44 @@
+import pytest
+from fastapi import HTTPException
+
+from app.sheets.responses import etag_matches, parse_range
+
+
+def test_parse_range_without_header_sends_everything():
+    assert parse_range(None, 100) is None
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("bytes=0-9", (0, 9)),
+        ("bytes=90-", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=50-500", (50, 99)),
+        ("bytes=-500", (0, 99)),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize(
+    "header", ["items=0-9", "bytes=0-9,20-29", "bytes=a-b", "bytes=9-0"]
+)
+def test_parse_range_ignores_unsupported_ranges(header):
+    assert parse_range(header, 100) is None
+
+
+def test_parse_range_past_end_is_not_satisfiable():
+    with pytest.raises(HTTPException) as err:
+        parse_range("bytes=100-", 100)
+    assert err.value.status_code == 416
+    assert err.value.headers["Content-Range"] == "bytes */100"
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"xyz", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"xyz"', '"abc"')
+    assert not etag_matches(None, '"abc"')
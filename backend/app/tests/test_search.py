@@ -0,0 +1,222 @@
+import asyncio
+import uuid
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.sheets import search
+from app.tests.conftest import FakeCursor
+
+
+class FakeSheets:
+    def __init__(self, docs):
+        self.docs = docs
+        self.finds = 0
+
+    def aggregate(self, pipeline):
+        ids = pipeline[0]["$match"]["sheet_id"]["$in"]
+        return FakeCursor([doc for doc in self.docs if doc["sheet_id"] in ids])
+
+    def find(self, query, projection=None):
+        self.finds += 1
+        ids = query.get("sheet_id", {}).get("$in")
+        return FakeCursor(
+            [doc for doc in self.docs if ids is None or doc["sheet_id"] in ids]
+        )
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.sheets = FakeSheets(docs)
+
+
+def make_index(*sheets):
+    index = search.UserIndex()
+    ids = []
+    for sheet in sheets:
+        sheet_id = uuid.uuid4()
+        index.add(sheet_id, search.sheet_tokens(sheet))
+        ids.append(sheet_id)
+    return index, ids
+
+
+def test_tokenize_drops_accents_without_stemming():
+    assert search.tokenize("Dvořák: Rusalka, Op. 114") == [
+        "dvorak",
+        "rusalka",
+        "op",
+        "114",
+    ]
+    assert search.tokenize("Variations") == ["variations"]
+
+
+def test_piece_outranks_composers_outranks_tags():
+    index, (by_tag, by_piece, by_composer) = make_index(
+        {"piece": "Sonata", "tags": ["chopin"]},
+        {"piece": "Chopin Nocturnes"},
+        {"piece": "Ballade", "composers": ["Frédéric Chopin"]},
+    )
+
+    assert index.search("chopin") == [by_piece, by_composer, by_tag]
+
+
+def test_prefixes_and_typos_match():
+    index, (nocturne, other) = make_index(
+        {"piece": "Nocturne", "composers": ["Chopin"]}, {"piece": "Etude"}
+    )
+
+    assert index.search("noct") == [nocturne]
+    assert index.search("chopn") == [nocturne]
+    assert index.search("xyz") == []
+
+
+def test_sheets_matching_more_words_come_first():
+    index, (piece_only, both) = make_index(
+        {"piece": "Nocturne"}, {"piece": "Etude", "composers": ["Nocturne Chopin"]}
+    )
+
+    assert index.search("nocturne chopin") == [both, piece_only]
+
+
+def test_removed_sheets_leave_no_trace():
+    index, (kept, removed) = make_index({"piece": "Nocturne"}, {"piece": "Rhapsody"})
+
+    index.remove(removed)
+
+    assert index.search("rhapsody") == []
+    assert "rhapsody" not in index.vocabulary
+    assert all("rhapsody" not in tokens for tokens in index.grams.values())
+
+
+def test_snapshot_round_trip():
+    index, ids = make_index({"piece": "Nocturne"}, {"piece": "Rhapsody"})
+
+    restored = search.UserIndex.from_snapshot(index.snapshot())
+
+    assert restored.sheets == index.sheets
+    assert restored.search("nocturne") == ids[:1]
+
+
+def test_ranked_pages_keep_ranking_order(monkeypatch: MonkeyPatch):
+    ranked = [uuid.uuid4() for _ in range(5)]
+    docs = [
+        {"sheet_id": sheet_id, "piece": "Nocturne", "composers": ["Chopin"]}
+        for sheet_id in ranked
+    ]
+    monkeypatch.setattr("app.sheets.search.db", FakeDB(list(reversed(docs))))
+    loop = asyncio.get_event_loop()
+
+    first = loop.run_until_complete(search.ranked_page("a@b.com", ranked, limit=2))
+    second = loop.run_until_complete(
+        search.ranked_page("a@b.com", ranked, limit=2, after=first.next_cursor)
+    )
+    back = loop.run_until_complete(
+        search.ranked_page("a@b.com", ranked, limit=2, before=second.prev_cursor)
+    )
+
+    assert [sheet.sheet_id for sheet in first.items] == ranked[:2]
+    assert first.prev_cursor is None
+    assert [sheet.sheet_id for sheet in second.items] == ranked[2:4]
+    assert [sheet.sheet_id for sheet in back.items] == ranked[:2]
+    assert back.prev_cursor is None
+
+
+def test_ranked_page_before_the_first_sheet_is_empty(monkeypatch: MonkeyPatch):
+    ranked = [uuid.uuid4() for _ in range(3)]
+    monkeypatch.setattr("app.sheets.search.db", FakeDB([]))
+    before = search.encode_cursor("0", uuid.uuid4())
+
+    page = asyncio.get_event_loop().run_until_complete(
+        search.ranked_page("a@b.com", ranked, limit=2, before=before)
+    )
+
+    assert page.items == []
+    assert page.next_cursor is None and page.prev_cursor is None
+
+
+def test_later_ranked_pages_skip_facets(monkeypatch: MonkeyPatch):
+    ranked = [uuid.uuid4() for _ in range(3)]
+    fake_db = FakeDB(
+        [
+            {"sheet_id": sheet_id, "piece": "Etude", "composers": ["Chopin"]}
+            for sheet_id in ranked
+        ]
+    )
+    pipelines = []
+    aggregate = fake_db.sheets.aggregate
+
+    def recording_aggregate(pipeline):
+        pipelines.append(pipeline)
+        return aggregate(pipeline)
+
+    fake_db.sheets.aggregate = recording_aggregate
+    monkeypatch.setattr("app.sheets.search.db", fake_db)
+    after = search.encode_cursor("0", ranked[0])
+
+    page = asyncio.get_event_loop().run_until_complete(
+        search.ranked_page("a@b.com", ranked, limit=1, after=after, with_facets=True)
+    )
+
+    assert [sheet.sheet_id for sheet in page.items] == ranked[1:2]
+    assert page.total is None and page.facets is None
+    assert not any("$facet" in stage for stage in pipelines[0])
+
+
+def test_restarted_index_only_fetches_new_sheets(monkeypatch: MonkeyPatch, tmp_path):
+    kept = {"sheet_id": uuid.uuid4(), "piece": "Nocturne"}
+    removed = {"sheet_id": uuid.uuid4(), "piece": "Rhapsody"}
+    fake_db = FakeDB([kept, removed])
+    monkeypatch.setattr("app.sheets.search.db", fake_db)
+    monkeypatch.setattr("app.sheets.search.SEARCH_INDEX_DIR", str(tmp_path / "idx"))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(search.IndexCache(10).get("a@b.com"))
+    added = {"sheet_id": uuid.uuid4(), "piece": "Etude"}
+    fake_db.sheets.docs = [kept, added]
+    fake_db.sheets.finds = 0
+
+    index = loop.run_until_complete(search.IndexCache(10).get("a@b.com"))
+
+    assert set(index.sheets) == {kept["sheet_id"], added["sheet_id"]}
+    assert index.search("etude") == [added["sheet_id"]]
+    assert fake_db.sheets.finds == 2
+
+
+def test_write_during_sync_is_kept(monkeypatch: MonkeyPatch, tmp_path):
+    kept = {"sheet_id": uuid.uuid4(), "piece": "Nocturne"}
+    added = {"sheet_id": uuid.uuid4(), "piece": "Etude"}
+    cache = search.IndexCache(10)
+
+    class WriteDuringSync(FakeSheets):
+        def find(self, query, projection=None):
+            cursor = super().find(query, projection)
+            if self.finds == 3:
+                self.docs.append(added)
+                cache.sheets_changed("a@b.com", added=[added])
+            return cursor
+
+    fake_db = FakeDB([])
+    fake_db.sheets = WriteDuringSync([kept])
+    monkeypatch.setattr("app.sheets.search.db", fake_db)
+    monkeypatch.setattr("app.sheets.search.SEARCH_INDEX_DIR", str(tmp_path / "idx"))
+    monkeypatch.setattr("app.sheets.search.SEARCH_SYNC_INTERVAL", -1)
+    loop = asyncio.get_event_loop()
+    first = loop.run_until_complete(cache.get("a@b.com"))
+
+    loop.run_until_complete(cache.get("a@b.com"))
+
+    assert set(first.sheets) == {kept["sheet_id"], added["sheet_id"]}
+    index = loop.run_until_complete(cache.get("a@b.com"))
+    assert set(index.sheets) == {kept["sheet_id"], added["sheet_id"]}
+
+
+def test_index_dir_must_be_private(monkeypatch: MonkeyPatch, tmp_path):
+    tmp_path.chmod(0o755)
+    monkeypatch.setattr("app.sheets.search.SEARCH_INDEX_DIR", str(tmp_path))
+
+    with pytest.raises(PermissionError):
+        search._write_snapshot("a@b.com", {})
+
+    private = tmp_path / "idx"
+    monkeypatch.setattr("app.sheets.search.SEARCH_INDEX_DIR", str(private))
+    search._write_snapshot("a@b.com", {})
+    assert private.stat().st_mode & 0o777 == 0o700
@@ -0,0 +1,281 @@
+import asyncio
+import datetime
+import uuid
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from motor import motor_asyncio
+
+from app import dependencies, taxonomy
+from app.sheets import crud, models
+
+Collection = motor_asyncio.AsyncIOMotorCollection
+
+
+@pytest.fixture
+def sheets_db(monkeypatch: MonkeyPatch, async_db):
+    """Point crud, and the taxonomy it keeps up to date, at the test database."""
+    monkeypatch.setattr("app.sheets.crud.db", async_db)
+    monkeypatch.setattr("app.taxonomy.db", async_db)
+    monkeypatch.setattr("app.dependencies.db_client", async_db.client)
+    return async_db
+
+
+def make_sheet(**kwargs) -> models.SheetInDB:
+    kwargs.setdefault("tags", ["classical"])
+    kwargs.setdefault("instruments", ["violin"])
+    return models.SheetInDB(
+        piece="Rondo",
+        composers=["Mozart"],
+        owner_email="a@b.com",
+        sheet_id=uuid.uuid4(),
+        file_ext="pdf",
+        **kwargs,
+    )
+
+
+def sheet_ids(collection) -> list:
+    docs = asyncio.get_event_loop().run_until_complete(
+        collection.find({}).to_list(None)
+    )
+    return [doc["sheet_id"] for doc in docs]
+
+
+def test_previous_versions_in_one_query(monkeypatch: MonkeyPatch, sheets_db):
+    sheet = make_sheet()
+    sheet.lineage_id = sheet.sheet_id
+    # Mongo keeps milliseconds.
+    now = datetime.datetime.now().replace(microsecond=0)
+    versions = [
+        {
+            **make_sheet(current=False, lineage_id=sheet.sheet_id).dict(),
+            "replaced_at": now - datetime.timedelta(days=days),
+        }
+        for days in (3, 1, 2)
+    ] + [{**make_sheet(current=False).dict(), "replaced_at": now}]
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.sheet_versions.insert_many(versions))
+    finds = []
+    find = Collection.find
+
+    def counted(collection, *args, **kwargs):
+        finds.append(collection.name)
+        return find(collection, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, "find", counted)
+
+    found = run(crud.get_previous_versions(sheet))
+
+    assert finds == ["sheet_versions"]
+    assert [now - time for _, time in found] == [
+        datetime.timedelta(days=days) for days in (1, 2, 3)
+    ]
+
+
+def legacy_sheets():
+    """A live sheet and its old version stored the way they were before
+    history moved to sheet_versions."""
+    old = make_sheet(current=False, blob_id="old")
+    replaced_at = datetime.datetime.now() - datetime.timedelta(days=1)
+    live = make_sheet(blob_id="new", prev_versions=[(old.sheet_id, replaced_at)])
+    return live, old
+
+
+def test_unmigrated_history_is_listed(sheets_db):
+    live, old = legacy_sheets()
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.sheets.insert_many([live.dict(), old.dict()]))
+
+    found = run(crud.get_previous_versions(live))
+
+    assert [(summary.sheet_id, time) for summary, time in found] == live.prev_versions
+
+
+def test_unmigrated_history_is_restored_and_deleted(sheets_db, fake_blob_storage):
+    live, old = legacy_sheets()
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.sheets.insert_many([live.dict(), old.dict()]))
+    run(
+        sheets_db.blobs.insert_many(
+            [{"_id": "old", "refcount": 1}, {"_id": "new", "refcount": 1}]
+        )
+    )
+
+    restored = run(crud.restore_previous_sheet(old, live))
+
+    assert sheet_ids(sheets_db.sheets) == [old.sheet_id]
+    assert restored.lineage_id == live.sheet_id
+    assert sheet_ids(sheets_db.sheet_versions) == [live.sheet_id]
+
+    run(crud.delete_sheet_by_id(live.owner_email, restored.sheet_id))
+
+    assert sheet_ids(sheets_db.sheets) == [] == sheet_ids(sheets_db.sheet_versions)
+    assert run(sheets_db.blobs.count_documents({})) == 0
+    assert sorted(fake_blob_storage[1]) == ["new", "old"]
+
+
+def test_related_lists_pipeline_splits_fields():
+    sheet = make_sheet()
+    pipeline = crud.related_lists_pipeline(sheet, ["piece", "composers", "tags"])
+
+    match = pipeline[0]["$match"]
+    assert match["sheet_id"] == {"$ne": sheet.sheet_id}
+    assert {"piece": "Rondo"} in match["$or"]
+    facets = pipeline[-1]["$facet"]
+    assert list(facets) == ["piece", "composers", "tags"]
+    assert facets["tags"][0] == {
+        "$match": {"tags": {"$elemMatch": {"$in": ["classical"]}}}
+    }
+
+
+def test_update_moves_old_version_to_history(sheets_db):
+    old_sheet = make_sheet()
+    old_sheet.lineage_id = uuid.uuid4()
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.sheets.insert_one(old_sheet.dict()))
+    new_sheet = models.Sheet(
+        **{**old_sheet.dict(), "sheet_id": uuid.uuid4(), "tags": ["romantic"]}
+    )
+
+    updated = run(crud.update_sheet(old_sheet, new_sheet))
+
+    assert sheet_ids(sheets_db.sheets) == [new_sheet.sheet_id]
+    assert updated.lineage_id == old_sheet.lineage_id
+    retired = run(sheets_db.sheet_versions.find_one({}))
+    assert retired["sheet_id"] == old_sheet.sheet_id
+    assert retired["lineage_id"] == old_sheet.lineage_id
+    assert retired["current"] is False
+    assert retired["replaced_at"]
+    assert run(taxonomy.get_terms("a@b.com", "tags")) == [("romantic", 1)]
+
+
+def test_update_of_stale_version_conflicts(sheets_db):
+    old_sheet = make_sheet()
+    new_sheet = models.Sheet(**{**old_sheet.dict(), "sheet_id": uuid.uuid4()})
+
+    with pytest.raises(crud.VersionConflict):
+        asyncio.get_event_loop().run_until_complete(
+            crud.update_sheet(old_sheet, new_sheet)
+        )
+
+
+def test_crash_during_update_keeps_the_sheet(monkeypatch: MonkeyPatch, sheets_db):
+    monkeypatch.setattr("app.dependencies.DB_TRANSACTIONS", False)
+    old_sheet = make_sheet()
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.sheets.insert_one(old_sheet.dict()))
+    new_sheet = models.Sheet(**{**old_sheet.dict(), "sheet_id": uuid.uuid4()})
+    find_one_and_replace = Collection.find_one_and_replace
+
+    async def crash(collection, *args, **kwargs):
+        raise ConnectionError("lost the server")
+
+    monkeypatch.setattr(Collection, "find_one_and_replace", crash)
+
+    with pytest.raises(ConnectionError):
+        run(crud.update_sheet(old_sheet, new_sheet))
+
+    assert sheet_ids(sheets_db.sheets) == [old_sheet.sheet_id]
+    assert sheet_ids(sheets_db.sheet_versions) == [old_sheet.sheet_id]
+    monkeypatch.setattr(Collection, "find_one_and_replace", find_one_and_replace)
+    run(crud.update_sheet(old_sheet, new_sheet))
+    assert sheet_ids(sheets_db.sheets) == [new_sheet.sheet_id]
+    assert sheet_ids(sheets_db.sheet_versions) == [old_sheet.sheet_id]
+
+
+@pytest.fixture
+def fake_blob_storage(monkeypatch: MonkeyPatch):
+    saved = []
+    removed = []
+
+    async def hash_upload(sheet_file):
+        return "abc", 3
+
+    async def save_sheet(sheet_file, blob_id, size, deduplicate=True):
+        saved.append((blob_id, deduplicate))
+
+    async def remove_blob(blob_id):
+        removed.append(blob_id)
+
+    monkeypatch.setattr("app.sheets.storage.hash_upload", hash_upload)
+    monkeypatch.setattr("app.sheets.storage.save_sheet", save_sheet)
+    monkeypatch.setattr("app.sheets.storage.remove_blob", remove_blob)
+    return saved, removed
+
+
+def test_upload_holds_reference_before_deduplicating(sheets_db, fake_blob_storage):
+    saved, _ = fake_blob_storage
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.blobs.insert_one({"_id": "abc", "refcount": 1}))
+
+    blob_id = run(crud.save_sheet_file(None))
+
+    assert blob_id == "abc"
+    assert run(sheets_db.blobs.find_one({"_id": "abc"}))["refcount"] == 2
+    assert saved == [("abc", True)]
+
+
+def test_unreferenced_blob_is_uploaded_again(sheets_db, fake_blob_storage):
+    saved, _ = fake_blob_storage
+    run = asyncio.get_event_loop().run_until_complete
+
+    run(crud.save_sheet_file(None))
+
+    assert saved == [("abc", False)]
+    assert run(sheets_db.blobs.find_one({"_id": "abc"}))["refcount"] == 1
+
+
+def test_failed_create_gives_blob_reference_back(
+    monkeypatch: MonkeyPatch, sheets_db, fake_blob_storage
+):
+    _, removed = fake_blob_storage
+    run = asyncio.get_event_loop().run_until_complete
+    run(sheets_db.blobs.insert_one({"_id": "abc", "refcount": 1}))
+
+    async def insert_one(collection, *args, **kwargs):
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(Collection, "insert_one", insert_one)
+
+    with pytest.raises(RuntimeError):
+        run(crud.create_sheet(make_sheet(blob_id="abc"), blob_held=True))
+
+    assert run(sheets_db.blobs.count_documents({})) == 0
+    assert removed == ["abc"]
+
+
+@pytest.mark.skipif(
+    not dependencies.DB_TRANSACTIONS, reason="transactions need a replica set"
+)
+def test_version_writes_commit_in_transactions(
+    monkeypatch: MonkeyPatch, sheets_db, fake_blob_storage
+):
+    transactions = []
+    with_transaction = motor_asyncio.AsyncIOMotorClientSession.with_transaction
+
+    async def counted(session, operation, *args, **kwargs):
+        transactions.append(operation.__name__)
+        return await with_transaction(session, operation, *args, **kwargs)
+
+    monkeypatch.setattr(
+        motor_asyncio.AsyncIOMotorClientSession, "with_transaction", counted
+    )
+    run = asyncio.get_event_loop().run_until_complete
+
+    first = run(crud.create_sheet(make_sheet(blob_id="abc")))
+    second = run(
+        crud.update_sheet(
+            first, models.Sheet(**{**first.dict(), "sheet_id": uuid.uuid4()})
+        )
+    )
+    restored = run(crud.restore_previous_sheet(first, second))
+    assert run(sheets_db.sheet_versions.count_documents({})) == 1
+    run(crud.delete_sheet_by_id(first.owner_email, restored.sheet_id))
+
+    assert transactions == ["create", "update", "restore", "delete"]
+    assert run(sheets_db.sheets.count_documents({})) == 0
+    assert run(sheets_db.sheet_versions.count_documents({})) == 0
+    assert run(sheets_db.taxonomy.count_documents({})) == 0
+    assert run(sheets_db.blobs.count_documents({})) == 0
+    assert fake_blob_storage[1] == ["abc"]
@@ -0,0 +1,265 @@
+import asyncio
+import io
+import os
+import tempfile
+from collections import defaultdict
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from starlette.datastructures import UploadFile
+
+from app.sheets import storage
+
+
+class FakeMinio:
+    def __init__(self):
+        self.objects = {}
+        self.part_sizes = {}
+
+    def put_object(self, bucket, name, data, length, content_type=None, part_size=None):
+        self.objects[name] = data.read(length)
+        self.part_sizes[name] = part_size
+
+
+@pytest.fixture
+def fake_minio(monkeypatch: MonkeyPatch):
+    client = FakeMinio()
+    monkeypatch.setattr("app.sheets.storage.minio_client", client)
+    return client
+
+
+def make_upload(data: bytes) -> UploadFile:
+    spooled = tempfile.SpooledTemporaryFile()
+    spooled.write(data)
+    return UploadFile("sheet.pdf", spooled, "application/pdf")
+
+
+def test_small_upload_is_single_put(fake_minio):
+    upload = make_upload(b"small sheet")
+    stats = asyncio.get_event_loop().run_until_complete(
+        storage.upload_stream(upload, "owner/sheet.pdf")
+    )
+
+    assert stats.parts == 1
+    assert stats.size == len(b"small sheet")
+    assert fake_minio.objects["owner/sheet.pdf"] == b"small sheet"
+
+
+def test_large_upload_is_sent_in_parts(fake_minio):
+    data = bytes(range(256)) * (storage.PART_SIZE * 3 // 256) + b"tail"
+    upload = make_upload(data)
+    asyncio.get_event_loop().run_until_complete(upload.read(10))
+    stats = asyncio.get_event_loop().run_until_complete(
+        storage.upload_stream(upload, "owner/big.pdf")
+    )
+
+    assert stats.parts == 4
+    assert stats.size == len(data)
+    assert fake_minio.objects["owner/big.pdf"] == data
+    assert fake_minio.part_sizes["owner/big.pdf"] == storage.PART_SIZE
+
+
+def test_failed_upload_is_raised(fake_minio, monkeypatch: MonkeyPatch):
+    def failing_put(*_args, **_kwargs):
+        raise IOError("connection reset")
+
+    monkeypatch.setattr(fake_minio, "put_object", failing_put)
+    upload = make_upload(b"x" * (storage.PART_SIZE + 1))
+    with pytest.raises(IOError):
+        asyncio.get_event_loop().run_until_complete(
+            storage.upload_stream(upload, "owner/broken.pdf")
+        )
+
+
+class FakeResponse:
+    def __init__(self, data: bytes):
+        self.data = io.BytesIO(data)
+        self.released = False
+
+    def read(self, size):
+        return self.data.read(size)
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        self.released = True
+
+
+def test_iter_object_releases_connection():
+    response = FakeResponse(b"a" * 100)
+
+    async def consume():
+        return [chunk async for chunk in storage.iter_object(response, 40)]
+
+    chunks = asyncio.get_event_loop().run_until_complete(consume())
+
+    assert [len(chunk) for chunk in chunks] == [40, 40, 20]
+    assert response.released
+
+
+def test_iter_object_releases_connection_when_abandoned():
+    response = FakeResponse(b"a" * 100)
+
+    async def consume_one():
+        iterator = storage.iter_object(response, 40)
+        await iterator.__anext__()
+        await iterator.aclose()
+
+    asyncio.get_event_loop().run_until_complete(consume_one())
+
+    assert response.released
+
+
+class FakeStat:
+    def __init__(self, size):
+        self.size = size
+        self.etag = "etag"
+        self.content_type = "application/pdf"
+
+
+class CachingMinio:
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = []
+
+    def stat_object(self, bucket, name):
+        return FakeStat(len(self.objects[name]))
+
+    def fget_object(self, bucket, name, path):
+        self.downloads.append(name)
+        with open(path, "wb") as file:
+            file.write(self.objects[name])
+
+
+@pytest.fixture
+def disk_cache(monkeypatch: MonkeyPatch, tmp_path):
+    client = CachingMinio({"a": b"a" * 40, "b": b"b" * 40, "c": b"c" * 40})
+    monkeypatch.setattr("app.sheets.storage.minio_client", client)
+    monkeypatch.setattr("app.sheets.storage.metrics.counters", defaultdict(int))
+    cache = storage.DiskCache(str(tmp_path), max_bytes=100, max_object_bytes=50)
+    return cache, client
+
+
+def test_concurrent_misses_download_once(disk_cache):
+    cache, client = disk_cache
+
+    async def read_twice():
+        return await asyncio.gather(cache.get("a"), cache.get("a"))
+
+    first, second = asyncio.get_event_loop().run_until_complete(read_twice())
+
+    assert client.downloads == ["a"]
+    assert first == second
+    with open(first.path, "rb") as file:
+        assert file.read() == b"a" * 40
+
+
+def test_known_stat_is_not_fetched_again(disk_cache):
+    cache, client = disk_cache
+
+    def stat_object(bucket, name):
+        raise AssertionError("stat_object called")
+
+    client.stat_object = stat_object
+    entry = asyncio.get_event_loop().run_until_complete(cache.get("a", FakeStat(40)))
+
+    assert entry.size == 40
+    assert client.downloads == ["a"]
+
+
+def test_cache_hit_skips_minio(disk_cache):
+    cache, client = disk_cache
+    run = asyncio.get_event_loop().run_until_complete
+    run(cache.get("a"))
+    run(cache.get("a"))
+
+    assert client.downloads == ["a"]
+    assert storage.metrics.counters["cache.hits"] == 1
+
+
+def test_cache_evicts_least_recently_used(disk_cache):
+    cache, client = disk_cache
+    run = asyncio.get_event_loop().run_until_complete
+    evicted = run(cache.get("a")).path
+    run(cache.get("b"))
+    run(cache.get("c"))
+
+    assert "a" not in cache
+    assert "b" in cache and "c" in cache
+    assert cache.size == 80
+    assert not os.path.exists(evicted)
+
+
+def test_cache_skips_large_objects(disk_cache):
+    cache, client = disk_cache
+    client.objects["big"] = b"x" * 60
+    entry = asyncio.get_event_loop().run_until_complete(cache.get("big"))
+
+    assert entry.path is None
+    assert entry.size == 60
+    assert "big" not in cache
+
+
+def test_discard_prefix_removes_files(disk_cache):
+    cache, client = disk_cache
+    client.objects["blobs/ab/abc-preview-thumb.webp"] = b"p"
+    entry = asyncio.get_event_loop().run_until_complete(
+        cache.get("blobs/ab/abc-preview-thumb.webp")
+    )
+    cache.discard_prefix("blobs/ab/abc")
+
+    assert cache.size == 0
+    assert not os.path.exists(entry.path)
+
+
+def test_open_copy_survives_eviction(disk_cache):
+    cache, client = disk_cache
+    run = asyncio.get_event_loop().run_until_complete
+    entry = run(cache.get("a"))
+    file = run(cache.open("a", entry))
+    run(cache.get("b"))
+    run(cache.get("c"))
+
+    async def read_all():
+        return b"".join([chunk async for chunk in storage.iter_file(file, 10, 20)])
+
+    assert not os.path.exists(entry.path)
+    assert run(read_all()) == b"a" * 20
+
+
+def test_vanished_copy_is_dropped(disk_cache):
+    cache, client = disk_cache
+    run = asyncio.get_event_loop().run_until_complete
+    entry = run(cache.get("a"))
+    os.remove(entry.path)
+
+    assert run(cache.open("a", entry)) is None
+    assert "a" not in cache
+    assert cache.size == 0
+
+
+def test_directories_of_dead_processes_are_swept(tmp_path):
+    dead = tmp_path / "1234-dead"
+    dead.mkdir()
+    (dead / "abc").write_bytes(b"left behind")
+    live, lock = storage.private_directory(str(tmp_path))
+
+    mine, my_lock = storage.private_directory(str(tmp_path))
+
+    assert not dead.exists()
+    assert os.path.isdir(live) and os.path.isdir(mine) and live != mine
+    lock.close()
+    storage.private_directory(str(tmp_path))
+    assert not os.path.exists(live) and os.path.isdir(mine)
+
+
+def test_clear_releases_the_directory(disk_cache):
+    cache, client = disk_cache
+    asyncio.get_event_loop().run_until_complete(cache.get("a"))
+    directory = cache.directory
+
+    cache.clear()
+
+    assert not os.path.exists(directory)
+    assert cache.directory is None
@@ -0,0 +1,52 @@
+import asyncio
+from collections import Counter
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from app import taxonomy
+from app.tests.conftest import FakeTaxonomy
+
+
+class FakeDB:
+    def __init__(self):
+        self.taxonomy = FakeTaxonomy()
+
+
+def test_sheet_terms_count_each_name_once():
+    sheet = {
+        "tags": ["baroque", "baroque", ""],
+        "composers": ["Bach"],
+        "instruments": [],
+        "genre": "Classical",
+    }
+
+    assert taxonomy.sheet_terms(sheet) == Counter(
+        {("tags", "baroque"): 1, ("composers", "Bach"): 1, ("genre", "Classical"): 1}
+    )
+
+
+def test_term_changes_skip_unchanged_terms():
+    old = {"tags": ["baroque", "easy"], "composers": ["Bach"], "genre": None}
+    new = {"tags": ["baroque"], "composers": ["Handel"], "genre": None}
+
+    assert taxonomy.term_changes([old], [new]) == Counter(
+        {("tags", "easy"): -1, ("composers", "Bach"): -1, ("composers", "Handel"): 1}
+    )
+
+
+def test_unused_terms_are_removed(monkeypatch: MonkeyPatch):
+    fake_db = FakeDB()
+    monkeypatch.setattr("app.taxonomy.db", fake_db)
+    sheet = {"tags": ["baroque"], "composers": ["Bach"]}
+    other = {"tags": ["baroque"], "composers": ["Handel"]}
+    loop = asyncio.get_event_loop()
+
+    for changes in (
+        taxonomy.term_changes(added=[sheet, other]),
+        taxonomy.term_changes(removed=[sheet]),
+    ):
+        loop.run_until_complete(taxonomy.apply_term_changes("a@b.com", changes))
+
+    assert fake_db.taxonomy.counts == Counter(
+        {("a@b.com", "tags", "baroque"): 1, ("a@b.com", "composers", "Handel"): 1}
+    )
@@ -0,0 +1,82 @@
+import asyncio
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.auth import cache, crud, models
+
+
+class FakeUsers:
+    def __init__(self, docs):
+        self.docs = docs
+        self.reads = 0
+
+    async def find_one(self, query):
+        self.reads += 1
+        for doc in self.docs:
+            if all(doc.get(field) == value for field, value in query.items()):
+                return dict(doc)
+        return None
+
+    async def replace_one(self, query, doc):
+        for stored in self.docs:
+            if stored["_id"] == query["_id"]:
+                stored.clear()
+                stored.update(doc, _id=query["_id"])
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.users = FakeUsers(docs)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+def test_entries_expire(monkeypatch: MonkeyPatch):
+    user_cache = cache.UserCache(max_users=10, ttl=30)
+    user = models.UserInDB(email="a@b.com")
+    now = [100.0]
+    monkeypatch.setattr("app.auth.cache.time.monotonic", lambda: now[0])
+
+    user_cache.put("a@b.com", user, user_cache.generation)
+    assert user_cache.get("a@b.com") == user
+    now[0] += 31
+
+    assert user_cache.get("a@b.com") is None
+
+
+def test_lookup_racing_an_invalidation_is_not_stored():
+    user_cache = cache.UserCache(max_users=10, ttl=30)
+    generation = user_cache.generation
+
+    user_cache.discard("a@b.com")
+    user_cache.put("a@b.com", models.UserInDB(email="a@b.com"), generation)
+
+    assert user_cache.get("a@b.com") is None
+
+
+def test_disabling_a_user_reaches_the_cache(monkeypatch: MonkeyPatch):
+    fake_db = FakeDB([{"_id": 1, "email": "a@b.com", "disabled": False}])
+    fake_redis = FakeRedis()
+    monkeypatch.setattr("app.auth.crud.db", fake_db)
+    monkeypatch.setattr("app.auth.crud.user_cache", cache.UserCache(10, 30))
+    monkeypatch.setattr("app.auth.cache.user_cache", crud.user_cache)
+    monkeypatch.setattr("app.auth.cache.redis_store", fake_redis)
+    loop = asyncio.get_event_loop()
+
+    for _ in range(3):
+        user = loop.run_until_complete(crud.get_cached_user_by_email("A@b.com"))
+        assert not user.disabled
+    assert fake_db.users.reads == 1
+
+    disabled = models.UserWithRole(email="a@b.com", disabled=True)
+    loop.run_until_complete(crud.update_user_by_email("a@b.com", disabled))
+    user = loop.run_until_complete(crud.get_cached_user_by_email("a@b.com"))
+
+    assert user.disabled
+    assert fake_redis.published[0] == (cache.INVALIDATION_CHANNEL, "a@b.com")
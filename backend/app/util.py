@@ -1,10 +1,8 @@
 from collections import defaultdict
 from typing import Optional
 
-import aiohttp
-from fastapi import HTTPException
-
-from app.dependencies import mailgun_enpoint, mailgun_key
+from app import mail
+from app.pagination import Page
 from app.sheets import models
 
 
@@ -17,6 +15,7 @@ async def send_email(
     reply_to: Optional[str] = None,
     high_priority: bool = False,
 ):
+    """Queue an email; it is sent in the background, with retries."""
     message_data = {
         "from": f"{from_name} <{from_address}>",
         "to": to,
@@ -29,23 +28,17 @@ async def send_email(
         message_data["h:X-Priority"] = 1
         message_data["h:X-MSMail-Priority"] = "High"
         message_data["h:Importance"] = "High"
-    async with aiohttp.ClientSession() as session:
-        res = await session.post(
-            mailgun_enpoint,
-            auth=aiohttp.BasicAuth("api", mailgun_key),
-            data=message_data,
-        )
-        if res.status != 200:
-            raise HTTPException(status_code=500, detail="Could not send email.")
+    mail.outbox.put(message_data)
 
 
-def get_next_prev_page_urls(url, page):
-    next_page = url.remove_query_params(["page"]).include_query_params(page=(page + 1))
-    prev_page = None
-    if page > 1:
-        prev_page = url.remove_query_params(["page"]).include_query_params(
-            page=(page - 1)
-        )
+def get_page_urls(url, page: Page):
+    """Previous and next links for a page of results, as cursor links."""
+    url = url.remove_query_params(["after", "before"])
+    prev_page = next_page = None
+    if page.prev_cursor:
+        prev_page = url.include_query_params(before=page.prev_cursor)
+    if page.next_cursor:
+        next_page = url.include_query_params(after=page.next_cursor)
     return prev_page, next_page
 
 
@@ -53,7 +46,7 @@ def get_sort_links(url, sort, direction):
     sort_links = defaultdict(lambda: "")
     for field in models.Sheet.sortable_fields():
         sort_links[field] = url.remove_query_params(
-            ["sort", "direction"]
+            ["sort", "direction", "after", "before"]
         ).include_query_params(sort=field)
         if field == sort:
             sort_links[field] = (
@@ -1,15 +1,32 @@
+import asyncio
+import datetime
+import hashlib
+import json
 import os
-import tempfile
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import quote_plus
 
 import click
+import minio
 import pymongo
-from pdf2image import convert_from_bytes
 
+from app import indexes, pagination, taxonomy
+from app.auth import security
 from app.auth.models import UserInDB, AuthRole
-from app.dependencies import minio_client
-from app.sheets import models
+from app.composers import crud as composer_crud
+from app.dependencies import (
+    minio_client,
+    DB_REPLICA_SET,
+    DB_TRANSACTIONS,
+    MINIO_POOL_SIZE,
+)
+from app.instruments import crud as instrument_crud
+from app.sheets import crud as sheet_crud, models, previews, search, storage
+from app.tags import crud as tag_crud
 
 db_uri = "mongodb://{username}:{password}@{host}:{port}".format(
     username=quote_plus(os.getenv("DB_USERNAME", "root")),
@@ -17,9 +34,10 @@ db_uri = "mongodb://{username}:{password}@{host}:{port}".format(
     host=quote_plus(os.getenv("DB_HOST", "localhost")),
     port=quote_plus(os.getenv("DB_PORT", "27017")),
 )
-db_client = pymongo.MongoClient(db_uri)
+db_client = pymongo.MongoClient(db_uri, replicaset=DB_REPLICA_SET)
 db = db_client[os.getenv("DB_NAME", "app")]
 
+
 # test volume
 @click.group()
 def cli():
@@ -38,51 +56,685 @@ def createsuperuser(email):
         print("user creation failed")
 
 
+def iter_import_items(source: Path):
+    """Yield (sheet, file path) pairs from a manifest or a directory tree.
+
+    A manifest is a JSON lines file of sheets, each with a ``file`` path
+    relative to the manifest. A directory tree has one folder per sheet
+    holding ``data.json`` and the sheet file.
+    """
+    if source.is_file():
+        with source.open() as manifest:
+            for line in manifest:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                sheet_path = source.parent / data.pop("file")
+                yield models.SheetInDB.parse_obj(data), sheet_path
+        return
+    for data_path in sorted(source.glob("**/data.json")):
+        sheet = models.SheetInDB.parse_file(data_path)
+        yield sheet, data_path.parent / f"sheet.{sheet.file_ext}"
+
+
+def upload_blob(sheet_path: Path):
+    """Store a sheet file as a blob, returning its digest, size and whether
+    it was uploaded or already stored."""
+    bucket = os.getenv("MINIO_BUCKET_NAME")
+    with sheet_path.open("rb") as sheet_file:
+        blob_id, size = storage.hash_file(sheet_file)
+    blob_name = storage.blob_prefix(blob_id)
+    if object_exists(bucket, blob_name):
+        return blob_id, size, False
+    minio_client.fput_object(bucket, blob_name, str(sheet_path))
+    return blob_id, size, True
+
+
+def write_import_batch(docs, blob_refs: Counter, term_updates, session=None):
+    # The sheets go in last, so any sheet found in the database on resume
+    # already has its blob references and terms counted. A crash before
+    # then counts them again on resume: too many references only keep blobs
+    # alive, and rebuildtaxonomy puts the term counts right. With
+    # DB_TRANSACTIONS the three writes commit together instead.
+    db.blobs.bulk_write(
+        [
+            pymongo.UpdateOne(
+                {"_id": blob_id}, {"$inc": {"refcount": count}}, upsert=True
+            )
+            for blob_id, count in blob_refs.items()
+        ],
+        ordered=False,
+        session=session,
+    )
+    if term_updates:
+        db.taxonomy.bulk_write(term_updates, ordered=False, session=session)
+    db.sheets.insert_many(docs, ordered=False, session=session)
+
+
+def apply_preview_results(pending, wait=False):
+    """Record finished preview renders, returning the ones still running."""
+    updates = []
+    running = []
+    for sheet_id, future in pending:
+        if not wait and not future.done():
+            running.append((sheet_id, future))
+            continue
+        try:
+            page_count = future.result()
+            update = {
+                "preview_status": models.PreviewStatus.ready.value,
+                "page_count": page_count,
+            }
+        except Exception as err:
+            print(f"preview for {sheet_id} failed: {err}")
+            update = {"preview_status": models.PreviewStatus.failed.value}
+        updates.append(pymongo.UpdateOne({"sheet_id": sheet_id}, {"$set": update}))
+    if updates:
+        db.sheets.bulk_write(updates, ordered=False)
+    return running
+
+
+def group_by_owner(docs):
+    groups = {}
+    for doc in docs:
+        groups.setdefault(doc["owner_email"], []).append(doc)
+    return groups
+
+
+def import_sheets(
+    source: Path,
+    checkpoint: Path,
+    batch_size: int,
+    upload_workers: int,
+    preview_workers: int,
+):
+    done = set()
+    if checkpoint.exists():
+        done = set(checkpoint.read_text().split())
+        print(f"resuming, {len(done)} sheets already imported")
+    items = iter_import_items(source)
+    start = time.monotonic()
+    imported = skipped = uploaded_bytes = deduplicated_bytes = 0
+    pending_previews = []
+    with ThreadPoolExecutor(upload_workers) as uploads, previews.new_pool(
+        preview_workers
+    ) as renders, checkpoint.open("a") as checkpoint_file:
+        while True:
+            batch = []
+            for sheet, sheet_path in items:
+                if str(sheet.sheet_id) in done:
+                    skipped += 1
+                    continue
+                batch.append((sheet, sheet_path))
+                if len(batch) == batch_size:
+                    break
+            if not batch:
+                break
+            existing = {
+                doc["sheet_id"]
+                for doc in db.sheets.find(
+                    {"sheet_id": {"$in": [sheet.sheet_id for sheet, _ in batch]}},
+                    {"sheet_id": 1},
+                )
+            }
+            skipped += len(existing)
+            batch = [item for item in batch if item[0].sheet_id not in existing]
+            results = uploads.map(lambda item: upload_blob(item[1]), batch)
+            docs = []
+            blob_refs = Counter()
+            for (sheet, _), (blob_id, size, uploaded) in zip(batch, results):
+                if uploaded:
+                    uploaded_bytes += size
+                else:
+                    deduplicated_bytes += size
+                sheet.clean_empty_strings()
+                sheet.clean_tags()
+                sheet.set_sort_keys()
+                sheet.lineage_id = sheet.lineage_id or sheet.sheet_id
+                sheet.blob_id = blob_id
+                sheet.preview_status = previews.initial_status(sheet.file_ext)
+                if sheet.preview_status == models.PreviewStatus.pending.value:
+                    sheet.preview_queued_at = datetime.datetime.now()
+                blob_refs[blob_id] += 1
+                docs.append(sheet.dict())
+            if docs:
+                term_updates = [
+                    update
+                    for owner_email, owner_docs in group_by_owner(docs).items()
+                    for update in taxonomy.term_updates(
+                        owner_email, taxonomy.term_changes(added=owner_docs)
+                    )
+                ]
+                if DB_TRANSACTIONS:
+                    with db_client.start_session() as session:
+                        session.with_transaction(
+                            lambda session: write_import_batch(
+                                docs, blob_refs, term_updates, session
+                            )
+                        )
+                else:
+                    write_import_batch(docs, blob_refs, term_updates)
+            for sheet, sheet_path in batch:
+                if sheet.preview_status != models.PreviewStatus.pending.value:
+                    continue
+                future = previews.submit_previews(renders, sheet, str(sheet_path))
+                pending_previews.append((sheet.sheet_id, future))
+            checkpoint_file.write(
+                "".join(f"{sheet.sheet_id}\n" for sheet, _ in batch)
+                + "".join(f"{sheet_id}\n" for sheet_id in existing)
+            )
+            checkpoint_file.flush()
+            imported += len(docs)
+            pending_previews = apply_preview_results(pending_previews)
+            elapsed = time.monotonic() - start
+            print(
+                f"{imported} imported, {skipped} skipped, "
+                f"{imported / elapsed:.1f} sheets/s, "
+                f"{uploaded_bytes / elapsed / 1024 / 1024:.2f} MiB/s uploaded"
+            )
+        print(f"waiting for {len(pending_previews)} previews")
+        apply_preview_results(pending_previews, wait=True)
+    elapsed = time.monotonic() - start
+    print(
+        f"Imported {imported} sheets in {elapsed:.1f}s "
+        f"({imported / elapsed if elapsed else 0:.1f} sheets/s), skipped {skipped}"
+    )
+    print(
+        f"Uploaded {uploaded_bytes / 1024 / 1024:.1f} MiB, "
+        f"{deduplicated_bytes / 1024 / 1024:.1f} MiB already stored"
+    )
+
+
+@cli.command()
+@click.argument("source", type=click.Path(exists=True))
+@click.option(
+    "--checkpoint",
+    type=click.Path(),
+    default=None,
+    help="File recording imported sheet ids. Defaults to SOURCE.checkpoint.",
+)
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--upload-workers", default=MINIO_POOL_SIZE, show_default=True)
+@click.option("--preview-workers", default=previews.PREVIEW_WORKERS, show_default=True)
+def importdata(source, checkpoint, batch_size, upload_workers, preview_workers):
+    """Import sheets from a directory tree or a JSON lines manifest.
+
+    Interrupted imports pick up where they stopped when run again with the
+    same checkpoint file.
+    """
+    source = Path(source)
+    checkpoint = Path(checkpoint or f"{source.absolute()}.checkpoint")
+    import_sheets(source, checkpoint, batch_size, upload_workers, preview_workers)
+
+
 @cli.command()
-def createdata():
+@click.pass_context
+def createdata(ctx):
     if "testdata" not in os.listdir("/"):
         print("No data to add")
         raise SystemExit(1)
-    folders = os.listdir("/testdata")
-    for folder in folders:
-        data_path = Path("/") / "testdata" / folder / "data.json"
-        sheet_path = Path("/") / "testdata" / folder / "sheet.pdf"
-        sheet = models.SheetInDB.parse_file(data_path)
-        if db.sheets.find_one({"sheet_id": sheet.sheet_id}):
-            print(f"skipping {sheet.piece} id: {sheet.sheet_id}")
-            continue
-        sheet.clean_empty_strings()
-        sheet.clean_tags()
-        db.sheets.insert_one(sheet.dict())
-        sheet_stats = os.stat(str(sheet_path.absolute()))
-        sheet_file = sheet_path.open("rb")
-        minio_client.put_object(
-            os.getenv("MINIO_BUCKET_NAME"),
-            f"{sheet.owner_email}/{sheet.sheet_id}.{sheet.file_ext}",
-            sheet_file,
-            sheet_stats.st_size,
+    ctx.invoke(importdata, source="/testdata")
+
+
+def object_exists(bucket, object_name):
+    try:
+        minio_client.stat_object(bucket, object_name)
+    except minio.error.NoSuchKey:
+        return False
+    return True
+
+
+def migrate_blob(collection, doc) -> bool:
+    """Move one sheet's legacy object into its hashed blob, returning whether
+    the object was there to move."""
+    bucket = os.getenv("MINIO_BUCKET_NAME")
+    sheet = models.SheetInDB.parse_obj(doc)
+    legacy_name = storage.sheet_object_name(sheet)
+    legacy_preview = storage.legacy_preview_name(sheet.sheet_id, sheet.owner_email)
+    try:
+        data = minio_client.get_object(bucket, legacy_name)
+    except minio.error.NoSuchKey:
+        print(f"skipping {sheet.piece} id: {sheet.sheet_id}, {legacy_name} missing")
+        return False
+    digest = hashlib.sha256()
+    try:
+        for chunk in data.stream(storage.CHUNK_SIZE):
+            digest.update(chunk)
+    finally:
+        data.close()
+        data.release_conn()
+    sheet.blob_id = digest.hexdigest()
+    blob_name = storage.sheet_object_name(sheet)
+    if not object_exists(bucket, blob_name):
+        minio_client.copy_object(bucket, blob_name, f"/{bucket}/{legacy_name}")
+    db.blobs.update_one({"_id": sheet.blob_id}, {"$inc": {"refcount": 1}}, upsert=True)
+    collection.update_one({"_id": doc["_id"]}, {"$set": {"blob_id": sheet.blob_id}})
+    minio_client.remove_object(bucket, legacy_name)
+    minio_client.remove_object(bucket, legacy_preview)
+    return True
+
+
+@cli.command()
+def migrateblobs():
+    """Move sheets stored as {owner_email}/{sheet_id}.{ext} into hashed blobs."""
+    # Old versions hold references to their blobs just as live sheets do.
+    for collection in (db.sheets, db.sheet_versions):
+        migrated = sum(
+            migrate_blob(collection, doc) for doc in collection.find({"blob_id": None})
         )
-        sheet_file.seek(0)
-        images = convert_from_bytes(
-            sheet_file.read(),
-            dpi=50,
-            use_cropbox=True,
-            first_page=1,
-            last_page=1,
-            grayscale=True,
+        print(f"Migrated {migrated} documents in {collection.name}")
+
+
+@cli.command()
+def setsortkeys():
+    """Fill in the sort keys that list pages are paginated on."""
+    updates = []
+    for doc in db.sheets.find({}, {"prev_versions": 0}):
+        sort_keys = {
+            field: models.sort_key(doc.get(field))
+            for field in models.Sheet.sortable_fields()
+        }
+        if doc.get("sort_keys") != sort_keys:
+            updates.append(
+                pymongo.UpdateOne(
+                    {"_id": doc["_id"]}, {"$set": {"sort_keys": sort_keys}}
+                )
+            )
+        if len(updates) == 1000:
+            db.sheets.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        db.sheets.bulk_write(updates, ordered=False)
+    print("Sort keys up to date")
+
+
+@cli.command()
+def migrateversions():
+    """Move old versions out of sheets and into sheet_versions."""
+    moved = 0
+    for doc in db.sheets.find({"current": True}, {"sheet_id": 1, "prev_versions": 1}):
+        lineage_id = doc["sheet_id"]
+        for version_id, replaced_at in doc.get("prev_versions") or []:
+            version = db.sheets.find_one({"sheet_id": version_id, "current": False})
+            if version is None:
+                continue
+            version.pop("_id")
+            version.pop("prev_versions", None)
+            version.update(lineage_id=lineage_id, replaced_at=replaced_at)
+            db.sheet_versions.replace_one(
+                {"sheet_id": version_id}, version, upsert=True
+            )
+            db.sheets.delete_one({"sheet_id": version_id, "current": False})
+            moved += 1
+        db.sheets.update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"lineage_id": lineage_id}, "$unset": {"prev_versions": ""}},
+        )
+    # Versions no live sheet points at still keep their own history.
+    for version in db.sheets.find({"current": False}):
+        db.sheets.delete_one({"_id": version.pop("_id")})
+        version.pop("prev_versions", None)
+        version.setdefault("lineage_id", version["sheet_id"])
+        version.setdefault("replaced_at", datetime.datetime.now())
+        db.sheet_versions.replace_one(
+            {"sheet_id": version["sheet_id"]}, version, upsert=True
+        )
+        moved += 1
+    print(f"Moved {moved} old versions to sheet_versions")
+
+
+@cli.command()
+def rebuildtaxonomy():
+    """Recount every user's tags, composers, instruments and genres."""
+    # $out swaps the collection in once the counts are done and keeps its
+    # indexes; counts changed by edits made meanwhile are lost.
+    db.sheets.aggregate(taxonomy.rebuild_pipeline())
+    print(f"Counted {db.taxonomy.count_documents({})} terms")
+
+
+def query_shapes():
+    """Yield (description, explain command, allow in-memory sort) for every
+    query the app sends."""
+    owner = "explain@example.com"
+    sheet = models.Sheet(
+        piece="explain",
+        catalog_number="explain",
+        composers=["explain"],
+        genre="explain",
+        tags=["explain"],
+        instruments=["explain"],
+        type="explain",
+        owner_email=owner,
+        sheet_id=uuid.uuid4(),
+        file_ext="pdf",
+    )
+    cursor = pagination.encode_cursor("explain", uuid.uuid4())
+    filters = {
+        "user sheets": sheet_crud.user_sheets_query(owner),
+        "tag sheets": tag_crud.get_tag_query(owner, "explain"),
+        "composer sheets": composer_crud.get_composer_query(owner, "explain"),
+        "instrument sheets": instrument_crud.get_instrument_query(owner, "explain"),
+    }
+    for field in models.Sheet.allowed_related_fields():
+        for exclude in (True, False):
+            filters[f"related {field} (exclude={exclude})"] = (
+                sheet_crud.generate_related_query(sheet, field, exclude)
+            )
+    pages = [
+        ("first page", {}),
+        ("next page", {"after": cursor}),
+        ("previous page", {"before": cursor}),
+    ]
+    for name, query in filters.items():
+        yield (
+            f"{name}, counts",
+            {
+                "aggregate": "sheets",
+                "pipeline": pagination.summary_pipeline(
+                    query, with_total=True, facets=pagination.FACET_FIELDS
+                ),
+                "cursor": {},
+            },
+            False,
+        )
+        for sort in models.Sheet.sortable_fields():
+            for direction in indexes.SORT_DIRECTIONS:
+                for page_name, page_args in pages:
+                    pipeline = pagination.build_pipeline(
+                        query,
+                        sort,
+                        direction,
+                        projection=models.SUMMARY_PROJECTION,
+                        **page_args,
+                    )
+                    yield (
+                        f"{name}, {page_name}, sort {sort} {direction}",
+                        {"aggregate": "sheets", "pipeline": pipeline, "cursor": {}},
+                        False,
+                    )
+    # $text results can't come from another index in sort order.
+    yield (
+        "text search ranking",
+        {
+            "find": "sheets",
+            "filter": search.text_search_query(owner, "explain"),
+            "projection": {"sheet_id": 1, "score": {"$meta": "textScore"}},
+            "sort": {"score": {"$meta": "textScore"}},
+        },
+        True,
+    )
+    ranked = [uuid.uuid4() for _ in range(3)]
+    # At most SEARCH_MAX_RESULTS matches are sorted by a field.
+    yield (
+        "search results sorted by field",
+        {
+            "aggregate": "sheets",
+            "pipeline": pagination.build_pipeline(
+                {**sheet_crud.user_sheets_query(owner), "sheet_id": {"$in": ranked}}
+            ),
+            "cursor": {},
+        },
+        True,
+    )
+    for with_facets in (False, True):
+        yield (
+            f"search results page (facets={with_facets})",
+            {
+                "aggregate": "sheets",
+                "pipeline": search.ranked_pipeline(
+                    owner, ranked, ranked[:2], with_facets
+                ),
+                "cursor": {},
+            },
+            False,
+        )
+    yield (
+        "search index sync",
+        {
+            "find": "sheets",
+            "filter": sheet_crud.user_sheets_query(owner),
+            "projection": {"_id": 0, "sheet_id": 1},
+        },
+        False,
+    )
+    yield (
+        "related lists",
+        {
+            "aggregate": "sheets",
+            "pipeline": sheet_crud.related_lists_pipeline(
+                sheet, ["piece", "composers", "tags"]
+            ),
+            "cursor": {},
+        },
+        False,
+    )
+    yield (
+        "previous versions",
+        {
+            "find": "sheet_versions",
+            "filter": {"owner_email": owner, "lineage_id": sheet.sheet_id},
+            "sort": {"replaced_at": -1},
+        },
+        False,
+    )
+    yield (
+        "old version by id",
+        {
+            "find": "sheet_versions",
+            "filter": {"owner_email": owner, "sheet_id": sheet.sheet_id},
+        },
+        False,
+    )
+    yield (
+        "sheet by id",
+        {
+            "find": "sheets",
+            "filter": {"owner_email": owner, "sheet_id": sheet.sheet_id},
+        },
+        False,
+    )
+    yield (
+        "stale preview renders",
+        {
+            "find": "sheets",
+            "filter": sheet_crud.stale_preview_query(datetime.datetime.now()),
+            "limit": 1,
+        },
+        False,
+    )
+    yield (
+        "autocomplete values",
+        {"find": "taxonomy", "filter": {"owner_email": owner}},
+        False,
+    )
+    for field in taxonomy.TAXONOMY_FIELDS:
+        for sort, keys in taxonomy.TERM_SORTS.items():
+            yield (
+                f"all {field}, sort {sort}",
+                {
+                    "find": "taxonomy",
+                    "filter": taxonomy.terms_query(owner, field),
+                    "sort": dict(keys),
+                },
+                False,
+            )
+
+
+def plan_problems(explain, allow_sort: bool):
+    """Collection scans and in-memory sorts anywhere in an explain result.
+
+    Sorts after a $group, such as the one explain shows for $sortByCount,
+    order the grouped results rather than documents and are allowed.
+    """
+    problems = set()
+    if isinstance(explain, list):
+        for item in explain:
+            problems |= plan_problems(item, allow_sort)
+            if isinstance(item, dict) and "$group" in item:
+                allow_sort = True
+    elif isinstance(explain, dict):
+        stage = explain.get("stage")
+        if stage == "COLLSCAN":
+            problems.add("COLLSCAN")
+        if (stage == "SORT" or "$sort" in explain) and not allow_sort:
+            problems.add("in-memory SORT")
+        for key, value in explain.items():
+            # The echoed command contains the pipeline's own $sort.
+            if key != "command":
+                problems |= plan_problems(value, allow_sort)
+    return problems
+
+
+@cli.command()
+@click.option("--prune", is_flag=True, help="Drop indexes missing from the registry.")
+def syncindexes(prune):
+    """Make indexes match app/indexes.py and check every query uses them."""
+    for collection, wanted in indexes.INDEXES.items():
+        created = db[collection].create_indexes(wanted)
+        print(f"{collection}: {', '.join(created)}")
+        names = {index.document["name"] for index in wanted} | {"_id_"}
+        for name in db[collection].index_information():
+            if name in names:
+                continue
+            if prune:
+                db[collection].drop_index(name)
+                print(f"{collection}: dropped {name}")
+            else:
+                print(f"{collection}: {name} is not in the registry")
+    failures = 0
+    for description, command, allow_sort in query_shapes():
+        explain = db.command("explain", command, verbosity="queryPlanner")
+        problems = plan_problems(explain, allow_sort)
+        if problems:
+            failures += 1
+            print(f"FAIL {description}: {', '.join(sorted(problems))}")
+    if failures:
+        print(f"{failures} queries are not fully backed by an index")
+        raise SystemExit(1)
+    print("All queries use indexes")
+
+
+def seed_benchmark_sheets(collection, count: int, versions: int):
+    now = datetime.datetime.now()
+    docs = []
+    for number in range(count):
+        sheet = models.SheetInDB(
+            piece=f"Piece {number}",
+            catalog_number=f"Op. {number}",
+            composers=["Composer One", "Composer Two"],
+            genre="Classical",
+            tags=["benchmark", "seeded"],
+            instruments=["violin", "viola", "cello"],
+            type="part",
+            owner_email="benchmark@example.com",
+            sheet_id=uuid.uuid4(),
+            file_ext="pdf",
+            prev_versions=[(uuid.uuid4(), now) for _ in range(versions)],
+        )
+        sheet.set_sort_keys()
+        docs.append(sheet.dict())
+        if len(docs) == 1000:
+            collection.insert_many(docs)
+            docs = []
+    if docs:
+        collection.insert_many(docs)
+
+
+@cli.command()
+@click.option("--count", default=5000, show_default=True)
+@click.option("--versions", default=30, show_default=True)
+@click.option("--rounds", default=3, show_default=True)
+def benchlists(count, versions, rounds):
+    """Compare full and summary list parsing on a seeded collection."""
+    collection = db["benchmark_sheets"]
+    collection.drop()
+    seed_benchmark_sheets(collection, count, versions)
+    query = sheet_crud.user_sheets_query("benchmark@example.com")
+    cases = [
+        ("full documents, SheetOut", None, models.SheetOut.parse_obj),
+        (
+            "summary projection, SheetSummary",
+            models.SUMMARY_PROJECTION,
+            models.SheetSummary.parse_obj,
+        ),
+    ]
+    try:
+        for name, projection, parse in cases:
+            best = None
+            for _ in range(rounds):
+                start = time.monotonic()
+                for doc in collection.find(query, projection):
+                    parse(doc)
+                elapsed = time.monotonic() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name}: {count / best:.0f} docs/s ({best:.2f}s for {count})")
+    finally:
+        collection.drop()
+
+
+async def login_cycles(hash_secret, verify_secret, logins: int, concurrency: int):
+    """Hash and verify ``logins`` OTPs, ``concurrency`` at a time.
+
+    Returns the elapsed seconds and the longest the event loop was stalled.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    stalls = [0.0]
+    done = asyncio.Event()
+
+    async def watch_loop():
+        while not done.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(0.005)
+            stalls[0] = max(stalls[0], time.monotonic() - start - 0.005)
+
+    async def login():
+        async with slots:
+            code = "12345678"
+            assert await verify_secret(code, await hash_secret(code))
+
+    watcher = asyncio.ensure_future(watch_loop())
+    start = time.monotonic()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.monotonic() - start
+    done.set()
+    await watcher
+    return elapsed, stalls[0]
+
+
+@cli.command()
+@click.option("--logins", default=200, show_default=True)
+@click.option("--concurrency", default=20, show_default=True)
+def benchlogin(logins, concurrency):
+    """Compare login secret hashing strategies under concurrent logins."""
+
+    async def inline_bcrypt_hash(secret):
+        return security.pwd_context.hash(secret)
+
+    async def inline_bcrypt_verify(secret, secret_hash):
+        return security.pwd_context.verify(secret, secret_hash)
+
+    cases = [
+        ("bcrypt on the event loop", inline_bcrypt_hash, inline_bcrypt_verify),
+        (
+            f"bcrypt on {security.BCRYPT_WORKERS} threads",
+            lambda secret: security.hash_secret(secret, "bcrypt"),
+            security.verify_secret,
+        ),
+        (
+            "hmac-sha256",
+            lambda secret: security.hash_secret(secret, "hmac"),
+            security.verify_secret,
+        ),
+    ]
+    loop = asyncio.get_event_loop()
+    for name, hash_secret, verify_secret in cases:
+        elapsed, stall = loop.run_until_complete(
+            login_cycles(hash_secret, verify_secret, logins, concurrency)
         )
-        tmp_preview = tempfile.NamedTemporaryFile()
-        images[0].save(tmp_preview, format="PNG")
-        tmp_preview.seek(0)
-        preview_stats = os.stat(tmp_preview.name)
-        minio_client.put_object(
-            os.getenv("MINIO_BUCKET_NAME"),
-            f"{sheet.owner_email}/{sheet.sheet_id}-preview.png",
-            tmp_preview,
-            preview_stats.st_size,
+        print(
+            f"{name}: {logins / elapsed:.0f} logins/s, "
+            f"event loop stalled up to {stall * 1000:.1f}ms"
         )
-        tmp_preview.close()
-        sheet_file.close()
 
 
 if __name__ == "__main__":